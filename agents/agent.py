@@ -7,7 +7,8 @@ from utils import log, LogLevel
 import env
 from tools import ToolCallToConfirm
 from tools import ToolExecutor
-from utils.llm import llm_tools_invoke, llm_tools_stream
+from utils.llm import llm_tools_invoke, llm_tools_stream, HistoryPreparer
+from utils.llm_scheduler import Priority
 import json
 from typing import Generator
 
@@ -31,7 +32,9 @@ class Agent:
                  job_continue_or_end_prompt: str,
                  tools: list[str] = None,
                  max_step: int = 20,
-                 final_tool: str = "final_answer"):
+                 final_tool: str = "final_answer",
+                 priority: Priority = Priority.INTERACTIVE,
+                 prepare_history: HistoryPreparer = None):
         self.name = name
         self.system_prompt = system_prompt
         self.job_continue_or_end_prompt = job_continue_or_end_prompt
@@ -42,6 +45,10 @@ class Agent:
         }
         self.max_step = max_step
         self.final_tool = final_tool
+        # Scheduling class of this agent's LLM calls
+        self.priority = priority
+        # Rewrites the history sent to the LLM, e.g. to replace long tool arguments by summaries
+        self.prepare_history = prepare_history
 
     def add_env_tools(self, env: str, tools: list[str]):
         self.env_tools[env] = tools
@@ -84,7 +91,8 @@ class Agent:
             formatted_message: str = self.job_continue_or_end_prompt.format(
                 user_input=user_input, env=session.get_ctx("env"))
             session.add_message(HumanMessage(content=formatted_message))
-            yield from llm_tools_stream(llm_with_tools, session)
+            yield from llm_tools_stream(llm_with_tools, session, priority=self.priority,
+                                        prepare_history=self.prepare_history)
 
         last_ai_message: type[AIMessage] = None
         task_finish_flag: bool = False
@@ -144,7 +152,8 @@ class Agent:
                 return
 
             # Loop conversation
-            last_ai_message = llm_tools_invoke(llm_with_tools, session)
+            last_ai_message = llm_tools_invoke(
+                llm_with_tools, session, priority=self.priority, prepare_history=self.prepare_history)
 
         # hit boundary，give the opportunity to user to continue the conversation
         if i == self.max_step - 1:
@@ -1,4 +1,5 @@
 from agents.agent import Agent
+from utils.llm_scheduler import Priority
 
 
 # System prompt
@@ -17,4 +18,5 @@ job_continue_or_end_prompt = """
 # Main agent
 critic_agent = Agent("critic_agent",
                      system_prompt,
-                     job_continue_or_end_prompt)
+                     job_continue_or_end_prompt,
+                     priority=Priority.SUB_AGENT)
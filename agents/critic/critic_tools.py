@@ -1,4 +1,131 @@
-from typing import Optional
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Deque, Dict, Generator, Optional, Tuple
 from utils import log, LogLevel
 from session import session_manager
-from langchain_core.tools import tool
+from agents.critic.critic_agent import critic_agent
+from agents.sub_agent import sub_agent_sessions, sub_session_id
+from env import CRITIC_WORKERS, CRITIC_WAIT, ENABLE_CRITIC_GATE
+from utils.chapter_memory import ChapterMemory
+from utils.chunk_analysis import critic_gate, gate_feedback
+from utils.index_store import IndexStore
+from utils.llm import stream_text
+
+
+# Answer of the critic tool when a review outlasts CRITIC_WAIT, the feedback reaches the main agent once stored
+REVIEW_PENDING = "The critic is still reviewing chunk {chunk_index}, its feedback will be shown at a later step"
+
+
+def critic_session_id(session_id: str) -> str:
+    return sub_session_id(session_id, critic_agent)
+
+
+def review_text(session_id: str, content: str) -> Generator:
+    """Critic feedback on a chunk, the pre-critic gate answers instead of the critic when the checks are clear"""
+    if ENABLE_CRITIC_GATE:
+        language = session_manager.get_session(session_id).get_ctx("story_language")
+        decision, reasons, analysis = critic_gate.check(content, language)
+        log(session_id, f"critic gate: {decision.value} {reasons} {analysis}", LogLevel.DEBUG)
+        feedback = gate_feedback(decision, reasons, analysis)
+        if feedback is not None:
+            yield feedback
+            return
+    yield from sub_agent_sessions.call(critic_agent, session_id, content)
+
+
+def review_chunk(session_id: str, chunk_index: int) -> Optional[str]:
+    """Run the critic on the stored chunk and keep its feedback with the chunk version it reviewed"""
+    index_store = IndexStore(session_id)
+    pipe = index_store.redis_client.pipeline()
+    pipe.hget(index_store.data_key, chunk_index)
+    pipe.hget(index_store.chunk_versions_key, chunk_index)
+    content, chunk_version = pipe.execute()
+    if content is None:
+        return None
+    feedback = stream_text(review_text(session_id, content.decode('utf-8')))
+    ChapterMemory(session_id).set_feedback(chunk_index, int(chunk_version or 0), feedback)
+    return feedback
+
+
+class CriticPipeline:
+    """
+    Reviews chunks in the background as soon as they are stored, so the critic's round trip overlaps the
+    generation of the next chunk. Feedback is stored with the chunk (ChapterMemory) and shown to the main
+    agent at its next step. Reviews of one session run in order, the critic's session policy may carry
+    earlier reviews into the next one: a session's reviews wait in its queue, not on a worker thread, and the
+    next one is submitted when the previous one is done. The order only holds within one process: pending reviews live in
+    this process, a session whose requests reach several workers may have reviews of two workers
+    running on its critic sub-session at once.
+    """
+
+    def __init__(self, workers: int = CRITIC_WORKERS):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="critic")
+        self._lock = threading.Lock()
+        # (session, chunk) -> pending review, session -> reviews waiting for its running review
+        self._reviews: Dict[Tuple[str, int], Future] = {}
+        self._queues: Dict[str, Deque[Tuple[int, Future]]] = {}
+
+    def submit(self, session_id: str, chunk_index: int) -> Future:
+        """Review a chunk after the session's earlier reviews"""
+        future = Future()
+        future.add_done_callback(
+            lambda f: self._done(session_id, chunk_index, f))
+        with self._lock:
+            self._reviews[(session_id, chunk_index)] = future
+            queue = self._queues.get(session_id)
+            if queue is not None:
+                queue.append((chunk_index, future))
+                return future
+            self._queues[session_id] = deque()
+        self.executor.submit(self._run, session_id, chunk_index, future)
+        return future
+
+    @staticmethod
+    def _run(session_id: str, chunk_index: int, future: Future):
+        try:
+            future.set_result(review_chunk(session_id, chunk_index))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _done(self, session_id: str, chunk_index: int, future: Future):
+        with self._lock:
+            if self._reviews.get((session_id, chunk_index)) is future:
+                del self._reviews[(session_id, chunk_index)]
+            # Only the running review of a session completes, start the next one or retire the queue
+            queue = self._queues.get(session_id)
+            following = queue.popleft() if queue else None
+            if following is None:
+                self._queues.pop(session_id, None)
+        if following is not None:
+            self.executor.submit(self._run, session_id, *following)
+        if future.exception() is not None:
+            log(session_id, f"critic review of chunk {chunk_index} failed: {future.exception()}",
+                LogLevel.ERROR)
+
+    def pending(self, session_id: str, chunk_index: int) -> bool:
+        with self._lock:
+            return (session_id, chunk_index) in self._reviews
+
+    def feedback(self, session_id: str, chunk_index: int, timeout: float = CRITIC_WAIT) -> Optional[str]:
+        """
+        Feedback on the current content of a chunk, waiting for its pending review; None if never reviewed.
+        A review still running after `timeout` answers REVIEW_PENDING, it keeps running on its own.
+        """
+        with self._lock:
+            future = self._reviews.get((session_id, chunk_index))
+        if future is not None:
+            try:
+                future.result(timeout)
+            except TimeoutError:
+                log(session_id, f"critic review of chunk {chunk_index} still running after {timeout}s",
+                    LogLevel.WARNING)
+                return REVIEW_PENDING.format(chunk_index=chunk_index)
+            except Exception:
+                return None
+        return ChapterMemory(session_id).feedback(chunk_index).get(chunk_index)
+
+
+# Global critic pipeline instance
+critic_pipeline = CriticPipeline()
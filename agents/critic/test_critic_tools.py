@@ -0,0 +1,134 @@
+import threading
+import time
+import uuid
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from redis import Redis
+from env import get_redis_env
+from session import session_manager
+from utils.chapter_memory import ChapterMemory, compact_history
+import agents.critic.critic_tools
+from agents.critic.critic_tools import CriticPipeline, critic_pipeline, critic_session_id, REVIEW_PENDING
+from utils.chunk_analysis import critic_gate
+import agents.main.writer_tools
+from agents.main.writer_tools import prompt_chunk_content
+
+
+class SlowCriticLLM(BaseChatModel):
+    """Fake critic answering after a delay with the first words of the chunk it reviewed"""
+    delay: float = 0.5
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-critic"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        time.sleep(self.delay)
+        chunk = messages[-1].content.split("# The content of the novel chapter is:\n")[1].split("\n")[0]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=f"Review of {chunk}"))])
+
+
+def test_critic_pipeline():
+    """Test background critic reviews overlapping chunk generation"""
+    print("=== Testing critic pipeline ===")
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping critic pipeline tests (Redis service may not be running)\n")
+        return
+
+    import agents.agent
+    llm = agents.agent.job_intent_llm
+    fake = agents.agent.job_intent_llm = SlowCriticLLM()
+    # Background reviews are opt-in
+    async_critic, agents.main.writer_tools.ENABLE_ASYNC_CRITIC = agents.main.writer_tools.ENABLE_ASYNC_CRITIC, True
+    # Short chunks without dialogue, borderline for the pre-critic gate so the critic reviews them
+    min_words, critic_gate.min_words = critic_gate.min_words, 0
+    session_id = f"test_critic_{uuid.uuid4()}"
+    session = session_manager.get_session(session_id)
+    memory = ChapterMemory(session_id)
+    try:
+        session.set_ctx("title", "Test Novel")
+        start = time.perf_counter()
+        for i in range(1, 4):
+            prompt_chunk_content.invoke(
+                {"chunk_index": i, "content": f"chunk{i} text", "session_id": session_id})
+        assert time.perf_counter() - start < fake.delay, "Storing chunks should not wait for the critic"
+        assert critic_pipeline.pending(session_id, 3), "Reviews should run in the background"
+
+        assert critic_pipeline.feedback(session_id, 3) == "Review of chunk3 text", "The tool should get the review"
+        assert memory.feedback() == {2: "Review of chunk2 text", 3: "Review of chunk3 text"}, \
+            "Feedback of the latest chunks should be kept"
+        system = compact_history(session_id, [SystemMessage(content="system")])[0].content
+        assert "# Critic feedback" in system and "Review of chunk3 text" in system, \
+            "Feedback should reach the main agent at its next step"
+
+        # Rewritten chunks drop the feedback on the old text until they are reviewed again
+        prompt_chunk_content.invoke({"chunk_index": 3, "content": "chunk3 revised", "session_id": session_id})
+        assert 3 not in memory.feedback(), "Feedback on replaced content should be hidden"
+        assert critic_pipeline.feedback(session_id, 3) == "Review of chunk3 revised", "The rewrite should be reviewed"
+
+        # A review outlasting the wait is reported pending and finishes once, never reviewed twice
+        calls = fake.calls
+        prompt_chunk_content.invoke({"chunk_index": 4, "content": "chunk4 text", "session_id": session_id})
+        assert critic_pipeline.feedback(session_id, 4, timeout=0.05) == REVIEW_PENDING.format(chunk_index=4), \
+            "A slow review should be reported pending"
+        assert critic_pipeline.feedback(session_id, 4) == "Review of chunk4 text", "The pending review should finish"
+        assert fake.calls == calls + 1, f"Chunk 4 should be reviewed once, {fake.calls - calls} reviews"
+        print("Critic pipeline tests passed\n")
+    finally:
+        agents.agent.job_intent_llm = llm
+        agents.main.writer_tools.ENABLE_ASYNC_CRITIC = async_critic
+        critic_gate.min_words = min_words
+        session_manager.sessions.pop(session_id, None)
+        redis_client.delete(*memory.index_store._chunk_keys, memory.index_store.meta_key, memory.key,
+                            memory.feedback_key, critic_session_id(session_id),
+                            f"session_ctx:{critic_session_id(session_id)}",
+                            f"session_ctx:{session_id}", f"session_keys:{session_id}")
+
+
+def test_critic_pipeline_queues():
+    """Test one session's queued reviews run in order without holding the other sessions' workers"""
+    print("=== Testing critic pipeline queues ===")
+
+    lock = threading.Lock()
+    started, running = [], {}
+
+    def fake_review(session_id: str, chunk_index: int) -> str:
+        with lock:
+            started.append((session_id, chunk_index))
+            running[session_id] = running.get(session_id, 0) + 1
+            assert running[session_id] == 1, "Reviews of one session should not overlap"
+        time.sleep(0.2)
+        with lock:
+            running[session_id] -= 1
+        return f"Review of {session_id} {chunk_index}"
+
+    review_chunk = agents.critic.critic_tools.review_chunk
+    agents.critic.critic_tools.review_chunk = fake_review
+    try:
+        pipeline = CriticPipeline(workers=2)
+        busy = [pipeline.submit("busy", i) for i in range(1, 5)]
+        time.sleep(0.05)
+        other = pipeline.submit("other", 1)
+        assert other.result(0.5) == "Review of other 1", "Other sessions should not wait for a busy session"
+        assert not busy[-1].done(), "The busy session's reviews should still be queued"
+        assert [f.result(2) for f in busy] == [f"Review of busy {i}" for i in range(1, 5)], "Unexpected reviews"
+        assert [chunk for session, chunk in started if session == "busy"] == [1, 2, 3, 4], \
+            "Reviews of one session should run in submission order"
+        time.sleep(0.05)
+        assert not pipeline._queues and not pipeline._reviews, "Finished sessions should be forgotten"
+        print("Critic pipeline queue tests passed\n")
+    finally:
+        agents.critic.critic_tools.review_chunk = review_chunk
+
+
+if __name__ == "__main__":
+    test_critic_pipeline()
+    test_critic_pipeline_queues()
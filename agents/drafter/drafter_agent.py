@@ -0,0 +1,44 @@
+from agents.agent import Agent
+from utils.llm_scheduler import Priority
+
+
+# System prompt
+system_prompt = """
+# You are a novelist drafting one chunk of a novel while other writers draft the other chunks at the same time. Follow the novel's title, characters and outline, write exactly the plot of your chunk and nothing of the chunks before or after it, so the chunks join into one story.
+
+## chunk content requirements
+Balance description and action: Use small plot advancements as the main thread, interspersed with sensory descriptions and emotional introspection. Avoid long, cumbersome background narratives that dominate the text and prevent rhythm fatigue.
+Strengthen character motivation and dialogue: Reveal character traits and positions through direct dialogue and character choices. Leave room for interpretation and avoid didactic exposition; let the plot progression reveal the underlying messages.
+
+# Output only the text of the chunk, without titles, notes or explanations.
+"""
+
+job_continue_or_end_prompt = """
+{user_input}
+# Please write the text of the chunk.
+"""
+
+# Drafts one chunk from its outline segment
+drafter_agent = Agent("drafter_agent",
+                      system_prompt,
+                      job_continue_or_end_prompt,
+                      priority=Priority.SUB_AGENT)
+
+
+# System prompt
+stitcher_system_prompt = """
+# You are the editor joining chunks of a novel that were drafted separately. You get the end of the previous chunk and the opening of the next one. Rewrite the opening so it continues smoothly from the previous ending: consistent names, places, time and character states, no repetition of what already happened, a natural transition. Keep its plot, length, style and language.
+
+# Output only the rewritten opening, without notes or explanations.
+"""
+
+stitcher_job_prompt = """
+{user_input}
+# Please rewrite the opening of the next chunk.
+"""
+
+# Rewrites the opening of a drafted chunk to follow the previous one
+stitcher_agent = Agent("stitcher_agent",
+                       stitcher_system_prompt,
+                       stitcher_job_prompt,
+                       priority=Priority.SUB_AGENT)
@@ -0,0 +1,147 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from agents.agent import Agent
+from agents.critic.critic_tools import critic_pipeline
+from agents.drafter.drafter_agent import drafter_agent, stitcher_agent
+from env import CHAPTER_MEMORY_TAIL, PARALLEL_DRAFTING_WORKERS, STITCH_HEAD_CHARS, ENABLE_ASYNC_CRITIC
+from session import MemorySession, session_manager
+from tools import tool_with_confirm
+from utils import log, LogLevel
+from utils.chapter_memory import ChapterMemory
+from utils.index_store import IndexStore
+from utils.llm import stream_text
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n|\n")
+
+
+def agent_text(agent: Agent, session_id: str, prompt: str, user_id: str = None) -> str:
+    """Run a sub-agent without tools in a throwaway session and return its text"""
+    session = MemorySession(session_id)
+    session.set_ctx("user_id", user_id or session_id)
+    return stream_text(agent.call(session, prompt)).strip()
+
+
+def split_opening(content: str, head_chars: int = STITCH_HEAD_CHARS) -> Tuple[str, str]:
+    """Split a chunk after the paragraph reaching `head_chars`, the opening is at least one paragraph"""
+    for match in _PARAGRAPH_BREAK.finditer(content):
+        if match.start() >= head_chars:
+            return content[:match.start()], content[match.start():]
+    return content, ""
+
+
+def _draft_prompt(ctx: Dict[str, str], plan: List[str], position: int, chunk_index: int) -> str:
+    lines = [f"# Novel title: {ctx.get('title') or ''}",
+             f"# Story language: {ctx.get('story_language') or 'the language of the outline'}",
+             f"# Characters:\n{ctx.get('roles') or ''}",
+             f"# Outline:\n{ctx.get('story_outline') or ''}"]
+    if position > 0:
+        lines.append(f"# The previous chunk (not yours): {plan[position - 1]}")
+    lines.append(f"# Your chunk is chunk {chunk_index}: {plan[position]}")
+    if position + 1 < len(plan):
+        lines.append(f"# The next chunk (not yours): {plan[position + 1]}")
+    return "\n\n".join(lines)
+
+
+def _stitch_prompt(ctx: Dict[str, str], previous_tail: str, opening: str) -> str:
+    return "\n\n".join([f"# Characters:\n{ctx.get('roles') or ''}",
+                        f"# End of the previous chunk:\n{previous_tail}",
+                        f"# Opening of the next chunk:\n{opening}"])
+
+
+def draft_in_parallel(session_id: str, plan: List[str], first_chunk: int = 1,
+                      workers: int = PARALLEL_DRAFTING_WORKERS) -> Tuple[Dict[int, str], List[int]]:
+    """
+    Draft the chunks of `plan` concurrently with sub-agents, each given the outline, its own segment and
+    its neighbours' segments, then stitch them in order: the opening of every chunk is rewritten to follow
+    the end of the previous one. Returns the stitched chunks by chunk index and the chunks that failed.
+    """
+    session = session_manager.get_session(session_id)
+    ctx = {key: session.get_ctx(key) for key in ("title", "story_language", "roles", "story_outline")}
+    user_id = session.get_ctx("user_id") or session_id
+    chunk_indexes = [first_chunk + i for i in range(len(plan))]
+
+    def draft(position: int) -> Optional[str]:
+        chunk_index = chunk_indexes[position]
+        try:
+            return agent_text(drafter_agent, f"{session_id}_draft_{chunk_index}",
+                              _draft_prompt(ctx, plan, position, chunk_index), user_id) or None
+        except Exception as e:
+            log(session_id, f"drafting chunk {chunk_index} failed: {e}", LogLevel.ERROR)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(plan)))) as executor:
+        drafts = list(executor.map(draft, range(len(plan))))
+
+    # The chunk before the batch is already stored, the first draft joins it too
+    previous = IndexStore(session_id).get(first_chunk - 1)
+    previous = previous.decode('utf-8') if previous is not None else None
+    chunks: Dict[int, str] = {}
+    for chunk_index, content in zip(chunk_indexes, drafts):
+        if content is None:
+            # Nothing to stitch to past a gap
+            previous = None
+            continue
+        if previous:
+            opening, rest = split_opening(content)
+            try:
+                stitched = agent_text(stitcher_agent, f"{session_id}_stitch_{chunk_index}",
+                                      _stitch_prompt(ctx, previous[-CHAPTER_MEMORY_TAIL:], opening), user_id)
+                content = (stitched or opening) + rest
+            except Exception as e:
+                log(session_id, f"stitching chunk {chunk_index} failed, keeping the draft: {e}", LogLevel.WARNING)
+        chunks[chunk_index] = content
+        previous = content
+    failed = [i for i, content in zip(chunk_indexes, drafts) if content is None]
+    return chunks, failed
+
+
+@tool_with_confirm
+def draft_chunks_in_parallel(
+    chunk_plan: List[str],
+    first_chunk_index: int = 1,
+    reason: Optional[str] = None,
+    session_id: Optional[str] = "writer_tools"
+) -> str:
+    """
+    Draft several chunks at the same time from the outline, much faster than generating them one by one.
+    Use it after the outline is generated, then get the critic's feedback on the drafted chunks and regenerate
+    the ones that do not meet the requirements with prompt_chunk_content.
+
+    Parameters:
+    - chunk_plan: the plot of each chunk to draft, in order, one entry per chunk, taken from the outline
+    - first_chunk_index: chunk_index of the first entry of chunk_plan, starts from 1
+    - reason: reason for calling the tool, used to output the current step description
+    Returns:
+    - str: the drafted chunk indexes and word counts
+    """
+    session = session_manager.get_session(session_id)
+    title = session.get_ctx("title")
+    if not title or not session.get_ctx("story_outline"):
+        log(session_id,
+            f"draft_chunks_in_parallel call with reason: {reason}, error: Please generate novel title and outline first", LogLevel.ERROR)
+        return "Please generate novel title and outline first"
+    log(session_id,
+        f"draft_chunks_in_parallel call with chunk_plan: {chunk_plan}, first_chunk_index: {first_chunk_index}, reason: {reason}", LogLevel.DEBUG)
+
+    chunks, failed = draft_in_parallel(session_id, chunk_plan, first_chunk_index)
+    index_store = IndexStore(session_id)
+    index_store.add_meta({
+        "title": title,
+        "session_id": session_id
+    })
+    memory = ChapterMemory(session_id)
+    for chunk_index, content in chunks.items():
+        index_store.add(chunk_index, content)
+        memory.remember(chunk_index, content,
+                        chunk_plan[chunk_index - first_chunk_index])
+        if ENABLE_ASYNC_CRITIC:
+            critic_pipeline.submit(session_id, chunk_index)
+    stats = index_store.stats()
+
+    log(session_id,
+        f"draft_chunks_in_parallel drafted chunks: {list(chunks)}, failed: {failed}", LogLevel.DEBUG)
+    result = f"Drafted chunk_index: {list(chunks)} \n\n Total word count: {stats['words']} in {stats['chunks']} chunks \n\n"
+    if failed:
+        result += f"Failed chunk_index: {failed}, generate them with prompt_chunk_content \n\n"
+    return result
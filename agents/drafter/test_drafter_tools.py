@@ -0,0 +1,101 @@
+import threading
+import time
+import uuid
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from redis import Redis
+from env import get_redis_env
+from session import session_manager
+from utils.chapter_memory import ChapterMemory
+from agents.critic.critic_tools import critic_pipeline, critic_session_id
+from agents.drafter.drafter_tools import draft_chunks_in_parallel, split_opening
+
+
+class FakeWriterLLM(BaseChatModel):
+    """Fake chat model: drafters echo their chunk's segment, the stitcher marks the opening it rewrote"""
+    delay: float = 0.3
+    running: int = 0
+    peak: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-writer"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        with _lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(self.delay)
+        with _lock:
+            self.running -= 1
+        prompt = messages[-1].content
+        if "rewrite the opening" in prompt:
+            opening = prompt.split("# Opening of the next chunk:\n")[1].split("\n# Please")[0].strip()
+            content = f"[stitched] {opening}"
+        elif "# Your chunk is " in prompt:
+            segment = prompt.split("# Your chunk is ")[1].split("\n")[0]
+            content = f"Draft of {segment}\n\nThe rest of the chunk."
+        else:
+            content = "The chunk reads well."
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+
+_lock = threading.Lock()
+
+
+def test_parallel_drafting():
+    """Test concurrent chunk drafting with the stitching pass"""
+    print("=== Testing parallel drafting ===")
+
+    opening, rest = split_opening("a" * 5 + "\n\n" + "b" * 5 + "\n" + "c", head_chars=6)
+    assert (opening, rest) == ("a" * 5 + "\n\n" + "b" * 5, "\nc"), "Opening should end at a paragraph break"
+    assert split_opening("one paragraph", head_chars=3) == ("one paragraph", ""), \
+        "A single paragraph is all opening"
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping parallel drafting tests (Redis service may not be running)\n")
+        return
+
+    import agents.agent
+    llm = agents.agent.job_intent_llm
+    fake = agents.agent.job_intent_llm = FakeWriterLLM()
+    session_id = f"test_drafting_{uuid.uuid4()}"
+    session = session_manager.get_session(session_id)
+    memory = ChapterMemory(session_id)
+    try:
+        session.set_ctx("title", "Test Novel")
+        session.set_ctx("story_outline", "Four short scenes")
+        plan = [f"scene {i}" for i in range(1, 5)]
+        start = time.perf_counter()
+        result = draft_chunks_in_parallel.invoke({"chunk_plan": plan, "session_id": session_id})
+        elapsed = time.perf_counter() - start
+
+        assert "Drafted chunk_index: [1, 2, 3, 4]" in result, f"Every chunk should be drafted: {result}"
+        assert fake.peak > 1, "Drafts should run concurrently"
+        # Four drafts at once, then three short stitches in order
+        assert elapsed < 7 * fake.delay, f"Drafting should not run one chunk after another: {elapsed:.2f}s"
+        first = memory.index_store.get(1).decode('utf-8')
+        assert first == "Draft of chunk 1: scene 1\n\nThe rest of the chunk.", "First chunk has nothing to join"
+        third = memory.index_store.get(3).decode('utf-8')
+        assert third.startswith("[stitched] Draft of chunk 3: scene 3"), "Later chunks should be stitched"
+        assert third.endswith("The rest of the chunk."), "Stitching should keep the rest of the chunk"
+        assert memory.summaries()[2]["beats"] == "scene 2", "The plan should become the chapter memory"
+        for i in range(1, 5):
+            critic_pipeline.feedback(session_id, i)
+        print("Parallel drafting tests passed\n")
+    finally:
+        agents.agent.job_intent_llm = llm
+        session_manager.sessions.pop(session_id, None)
+        redis_client.delete(*memory.index_store._chunk_keys, memory.index_store.meta_key, memory.key,
+                            memory.feedback_key, critic_session_id(session_id),
+                            f"session_ctx:{critic_session_id(session_id)}",
+                            f"session_ctx:{session_id}", f"session_keys:{session_id}")
+
+
+if __name__ == "__main__":
+    test_parallel_drafting()
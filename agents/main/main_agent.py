@@ -1,6 +1,8 @@
 from tools import time_tools, math_tools
 from agents.agent import Agent
 from agents.main.writer_tools import writer_tools
+from utils.chapter_memory import compact_history
+from env import ENABLE_ASYNC_CRITIC
 
 
 # Default tool set
@@ -26,11 +28,19 @@ Strengthen character motivation and dialogue: Reveal character traits and positi
 
 # After each chunk is generated, count the current novel word count and adjust according to the target word count until it exceeds the target word count.
 
-# After each chunk is generated, you need to get the critic's feedback on the chunk content.
+{critic_instruction}
+
+# Confirmed chunks are not repeated in the conversation, the chapter memory in this prompt summarizes them and shows the end of the last one. Always fill plot_beats and character_states when generating a chunk so the memory stays accurate.
 
 # you have to check tool finish_novel to judge whether the whole novel is finished.
 """
 
+if ENABLE_ASYNC_CRITIC:
+    critic_instruction = "# After each chunk is generated, the critic reviews it in the background while you go on with the next chunk. Its feedback appears in the Critic feedback section of this prompt, regenerate the chunk it reviewed when the feedback asks for changes that matter."
+else:
+    critic_instruction = "# After each chunk is generated, you need to get the critic's feedback on the chunk content."
+system_prompt = system_prompt.replace("{critic_instruction}", critic_instruction)
+
 job_continue_or_end_prompt = """
 # chunk content requirements
 Balance description and action: Use small plot advancements as the main thread, interspersed with sensory descriptions and emotional introspection. Avoid long, cumbersome background narratives that dominate the text and prevent rhythm fatigue.
@@ -45,6 +55,7 @@ Strengthen character motivation and dialogue: Reveal character traits and positi
 main_agent = Agent("main_agent",
                    system_prompt,
                    job_continue_or_end_prompt,
-                   default_tools, final_tool="finish_novel")
+                   default_tools, final_tool="finish_novel",
+                   prepare_history=compact_history)
 # Add UI tool set
 # main_agent.add_env_tools("ui", ui_tools)
@@ -6,10 +6,13 @@ from langchain_core.tools import tool
 from tools import tool_with_confirm
 from utils import log, LogLevel
 from session import session_manager
-from agents.critic.critic_agent import critic_agent
+from agents.critic.critic_tools import critic_pipeline, review_text
 from typing import Generator
 from typing import Optional
-from utils.index_store import IndexStore
+from utils.index_store import IndexStore, text_counts
+from utils.chapter_memory import ChapterMemory
+from agents.drafter.drafter_tools import draft_chunks_in_parallel
+from env import ENABLE_PARALLEL_DRAFTING, ENABLE_ASYNC_CRITIC
 
 
 output_dir = "assets"
@@ -32,18 +35,35 @@ def critic_the_chunk_content(
     Returns:
     - Generator: feedback on the novel chapter content
     """
-    sub_session_id = f"{session_id}_sub_agent_critic"
-    sub_session: Session = session_manager.get_session(sub_session_id)
     index_store = IndexStore(session_id)
+    if ENABLE_ASYNC_CRITIC:
+        # Reviewed in the background when the chunk was stored
+        feedback = critic_pipeline.feedback(session_id, chunk_index)
+        if feedback is None:
+            if index_store.get(chunk_index) is None:
+                log(session_id,
+                    f"critic_the_chunk_content call with chunk_index: {chunk_index}, error: Content not found", LogLevel.ERROR)
+                return "Content not found"
+            # Never reviewed, queue it behind the session's pending reviews rather than beside them,
+            # they share the critic sub-session
+            critic_pipeline.submit(session_id, chunk_index)
+            feedback = critic_pipeline.feedback(session_id, chunk_index)
+        log(session_id,
+            f"critic_the_chunk_content call with chunk_index: {chunk_index}, reviewed in the background, reason: {reason}", LogLevel.DEBUG)
+        if feedback is None:
+            return "The critic review failed, go on next chunk"
+        yield feedback
+        return "go on next chunk"
+
     content = index_store.get(chunk_index)
     if content is None:
         log(session_id,
             f"critic_the_chunk_content call with chunk_index: {chunk_index}, error: Content not found", LogLevel.ERROR)
         return "Content not found"
-    content = str(content)
+    content = content.decode('utf-8')
     log(session_id,
         f"critic_the_chunk_content call with chunk_index: {chunk_index}, content: {content}, reason: {reason}", LogLevel.DEBUG)
-    yield from critic_agent.call(sub_session, content)
+    yield from review_text(session_id, content)
     return "go on next chunk"
 
 
@@ -63,6 +83,8 @@ def set_story_language(
     """
     log(session_id,
         f"set_story_language call with language: {language}, reason: {reason}", LogLevel.DEBUG)
+    session = session_manager.get_session(session_id)
+    session.set_ctx("story_language", language)
     return f"Story language set to: {language}"
 
 
@@ -143,24 +165,16 @@ def prompt_story_outline(
 
 
 def count_content(session_id: str) -> int:
-    session = session_manager.get_session(session_id)
-    title = session.get_ctx("title")
-    if not title:
-        return 0
-    filename = f"{output_dir}/{title}.txt"
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            count_content = f.read()
-        count = len(count_content)
-        return count
-    except Exception as e:
-        return 0
+    """Word count of the confirmed chunks, kept up to date by the index store"""
+    return IndexStore(session_id).stats()["words"]
 
 
 @tool_with_confirm
 def prompt_chunk_content(
     chunk_index: int,
     content: str,
+    plot_beats: Optional[str] = None,
+    character_states: Optional[str] = None,
     reason: Optional[str] = None,
     session_id: Optional[str] = "writer_tools"
 ) -> str:
@@ -172,10 +186,12 @@ def prompt_chunk_content(
     Parameters:
     - chunk_index: content fragment index number
     - content: content fragment
+    - plot_beats: one or two sentences on what happens in this fragment, kept as the chapter memory of later steps
+    - character_states: where the main characters stand at the end of this fragment (location, goal, mood, relations)
     - reason: reason for calling the tool, used to output the current step description
 
     Returns:
-    - str: content fragment
+    - str: confirmation and word counts, the content itself is kept in the chapter memory
     """
     log(session_id,
         f"prompt_chunk_content call with chunk_index: {chunk_index}, content: {content}, reason: {reason}", LogLevel.DEBUG)
@@ -197,10 +213,15 @@ def prompt_chunk_content(
         "session_id": session_id
     })
     index_store.add(chunk_index, content)
+    ChapterMemory(session_id).remember(
+        chunk_index, content, plot_beats, character_states)
+    if ENABLE_ASYNC_CRITIC:
+        critic_pipeline.submit(session_id, chunk_index)
+    stats = index_store.stats()
 
     log(session_id,
         f"prompt_chunk_content call with chunk_index: {chunk_index}, content: {content}, reason: {reason}, result: Successfully added the {chunk_index}th chunk content to the index store", LogLevel.DEBUG)
-    return f"Confirmed chunk_index: {chunk_index} \n\n Content fragment: {content} \n\n Total word count: {index_store.count()}, Current chunk word count: {len(content)} \n\n"
+    return f"Confirmed chunk_index: {chunk_index} \n\n Total word count: {stats['words']} in {stats['chunks']} chunks, Current chunk word count: {text_counts(content)[0]} \n\n"
 
 # @tool_with_confirm
 # def refine_chunk_content(
@@ -241,13 +262,8 @@ def finish_novel(
     Returns:
     - str: answer
     """
-    session = session_manager.get_session(session_id)
-    title = session.get_ctx("title")
-    filename = f"{output_dir}/{title}.txt"
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            content = f.read()
-        count = len(content)
+        count = count_content(session_id)
     except Exception as e:
         log(session_id,
             f"finish_writing call with reason: {reason}, error: {e}", LogLevel.ERROR)
@@ -260,3 +276,5 @@ def finish_novel(
 
 writer_tools = [set_story_language, prompt_title,
                 prompt_roles, prompt_story_outline, critic_the_chunk_content, prompt_chunk_content,  finish_novel]
+if ENABLE_PARALLEL_DRAFTING:
+    writer_tools.append(draft_chunks_in_parallel)
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+from enum import StrEnum
+from typing import Generator
+from langchain_core.messages import HumanMessage, SystemMessage
+from agents.agent import Agent
+from env import (SUB_AGENT_SESSION_STORE, SUB_AGENT_SESSION_POLICY, SUB_AGENT_WINDOW, SUB_AGENT_NOTE_CHARS,
+                 SUB_AGENT_SUMMARY_CHARS, SUB_AGENT_SESSION_CACHE, get_sub_agent_session_policies)
+from session import MemorySession, Session, session_manager
+from utils.llm import LLMRetry
+
+
+class SubSessionPolicy(StrEnum):
+    EPHEMERAL = "ephemeral"  # every call starts from the system prompt
+    WINDOW = "window"  # the last calls are kept
+    SUMMARY = "summary"  # every call starts afresh with short notes of the earlier outputs
+
+
+def sub_session_id(session_id: str, agent: Agent) -> str:
+    """Session of a sub-agent working for a session, e.g. "{session_id}_sub_agent_critic" """
+    return f"{session_id}_sub_agent_{agent.name.removesuffix('_agent')}"
+
+
+def trim_to_window(session: Session, exchanges: int):
+    """Keep the system prompt and the last `exchanges` calls of a session"""
+    messages = session.get_all_messages()
+    humans = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+    if len(humans) <= exchanges:
+        return
+    cut = humans[-exchanges] if exchanges > 0 else len(messages)
+    kept = [m for m in messages[:cut] if isinstance(m, SystemMessage)] + messages[cut:]
+    session.clear_all_messages()
+    for message in kept:
+        session.add_message(message)
+
+
+class SubAgentSessions:
+    """
+    Sessions of sub-agents under a policy per agent, so a sub-agent called once per chunk does not
+    re-send every earlier call. Sessions are kept in the process (least recently used first out)
+    unless SUB_AGENT_SESSION_STORE is "redis".
+    """
+
+    def __init__(self, store: str = SUB_AGENT_SESSION_STORE, default_policy: str = SUB_AGENT_SESSION_POLICY,
+                 policies: dict = None, window: int = SUB_AGENT_WINDOW, max_sessions: int = SUB_AGENT_SESSION_CACHE):
+        self.store = store
+        self.default_policy = SubSessionPolicy(default_policy)
+        self.policies = {name: SubSessionPolicy(policy) for name, policy in (
+            policies if policies is not None else get_sub_agent_session_policies()).items()}
+        self.window = window
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, MemorySession] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def policy(self, agent: Agent) -> SubSessionPolicy:
+        return self.policies.get(agent.name, self.default_policy)
+
+    def get_session(self, session_id: str, agent: Agent) -> Session:
+        """The sub-agent's session for a parent session"""
+        sub_id = sub_session_id(session_id, agent)
+        if self.store == "redis":
+            return session_manager.get_session(sub_id)
+        with self._lock:
+            session = self._sessions.pop(sub_id, None) or MemorySession(sub_id)
+            self._sessions[sub_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def drop(self, session_id: str):
+        """Forget the in-memory sub-agent sessions of a deleted session"""
+        with self._lock:
+            for sub_id in [s for s in self._sessions if s.startswith(f"{session_id}_sub_agent_")]:
+                del self._sessions[sub_id]
+
+    def call(self, agent: Agent, session_id: str, user_input: str, user_id: str = None) -> Generator:
+        """Run a sub-agent for a session under its policy, yields what agent.call yields"""
+        policy = self.policy(agent)
+        if policy == SubSessionPolicy.EPHEMERAL:
+            session = MemorySession(sub_session_id(session_id, agent))
+        else:
+            session = self.get_session(session_id, agent)
+        session.set_ctx("user_id", user_id or session_id)
+
+        if policy == SubSessionPolicy.WINDOW:
+            trim_to_window(session, self.window)
+        elif policy == SubSessionPolicy.SUMMARY:
+            session.clear_all_messages()
+            notes = session.get_ctx("summary")
+            system_prompt = agent.system_prompt
+            if notes:
+                system_prompt += f"\n# Notes from your earlier answers in this work:\n{notes}\n"
+            session.add_message(SystemMessage(content=system_prompt))
+
+        output = ""
+        for part in agent.call(session, user_input):
+            if isinstance(part, str):
+                output += part
+            elif isinstance(part, LLMRetry):
+                output = part.drop(output)
+            yield part
+
+        if policy == SubSessionPolicy.SUMMARY:
+            note = " ".join(output.split())[:SUB_AGENT_NOTE_CHARS]
+            notes = f"{session.get_ctx('summary') or ''}\n- {note}".strip()
+            # Oldest notes go first
+            session.set_ctx("summary", notes[-SUB_AGENT_SUMMARY_CHARS:])
+
+
+# Global sub-agent sessions instance
+sub_agent_sessions = SubAgentSessions()
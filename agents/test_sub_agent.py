@@ -0,0 +1,84 @@
+import uuid
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from agents.agent import Agent
+from agents.sub_agent import SubAgentSessions, sub_session_id
+from utils.llm import LLMRetry
+
+
+class RecordingLLM(BaseChatModel):
+    """Fake chat model recording the messages of every call"""
+    calls: list = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-recording"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls.append(messages)
+        content = f"answer {len(self.calls)}"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+
+class RetryingAgent(Agent):
+    """Agent whose first attempt is aborted and retried"""
+
+    def call(self, session, user_input, tool_calls_to_confirm_feedback=None):
+        yield "loop loop"
+        yield LLMRetry("loop loop")
+        yield "fresh answer"
+
+
+def test_sub_agent_sessions():
+    """Test ephemeral, sliding window and summary sub-agent sessions"""
+    print("=== Testing sub-agent sessions ===")
+
+    import agents.agent
+    llm = agents.agent.job_intent_llm
+    fake = agents.agent.job_intent_llm = RecordingLLM(calls=[])
+    agent = Agent("reviewer_agent", "You review.", "{user_input}")
+    session_id = f"test_sub_agent_{uuid.uuid4()}"
+    try:
+        def run(sessions: SubAgentSessions, text: str) -> str:
+            return "".join(p for p in sessions.call(agent, session_id, text) if isinstance(p, str))
+
+        ephemeral = SubAgentSessions(store="memory", default_policy="ephemeral")
+        for i in range(3):
+            run(ephemeral, f"chunk {i}")
+        assert [len(call) for call in fake.calls] == [2, 2, 2], "Ephemeral calls should not see earlier calls"
+
+        fake.calls.clear()
+        window = SubAgentSessions(store="memory", default_policy="summary",
+                                  policies={"reviewer_agent": "window"}, window=1)
+        for i in range(3):
+            run(window, f"chunk {i}")
+        assert [len(call) for call in fake.calls] == [2, 4, 4], "The window should keep the last call"
+        assert fake.calls[-1][1].content == "chunk 1", "The oldest calls should leave the window"
+
+        fake.calls.clear()
+        summary = SubAgentSessions(store="memory", default_policy="summary")
+        for i in range(3):
+            run(summary, f"chunk {i}")
+        assert [len(call) for call in fake.calls] == [2, 2, 2], "Summary calls should start afresh"
+        assert "- answer 1\n- answer 2" in fake.calls[-1][0].content, "Earlier answers should be carried as notes"
+
+        retrying = RetryingAgent("retrying_agent", "You retry.", "{user_input}")
+        parts = list(summary.call(retrying, session_id, "chunk"))
+        assert any(isinstance(p, LLMRetry) for p in parts), "Retries should be forwarded to the caller"
+        notes = summary.get_session(session_id, retrying).get_ctx("summary")
+        assert notes == "- fresh answer", f"The aborted attempt should be dropped from the notes: {notes}"
+
+        lru = SubAgentSessions(store="memory", default_policy="window", max_sessions=1)
+        lru.get_session(session_id, agent)
+        lru.get_session("other", agent)
+        assert list(lru._sessions) == [sub_session_id("other", agent)], "Least recently used sessions go first"
+        lru.drop("other")
+        assert not lru._sessions, "Dropped sessions should be forgotten"
+        print("Sub-agent session tests passed\n")
+    finally:
+        agents.agent.job_intent_llm = llm
+
+
+if __name__ == "__main__":
+    test_sub_agent_sessions()
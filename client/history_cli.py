@@ -12,15 +12,17 @@ import sys
 import os
 import json
 from datetime import datetime
-from typing import List, Optional
+from typing import Iterator, List, Optional
 from tabulate import tabulate
 
 # Add project path to sys.path
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 try:
-    from history import HistoryManager
-    from env import get_redis_env
+    from utils.history import HistoryManager
+    from utils.redis_scan import scan_keys, scan_stats
+    from services.session_deletion_service import session_deletion_service
+    from env import get_redis_env, SCAN_COUNT
 except ImportError as e:
     print(f"Failed to import module: {e}")
     print("Please ensure the script is run in the dataui-agent project directory")
@@ -38,23 +40,20 @@ class HistoryTool:
             print(f"❌ Failed to connect to Redis: {e}")
             sys.exit(1)
 
+    def iter_users(self, count: int = SCAN_COUNT, parallel: bool = False) -> Iterator[dict]:
+        """Stream users with sessions and their session count, without blocking Redis"""
+        prefix = self.history_manager.user_sessions_prefix
+        for stats in scan_stats(self.history_manager.router.replica(), f"{prefix}*", count, parallel=parallel):
+            user_id = stats["key"][len(prefix):]
+            if user_id:
+                yield {"user_id": user_id, "sessions": stats["length"]}
+
     def list_users(self) -> List[str]:
         """Get all users with sessions"""
         try:
-            # Scan all user session keys
-            pattern = f"{self.history_manager.user_sessions_prefix}*"
-            keys = self.history_manager.redis.keys(pattern)
-
-            users = []
-            for key in keys:
-                key_str = key.decode(
-                    'utf-8') if isinstance(key, bytes) else key
-                user_id = key_str.replace(
-                    self.history_manager.user_sessions_prefix, '')
-                if user_id:
-                    users.append(user_id)
-
-            return sorted(users)
+            prefix = self.history_manager.user_sessions_prefix
+            return [key[len(prefix):] for key in scan_keys(self.history_manager.router.replica(), f"{prefix}*")
+                    if key[len(prefix):]]
         except Exception as e:
             print(f"❌ Failed to get user list: {e}")
             return []
@@ -130,13 +129,11 @@ class HistoryTool:
                 for i, interaction in enumerate(history, 1):
                     timestamp = interaction.get('timestamp', 'N/A')
                     user_input = interaction.get('user_input', '')
-                    agent_responses = interaction.get('agent_responses', [])
+                    response_text = interaction.get('text', '')
 
                     print(f"\n[{i}] {timestamp}")
                     print(f"👤 User: {user_input}")
-                    if agent_responses:
-                        response_text = ' '.join(agent_responses) if isinstance(
-                            agent_responses, list) else str(agent_responses)
+                    if response_text:
                         # Truncate long responses
                         if len(response_text) > 200:
                             response_text = response_text[:200] + "..."
@@ -235,55 +232,51 @@ class HistoryTool:
                     print("❌ Cancel deletion")
                     return
 
-            # Delete all sessions
-            for session in sessions:
-                session_id = session['session_id']
-                self.history_manager.clear_session_history(session_id)
-
-            # Clear user session list
-            self.history_manager.clear_user_sessions(user_id)
+            # Delete all sessions with everything they own
+            result = session_deletion_service.delete_user_sessions(user_id)
 
-            print(f"✅ Successfully deleted all sessions for user {user_id}")
+            print(
+                f"✅ Successfully deleted all sessions for user {user_id} ({result['keys']} keys)")
 
         except Exception as e:
             print(f"❌ Failed to delete user sessions: {e}")
 
-    def search_sessions(self, keyword: str, user_id: Optional[str] = None) -> None:
+    def migrate_user_sessions(self) -> None:
+        """Convert legacy user session lists into activity-scored sorted sets"""
+        try:
+            migrated = self.history_manager.migrate_user_sessions()
+            print(f"✅ Migrated {migrated} user session lists")
+        except Exception as e:
+            print(f"❌ Failed to migrate user sessions: {e}")
+
+    def rebuild_search_index(self) -> None:
+        """Rebuild the full-text search index from stored history"""
+        try:
+            indexed = self.history_manager.rebuild_search_index()
+            print(f"✅ Indexed {indexed} sessions")
+        except Exception as e:
+            print(f"❌ Failed to rebuild search index: {e}")
+
+    def migrate_history(self) -> None:
+        """Convert stored interactions into the compact history format"""
+        try:
+            converted = self.history_manager.migrate_history()
+            print(f"✅ Converted {converted} history records")
+        except Exception as e:
+            print(f"❌ Failed to migrate history: {e}")
+
+    def search_sessions(self, keyword: str, user_id: Optional[str] = None, page: int = 1, page_size: int = 20) -> None:
         """Search for sessions containing a keyword"""
         try:
-            users_to_search = [user_id] if user_id else self.list_users()
-            found_sessions = []
-
-            for uid in users_to_search:
-                sessions = self.history_manager.get_user_sessions_with_meta(
-                    uid)
-                for session in sessions:
-                    # Search in title
-                    if keyword.lower() in session['title'].lower():
-                        found_sessions.append(session)
-                        continue
-
-                    # Search in history
-                    history = self.history_manager.get_session_history(
-                        session['session_id'], limit=10)
-                    for interaction in history:
-                        user_input = interaction.get('user_input', '')
-                        agent_responses = interaction.get(
-                            'agent_responses', [])
-                        response_text = ' '.join(agent_responses) if isinstance(
-                            agent_responses, list) else str(agent_responses)
-
-                        if (keyword.lower() in user_input.lower() or
-                                keyword.lower() in response_text.lower()):
-                            found_sessions.append(session)
-                            break
+            found_sessions, total = self.history_manager.search_sessions(
+                keyword, user_id, offset=(page - 1) * page_size, limit=page_size)
 
             if not found_sessions:
                 print(f"❌ No sessions found containing keyword '{keyword}'")
                 return
 
             print(
-                f"\n🔍 Search results: found {len(found_sessions)} sessions containing keyword '{keyword}'")
+                f"\n🔍 Search results: found {total} sessions containing keyword '{keyword}', page {page}")
             print("=" * 80)
 
             # Show search results
@@ -298,10 +291,11 @@ class HistoryTool:
                                  ) > 30 else session['title'],
                     session.get('user_id', 'N/A'),
                     session.get(
-                        'updated_at', 'N/A')[:19] if session.get('updated_at') else 'N/A'
+                        'updated_at', 'N/A')[:19] if session.get('updated_at') else 'N/A',
+                    f"{session['score']:g}"
                 ])
 
-            headers = ['Session ID', 'Title', 'User ID', 'Updated']
+            headers = ['Session ID', 'Title', 'User ID', 'Updated', 'Score']
             print(tabulate(table_data, headers=headers, tablefmt='grid'))
 
         except Exception as e:
@@ -314,7 +308,12 @@ def main():
         dest='command', help='Available commands')
 
     # List all users
-    subparsers.add_parser('users', help='List all users with sessions')
+    users_parser = subparsers.add_parser(
+        'users', help='List all users with sessions')
+    users_parser.add_argument('--count', type=int, default=SCAN_COUNT,
+                              help='Keys requested per SCAN call')
+    users_parser.add_argument('--parallel', action='store_true',
+                              help='Scan cluster nodes concurrently')
 
     # List user sessions
     user_parser = subparsers.add_parser('sessions', help='List user sessions')
@@ -352,6 +351,22 @@ def main():
         'search', help='Search sessions containing a keyword')
     search_parser.add_argument('keyword', help='Search keyword')
     search_parser.add_argument('--user', help='Limit search to specified user')
+    search_parser.add_argument(
+        '--page', type=int, default=1, help='Result page')
+    search_parser.add_argument(
+        '--page-size', type=int, default=20, help='Results per page')
+
+    # Rebuild the search index
+    subparsers.add_parser('rebuild-search-index',
+                          help='Rebuild the full-text search index from stored history')
+
+    # Migrate legacy user session lists
+    subparsers.add_parser('migrate-user-sessions',
+                          help='Convert legacy user session lists into sorted sets')
+
+    # Migrate raw SSE frame history records
+    subparsers.add_parser('migrate-history',
+                          help='Convert stored interactions into the compact format')
 
     args = parser.parse_args()
 
@@ -365,11 +380,14 @@ def main():
     # Execute command
     try:
         if args.command == 'users':
-            users = tool.list_users()
-            if users:
-                print(f"\n👥 Found {len(users)} users:")
-                for i, user in enumerate(users, 1):
-                    print(f"  {i}. {user}")
+            # Print users as the scan finds them
+            found = 0
+            for found, user in enumerate(tool.iter_users(args.count, args.parallel), 1):
+                if found == 1:
+                    print("\n👥 Users:")
+                print(f"  {found}. {user['user_id']} ({user['sessions']} sessions)")
+            if found:
+                print(f"\n👥 Found {found} users")
             else:
                 print("❌ No users found")
 
@@ -389,7 +407,17 @@ def main():
             tool.delete_user_sessions(args.user_id, args.yes)
 
         elif args.command == 'search':
-            tool.search_sessions(args.keyword, args.user)
+            tool.search_sessions(args.keyword, args.user,
+                                 args.page, args.page_size)
+
+        elif args.command == 'rebuild-search-index':
+            tool.rebuild_search_index()
+
+        elif args.command == 'migrate-user-sessions':
+            tool.migrate_user_sessions()
+
+        elif args.command == 'migrate-history':
+            tool.migrate_history()
 
     except KeyboardInterrupt:
         print("\n\n❌ Operation interrupted by user")
@@ -12,7 +12,7 @@ import sys
 import os
 import json
 from datetime import datetime
-from typing import List, Optional
+from typing import Iterator, List, Optional
 from tabulate import tabulate
 
 # Add project path to sys.path
@@ -20,8 +20,11 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 try:
     from session import SessionManager, RedisSession, MemorySession
-    from env import get_redis_env
+    from env import get_redis_env, SCAN_COUNT
     from redis import Redis
+    from utils.redis_scan import scan_stats
+    from utils.read_router import replica_clients
+    from services.orphan_gc_service import OrphanCollector
     from langchain_core.messages import BaseMessage, AIMessage, HumanMessage, SystemMessage, ToolMessage
 except ImportError as e:
     print(f"导入模块失败: {e}")
@@ -38,26 +41,30 @@ class SessionTool:
             self.redis_client = Redis(**get_redis_env())
             # Test connection
             self.redis_client.ping()
+            # Listings and inspections read a replica when one is configured
+            replicas = replica_clients(Redis)
+            self.read_client = replicas[0] if replicas else self.redis_client
             print("✅ Successfully connected to Redis")
         except Exception as e:
             print(f"❌ Failed to connect to Redis: {e}")
             sys.exit(1)
 
+    # List keys with a prefix belong to other stores, session message lists have none
+    NON_SESSION_PREFIXES = ('user_sessions:', 'session_history:',
+                            'idempotency_events:')
+
+    def iter_sessions(self, pattern: str = "*", count: int = SCAN_COUNT, parallel: bool = False,
+                      memory: bool = False) -> Iterator[dict]:
+        """Stream sessions with their message count (and memory usage), without blocking Redis"""
+        for stats in scan_stats(self.read_client, pattern, count, type_="list",
+                                parallel=parallel, memory=memory):
+            if not stats["key"].startswith(self.NON_SESSION_PREFIXES):
+                yield stats
+
     def list_sessions(self, pattern: str = "*") -> List[str]:
         """Get all session ID list"""
         try:
-            # Scan all session keys
-            keys = self.redis_client.keys(pattern)
-
-            sessions = []
-            for key in keys:
-                key_str = key.decode(
-                    'utf-8') if isinstance(key, bytes) else key
-                # Filter out non-session keys (e.g. user session list)
-                if not key_str.startswith('user_sessions:') and not key_str.startswith('session_meta:'):
-                    sessions.append(key_str)
-
-            return sorted(sessions)
+            return sorted(stats["key"] for stats in self.iter_sessions(pattern))
         except Exception as e:
             print(f"❌ Failed to get session list: {e}")
             return []
@@ -66,7 +73,7 @@ class SessionTool:
         """Show session details"""
         try:
             # 创建RedisSession实例
-            session = RedisSession(session_id, self.redis_client)
+            session = RedisSession(session_id, self.read_client)
 
             # 获取消息数量
             message_count = session.get_message_count()
@@ -228,7 +235,7 @@ class SessionTool:
     def show_session_stats(self, session_id: str) -> None:
         """Show session statistics"""
         try:
-            session = RedisSession(session_id, self.redis_client)
+            session = RedisSession(session_id, self.read_client)
             message_count = session.get_message_count()
 
             if message_count == 0:
@@ -285,7 +292,7 @@ class SessionTool:
 
             for session_id in sessions:
                 try:
-                    session = RedisSession(session_id, self.redis_client)
+                    session = RedisSession(session_id, self.read_client)
                     messages = session.get_all_messages()
 
                     # 在消息内容中搜索关键词
@@ -325,6 +332,28 @@ class SessionTool:
             print(f"❌ Failed to search: {e}")
 
 
+    def collect_orphans(self, reclaim: bool = False, max_keys: Optional[int] = None,
+                        parallel: bool = False) -> None:
+        """Find keys of deleted sessions and report, or reclaim, their memory"""
+        try:
+            report = OrphanCollector(self.redis_client).run(
+                reclaim, max_keys, parallel)
+            if report.get("status") == "skipped":
+                print(f"⚠️  Skipped: {report['reason']}")
+                return
+            print(f"\n🧹 Orphan keys ({'reclaimed' if reclaim else 'dry run'}):")
+            print(tabulate([
+                ['Scanned keys', report['scanned']],
+                ['Orphan keys', report['orphans']],
+                ['Reclaimable bytes', report['reclaimable_bytes']],
+                ['Reclaimed keys', report['reclaimed']],
+                ['Duration (s)', report['duration_seconds']]
+            ] + [[f"  {kind}", count] for kind, count in report['by_kind'].items()],
+                headers=['Item', 'Value'], tablefmt='simple'))
+        except Exception as e:
+            print(f"❌ Failed to collect orphans: {e}")
+
+
 def main():
     parser = argparse.ArgumentParser(description='Session management tool')
     subparsers = parser.add_subparsers(
@@ -334,6 +363,12 @@ def main():
     list_parser = subparsers.add_parser('list', help='List all sessions')
     list_parser.add_argument('--pattern', default='*',
                              help='Session ID matching pattern')
+    list_parser.add_argument('--count', type=int, default=SCAN_COUNT,
+                             help='Keys requested per SCAN call')
+    list_parser.add_argument('--parallel', action='store_true',
+                             help='Scan cluster nodes concurrently')
+    list_parser.add_argument('--memory', action='store_true',
+                             help='Show memory usage of each session')
 
     # Show session details
     detail_parser = subparsers.add_parser(
@@ -371,6 +406,16 @@ def main():
         'search', help='Search for sessions containing the keyword')
     search_parser.add_argument('keyword', help='Search keyword')
 
+    # Find and reclaim keys of deleted sessions
+    gc_parser = subparsers.add_parser(
+        'gc', help='Report keys of deleted sessions and their memory')
+    gc_parser.add_argument('--reclaim', action='store_true',
+                           help='Unlink the orphan keys, rate limited')
+    gc_parser.add_argument('--max-keys', type=int,
+                           help='Stop after scanning this many keys')
+    gc_parser.add_argument('--parallel', action='store_true',
+                           help='Scan cluster nodes concurrently')
+
     args = parser.parse_args()
 
     if not args.command:
@@ -383,11 +428,17 @@ def main():
     # Execute command
     try:
         if args.command == 'list':
-            sessions = tool.list_sessions(args.pattern)
-            if sessions:
-                print(f"\n📋 Found {len(sessions)} sessions:")
-                for i, session_id in enumerate(sessions, 1):
-                    print(f"  {i}. {session_id}")
+            # Print sessions as the scan finds them
+            found = 0
+            for found, stats in enumerate(tool.iter_sessions(args.pattern, args.count, args.parallel, args.memory), 1):
+                if found == 1:
+                    print("\n📋 Sessions:")
+                line = f"  {found}. {stats['key']} ({stats['length']} messages"
+                if args.memory:
+                    line += f", {stats['memory']} bytes"
+                print(line + ")")
+            if found:
+                print(f"\n📋 Found {found} sessions")
             else:
                 print("❌ No sessions found")
 
@@ -409,6 +460,9 @@ def main():
         elif args.command == 'search':
             tool.search_sessions(args.keyword)
 
+        elif args.command == 'gc':
+            tool.collect_orphans(args.reclaim, args.max_keys, args.parallel)
+
     except KeyboardInterrupt:
         print("\n\n❌ Operation interrupted by user")
     except Exception as e:
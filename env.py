@@ -1,3 +1,4 @@
+import json
 import os
 from re import I
 
@@ -20,6 +21,176 @@ MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 1000))
 # Maximum requests per single worker
 MAX_REQUESTS = int(os.environ.get("MAX_REQUESTS", 1000))
 
+# Per-session execution lock
+# "queue": wait for the running request on the same session, "reject": fail fast with 409
+SESSION_LOCK_POLICY = os.environ.get("SESSION_LOCK_POLICY", "queue").lower()
+# Lease ttl in seconds, renewed by heartbeat while the stream is running
+SESSION_LOCK_TTL = float(os.environ.get("SESSION_LOCK_TTL", 30))
+# Maximum seconds a queued request waits for the lease
+SESSION_LOCK_WAIT = float(os.environ.get("SESSION_LOCK_WAIT", 60))
+# Maximum queued requests per session, more are rejected with 429
+SESSION_LOCK_MAX_WAITERS = int(
+    os.environ.get("SESSION_LOCK_MAX_WAITERS", 2))
+
+# LLM admission control, shared by all workers through Redis token buckets
+# Global provider calls per second, 0 disables the global rate limit
+LLM_RATE_LIMIT = float(os.environ.get("LLM_RATE_LIMIT", 10))
+LLM_BURST = float(os.environ.get("LLM_BURST", 20))
+# Per-user provider calls per second, keeps one user from starving others, 0 is unlimited
+LLM_USER_RATE_LIMIT = float(os.environ.get("LLM_USER_RATE_LIMIT", 2))
+LLM_USER_BURST = float(os.environ.get("LLM_USER_BURST", 5))
+# Maximum provider calls in flight across workers, a stream holds its slot until it ends, 0 is unlimited
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))
+# Seconds a slot is held without renewal, frees the slots of crashed workers
+LLM_SLOT_TTL = float(os.environ.get("LLM_SLOT_TTL", 120))
+# Maximum calls waiting for admission per worker, more are shed
+LLM_QUEUE_MAX = int(os.environ.get("LLM_QUEUE_MAX", 100))
+# Maximum seconds a call waits for admission
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 30))
+
+# Headless batch generation
+# Default and maximum worker processes per batch job
+BATCH_DEFAULT_CONCURRENCY = int(os.environ.get("BATCH_DEFAULT_CONCURRENCY", 2))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", 8))
+# Maximum confirmation rounds for one novel before giving up
+BATCH_MAX_ROUNDS = int(os.environ.get("BATCH_MAX_ROUNDS", 200))
+# Seconds to keep finished job state in Redis
+BATCH_JOB_TTL = int(os.environ.get("BATCH_JOB_TTL", 7 * 24 * 3600))
+# Batch jobs running at once across workers, 0 is unlimited, submissions beyond it are rejected
+BATCH_MAX_JOBS = int(os.environ.get("BATCH_MAX_JOBS", 4))
+# Seconds a running job's lease lasts without a heartbeat, jobs of a worker that died are then reported failed
+BATCH_JOB_LEASE_TTL = float(os.environ.get("BATCH_JOB_LEASE_TTL", 30))
+
+# Seconds a health probe result is reused
+HEALTH_CACHE_TTL = float(os.environ.get("HEALTH_CACHE_TTL", 5))
+
+# Seconds a /stream idempotency key and its recorded events are kept
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 600))
+# Seconds a running /stream request holds its idempotency key without renewing it
+IDEMPOTENCY_LEASE_TTL = float(os.environ.get("IDEMPOTENCY_LEASE_TTL", 30))
+
+# Seconds session metadata is cached per process, 0 disables the cache
+SESSION_META_CACHE_TTL = float(os.environ.get("SESSION_META_CACHE_TTL", 5))
+SESSION_META_CACHE_SIZE = int(os.environ.get("SESSION_META_CACHE_SIZE", 10000))
+
+# History records larger than this many bytes are stored zlib compressed, 0 disables compression
+HISTORY_COMPRESS_THRESHOLD = int(
+    os.environ.get("HISTORY_COMPRESS_THRESHOLD", 2048))
+
+# Seconds a search result set is kept for paging
+SEARCH_RESULT_TTL = int(os.environ.get("SEARCH_RESULT_TTL", 30))
+
+# Keys requested per SCAN call by keyspace walks
+SCAN_COUNT = int(os.environ.get("SCAN_COUNT", 1000))
+
+# Keys per UNLINK command when deleting sessions in bulk
+SESSION_DELETE_BATCH = int(os.environ.get("SESSION_DELETE_BATCH", 500))
+
+# Key registrations remembered per process so each key is registered once, and seconds a registration
+# is trusted before the key is registered again, in case another worker deleted the session meanwhile
+KEY_REGISTRY_CACHE_SIZE = int(
+    os.environ.get("KEY_REGISTRY_CACHE_SIZE", 100000))
+KEY_REGISTRY_CACHE_TTL = float(os.environ.get("KEY_REGISTRY_CACHE_TTL", 60))
+
+# Speculative session titles: seconds until the fallback title is kept, characters of the
+# first response used, seconds to wait for them, and background title workers per process
+TITLE_DEADLINE = float(os.environ.get("TITLE_DEADLINE", 10))
+TITLE_RESPONSE_CHARS = int(os.environ.get("TITLE_RESPONSE_CHARS", 200))
+TITLE_RESPONSE_WAIT = float(os.environ.get("TITLE_RESPONSE_WAIT", 3))
+TITLE_WORKERS = int(os.environ.get("TITLE_WORKERS", 4))
+
+# Orphan key collector: seconds between background runs (0 disables), keys reclaimed
+# per second, and seconds a key must be idle before it can be collected
+ORPHAN_GC_INTERVAL = int(os.environ.get("ORPHAN_GC_INTERVAL", 0))
+ORPHAN_GC_RATE = int(os.environ.get("ORPHAN_GC_RATE", 200))
+ORPHAN_GC_MIN_IDLE = int(os.environ.get("ORPHAN_GC_MIN_IDLE", 3600))
+
+# Read replicas as comma separated host:port pairs, read-only calls are spread over them.
+# Empty sends every read to the primary. Replicas share REDIS_DB and REDIS_PASSWORD.
+REDIS_REPLICAS = os.environ.get("REDIS_REPLICAS", "")
+# Read-your-writes after a write from this process: "version" checks the replica has caught up
+# with the version written (or reads the primary for READ_YOUR_WRITES_WINDOW seconds when the data
+# has no version), "wait" blocks writes until replicas reach the primary's replication offset,
+# "off" allows stale reads
+READ_YOUR_WRITES = os.environ.get("READ_YOUR_WRITES", "version").lower()
+READ_YOUR_WRITES_WINDOW = float(os.environ.get("READ_YOUR_WRITES_WINDOW", 5))
+# Milliseconds a write waits for replicas to catch up in "wait" mode
+READ_YOUR_WRITES_WAIT_MS = int(os.environ.get("READ_YOUR_WRITES_WAIT_MS", 100))
+
+# Chunks fetched per round trip when a manuscript is streamed
+MANUSCRIPT_WINDOW = int(os.environ.get("MANUSCRIPT_WINDOW", 50))
+
+# Directory of the assembled manuscript file cache, empty disables it and downloads stream from Redis
+MANUSCRIPT_CACHE_DIR = os.environ.get(
+    "MANUSCRIPT_CACHE_DIR", "/tmp/diy_agent_manuscripts")
+
+# Bytes of compressed chunk revisions kept per session, the oldest revisions are dropped beyond it
+CHUNK_REVISION_BUDGET = int(os.environ.get("CHUNK_REVISION_BUDGET", 1 << 20))
+
+# Characters of the last chunk shown to the main agent after the chunk summaries
+CHAPTER_MEMORY_TAIL = int(os.environ.get("CHAPTER_MEMORY_TAIL", 600))
+# Characters kept per summary field (plot beats, character states) of a chunk
+CHAPTER_MEMORY_FIELD_CHARS = int(os.environ.get("CHAPTER_MEMORY_FIELD_CHARS", 300))
+
+# Parallel drafting: offer the main agent a tool drafting the planned chunks concurrently with sub-agents,
+# drafts per session at once, and characters of each chunk's opening rewritten by the stitching pass
+ENABLE_PARALLEL_DRAFTING = os.environ.get(
+    "ENABLE_PARALLEL_DRAFTING", "False").lower() == "true"
+PARALLEL_DRAFTING_WORKERS = int(os.environ.get("PARALLEL_DRAFTING_WORKERS", 4))
+STITCH_HEAD_CHARS = int(os.environ.get("STITCH_HEAD_CHARS", 400))
+
+# Critic reviews run in the background as soon as a chunk is stored, overlapping the next chunk's generation.
+# Background reviews at once per process, seconds the critic tool waits for a pending review,
+# and latest chunks whose feedback is shown to the main agent
+ENABLE_ASYNC_CRITIC = os.environ.get(
+    "ENABLE_ASYNC_CRITIC", "False").lower() == "true"
+CRITIC_WORKERS = int(os.environ.get("CRITIC_WORKERS", 4))
+CRITIC_WAIT = float(os.environ.get("CRITIC_WAIT", 120))
+CRITIC_FEEDBACK_CHUNKS = int(os.environ.get("CRITIC_FEEDBACK_CHUNKS", 2))
+
+# Sub-agent sessions: "memory" keeps them in the process, "redis" shares them like user sessions.
+# Policies: "ephemeral" starts every call afresh, "window" keeps the last SUB_AGENT_WINDOW calls,
+# "summary" starts afresh with notes of earlier outputs (SUB_AGENT_NOTE_CHARS each, SUB_AGENT_SUMMARY_CHARS in total).
+# SUB_AGENT_SESSION_POLICIES overrides the policy per agent, e.g. "critic_agent=window,other_agent=ephemeral".
+SUB_AGENT_SESSION_STORE = os.environ.get("SUB_AGENT_SESSION_STORE", "memory")
+SUB_AGENT_SESSION_POLICY = os.environ.get(
+    "SUB_AGENT_SESSION_POLICY", "summary")
+SUB_AGENT_SESSION_POLICIES = os.environ.get("SUB_AGENT_SESSION_POLICIES", "")
+SUB_AGENT_WINDOW = int(os.environ.get("SUB_AGENT_WINDOW", 2))
+SUB_AGENT_NOTE_CHARS = int(os.environ.get("SUB_AGENT_NOTE_CHARS", 300))
+SUB_AGENT_SUMMARY_CHARS = int(os.environ.get("SUB_AGENT_SUMMARY_CHARS", 1500))
+# In-memory sub-agent sessions kept per process, least recently used first out
+SUB_AGENT_SESSION_CACHE = int(os.environ.get("SUB_AGENT_SESSION_CACHE", 1000))
+
+# Pre-critic gate: local checks of a chunk decide whether the critic LLM reviews it, is skipped for chunks
+# that pass every check, or the chunk is sent back for regeneration without a review
+ENABLE_CRITIC_GATE = os.environ.get(
+    "ENABLE_CRITIC_GATE", "False").lower() == "true"
+# Fewer words than this is regenerated
+CRITIC_GATE_MIN_WORDS = int(os.environ.get("CRITIC_GATE_MIN_WORDS", 150))
+# Share of repeated character n-grams (CRITIC_GATE_NGRAM characters) reviewed above the first, regenerated above the second
+CRITIC_GATE_NGRAM = int(os.environ.get("CRITIC_GATE_NGRAM", 8))
+CRITIC_GATE_REVIEW_REPETITION = float(
+    os.environ.get("CRITIC_GATE_REVIEW_REPETITION", 0.1))
+CRITIC_GATE_REGENERATE_REPETITION = float(
+    os.environ.get("CRITIC_GATE_REGENERATE_REPETITION", 0.35))
+# Share of the text in quoted dialogue outside this range is reviewed
+CRITIC_GATE_MIN_DIALOGUE = float(os.environ.get("CRITIC_GATE_MIN_DIALOGUE", 0.02))
+CRITIC_GATE_MAX_DIALOGUE = float(os.environ.get("CRITIC_GATE_MAX_DIALOGUE", 0.7))
+# Below this share of letters in the story language's script the chunk is regenerated
+CRITIC_GATE_MIN_SCRIPT = float(os.environ.get("CRITIC_GATE_MIN_SCRIPT", 0.6))
+
+# Repetition guard on streamed LLM output: a stream is aborted when REPETITION_THRESHOLD of the last
+# REPETITION_WINDOW character n-grams (REPETITION_NGRAM characters) already appeared earlier in the same
+# content or tool argument, and the call is retried with REPETITION_RETRY_PARAMS added to the request
+ENABLE_REPETITION_GUARD = os.environ.get(
+    "ENABLE_REPETITION_GUARD", "True").lower() == "true"
+REPETITION_NGRAM = int(os.environ.get("REPETITION_NGRAM", 32))
+REPETITION_WINDOW = int(os.environ.get("REPETITION_WINDOW", 512))
+REPETITION_THRESHOLD = float(os.environ.get("REPETITION_THRESHOLD", 0.8))
+REPETITION_RETRY_PARAMS = json.loads(os.environ.get(
+    "REPETITION_RETRY_PARAMS", '{"frequency_penalty": 0.6, "presence_penalty": 0.4}'))
+
 
 ENABLE_DASHSCOPE = os.environ.get("DASHSCOPE", "False").lower() == "true"
 print(
@@ -36,3 +207,33 @@ def get_redis_env():
         "db": REDIS_DB,
         "password": REDIS_PASSWORD,
     }
+
+
+def get_redis_replica_envs():
+    """
+    Get the connection configuration of each read replica
+    """
+    replicas = []
+    for endpoint in REDIS_REPLICAS.split(","):
+        if not endpoint.strip():
+            continue
+        host, _, port = endpoint.strip().rpartition(":")
+        replicas.append({
+            "host": host or REDIS_HOST,
+            "port": int(port),
+            "db": REDIS_DB,
+            "password": REDIS_PASSWORD,
+        })
+    return replicas
+
+
+def get_sub_agent_session_policies():
+    """
+    Get the session policy configured for each sub-agent
+    """
+    policies = {}
+    for item in SUB_AGENT_SESSION_POLICIES.split(","):
+        if "=" in item:
+            name, policy = item.split("=", 1)
+            policies[name.strip()] = policy.strip()
+    return policies
@@ -1,6 +1,7 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Any, Generator, Optional
 import openai
@@ -11,12 +12,22 @@ from utils.otel import tracer
 import json
 from opentelemetry.trace import Status, StatusCode
 import uuid
+import base64
+import hashlib
 import traceback
 from session import session_manager
 from tools import ToolCallToConfirm
-from env import DEFAULT_PORT, WORKERS, MAX_CONCURRENCY, MAX_REQUESTS
-from utils.llm import LLMToolCallError
-from utils.history import history_manager
+from env import DEFAULT_PORT, WORKERS, MAX_CONCURRENCY, MAX_REQUESTS, SESSION_LOCK_POLICY, SESSION_LOCK_WAIT
+from utils.llm import LLMToolCallError, LLMRetry
+from utils.llm_scheduler import llm_scheduler, LLMAdmissionError
+from utils.history import history_manager, TitleDraft
+from services.batch_service import batch_job_manager, BatchCapacityError
+from services.health_service import check_health
+from services.session_deletion_service import session_deletion_service
+from services.orphan_gc_service import orphan_collector
+from utils.metrics import render_metrics, ACTIVE_STREAMS, SSE_FRAMES, SSE_BYTES
+from utils.session_lock import session_lock_manager, SessionLockError, SessionLockLostError
+from utils.idempotency import idempotency_store
 
 # Create FastAPI application
 app = FastAPI()
@@ -41,6 +52,26 @@ class StreamRequest(BaseModel):
     sessionId: Optional[str] = None
     env: Optional[dict] = None
     tool_calls: Optional[list[ToolCallToConfirm]] = None
+    # Retries with the same key replay the original run instead of starting a new one
+    idempotencyKey: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    """
+    Batch generation request structure
+    """
+    prompts: list[str]
+    concurrency: Optional[int] = None
+    env: Optional[dict] = None
+
+
+def retry_frame(retry: LLMRetry) -> str:
+    """
+    Tell the client an aborted LLM attempt is regenerated: the last `discard` characters of the text
+    it streamed are dropped, clients that do not know the frame show its content as before
+    """
+    payload = {"type": "retry", "content": f"\n\n[{retry.message}]\n\n", "discard": len(retry.discarded)}
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
 
 def get_headers(request: Request):
@@ -51,8 +82,11 @@ def get_headers(request: Request):
     authorization = headers.get(
         "Authorization") or headers.get("authorization")
 
+    user_id = headers.get("UserId") or headers.get("userid")
+
     return {
-        "authorization": authorization
+        "authorization": authorization,
+        "user_id": user_id
     }
 
 
@@ -71,24 +105,116 @@ def get_session_id(request: Request, req_session_id: Optional[str] = None):
     return str(uuid.uuid4())
 
 
+def parse_fields(fields: Optional[str]) -> Optional[list[str]]:
+    """Parse a comma separated field projection, None returns every field"""
+    return [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+
+
+def make_etag(version: str, *params) -> str:
+    """Weak ETag of a resource version and the query that shaped the page"""
+    digest = hashlib.sha1(json.dumps(params).encode("utf-8")).hexdigest()[:12]
+    return f'W/"{version}-{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+def encode_page_token(cursor: Optional[dict]) -> Optional[str]:
+    """Opaque page token of a cursor, None when there is no such page"""
+    if not cursor or all(value is None for value in cursor.values()):
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii")
+
+
+def decode_page_token(page_token: str) -> dict:
+    try:
+        return json.loads(base64.urlsafe_b64decode(page_token.encode("ascii")))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid page token")
+
+
 @app.post(base_url + "stream/")
 async def stream_invoke(req: StreamRequest, request: Request):
 
     # Extract headers (including JWT authentication)
     header_info = get_headers(request)
     authorization = header_info["authorization"]
+    user_id = header_info["user_id"]
 
     # Generate session_id
     session_id = get_session_id(request, req.sessionId)
 
-    # Get a session
-    session = session_manager.get_session(session_id)
-    # Store authorization to session
-    if authorization:
-        session.set_ctx("authorization_token", authorization)
-    session.set_ctx("session_id", session_id)
-    session.set_ctx("env", req.env or {})
-    log(session_id, f"stream_invoke: {req}", LogLevel.INFO)
+    # A retried request attaches to the recorded run of the same idempotency key
+    idempotency_key = req.idempotencyKey or request.headers.get(
+        "Idempotency-Key")
+    idempotent_run = None
+    if idempotency_key:
+        # Keys of different users never collide, a key reused on another session is rejected
+        idempotency_key = idempotency_store.scoped_key(idempotency_key, user_id)
+        idempotent_run = idempotency_store.begin(idempotency_key, session_id)
+        if idempotent_run is None:
+            run_session_id = idempotency_store.get_state(idempotency_key).get("session_id")
+            if req.sessionId and run_session_id != req.sessionId:
+                raise HTTPException(
+                    status_code=409, detail="Idempotency key was already used for another session")
+            log(session_id,
+                f"duplicate request, replay idempotency key: {idempotency_key}", LogLevel.INFO)
+            return StreamingResponse(idempotency_store.replay(idempotency_key), media_type="text/event-stream")
+        # Keep the claim alive while the request waits for the session lock, not only while it streams
+        idempotent_run.start_heartbeat()
+
+    # Shed early when this worker's LLM admission queue is already full
+    if llm_scheduler.queue_depth() >= llm_scheduler.queue_max:
+        if idempotent_run:
+            idempotent_run.abandon()
+        raise HTTPException(
+            status_code=429, detail="The service is busy, please try again later")
+
+    # Only one request may run the agent on a session at a time
+    session_lock = session_lock_manager.get_lock(session_id)
+    try:
+        await session_lock.acquire_async(
+            wait=SESSION_LOCK_WAIT if SESSION_LOCK_POLICY == "queue" else 0)
+    except SessionLockError as e:
+        log(session_id, f"session lock rejected: {e}", LogLevel.WARNING)
+        if idempotent_run:
+            idempotent_run.abandon()
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    try:
+        # Get a session
+        session = session_manager.get_session(session_id)
+        session.set_fence(session_lock.lock_key, session_lock.token)
+        # Store authorization to session
+        if authorization:
+            session.set_ctx("authorization_token", authorization)
+        if user_id:
+            session.set_ctx("user_id", user_id)
+        session.set_ctx("session_id", session_id)
+        session.set_ctx("env", req.env or {})
+    except Exception:
+        session_lock.release()
+        if idempotent_run:
+            idempotent_run.abandon()
+        raise
+    log(session_id,
+        f"stream_invoke: {req}, session lock token: {session_lock.token}", LogLevel.INFO)
+
+    # Title a new session of a user while the agent works on its first step, fed with the start of the reply.
+    # Anonymous sessions are not listed anywhere, they get no title
+    title_draft = None
+    if user_id:
+        title_draft = TitleDraft()
+        try:
+            if not history_manager.start_title_generation(session_id, req.message, user_id, title_draft):
+                title_draft = None
+        except Exception as e:
+            title_draft = None
+            log(session_id, f"start title generation error: {e}", LogLevel.ERROR)
 
     def sse_generator() -> Generator[str, Any, None]:
         with tracer.start_as_current_span(
@@ -102,12 +228,19 @@ async def stream_invoke(req: StreamRequest, request: Request):
             try:
                 output = ""
                 for content in agent_call(session, req.message, req.tool_calls):
+                    if session_lock.lost:
+                        raise SessionLockLostError(
+                            session_id, session_lock.token)
                     if content:  # Only send when content is not empty
                         str_content = ""
                         if isinstance(content, str):
                             # AI message
                             str_content = f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
                             yield str_content
+                        elif isinstance(content, LLMRetry):
+                            # Aborted attempt, out of band of the text
+                            str_content = retry_frame(content)
+                            yield str_content
                         elif isinstance(content, ToolMessage):
                             # Tool result message
                             str_content = f"tool_message: {json.dumps(content.to_json()['kwargs'], ensure_ascii=False)}\n\n"
@@ -150,6 +283,8 @@ async def stream_invoke(req: StreamRequest, request: Request):
                             if content:  # Only send when content is not empty
                                 if isinstance(content, str):
                                     yield f"data: {json.dumps({'type': 'data', 'content': content}, ensure_ascii=False)}\n\n"
+                                elif isinstance(content, LLMRetry):
+                                    yield retry_frame(content)
                                 elif isinstance(content, ToolMessage):
                                     yield f"tool_message: {json.dumps(content.to_json(), ensure_ascii=False)}\n\n"
                                 else:
@@ -162,6 +297,14 @@ async def stream_invoke(req: StreamRequest, request: Request):
                             'content': f'Error occurred while processing request, session state has been cleaned. Error message: {str(retry_error)}'
                         }
                         yield f"data: {json.dumps(error_response, ensure_ascii=False)}\n\n"
+                elif isinstance(e, LLMAdmissionError):
+                    # Shed by admission control, the session is untouched so the client can simply retry
+                    error_response = {
+                        'type': 'error',
+                        'code': 'overloaded',
+                        'content': error_message
+                    }
+                    yield f"data: {json.dumps(error_response, ensure_ascii=False)}\n\n"
                 else:
                     # Other types of exceptions, return error directly
                     log(session_id,
@@ -177,16 +320,39 @@ async def stream_invoke(req: StreamRequest, request: Request):
         collected_responses = []
         user_input = req.message
 
+        session_lock.start_heartbeat()
+        ACTIVE_STREAMS.inc()
         try:
             for chunk in sse_generator():
                 collected_responses.append(chunk)
+                frame_type = chunk.split(":", 1)[0]
+                SSE_FRAMES.labels(frame_type).inc()
+                SSE_BYTES.labels(frame_type).inc(len(chunk.encode("utf-8")))
+                if idempotent_run:
+                    idempotent_run.append(chunk)
+                if title_draft and not title_draft.done and frame_type == "data":
+                    payload = json.loads(chunk[len("data: "):])
+                    if payload.get("type") not in ("error", "retry"):
+                        title_draft.feed(payload.get("content", ""))
                 yield chunk
         finally:
+            ACTIVE_STREAMS.dec()
+            if title_draft:
+                title_draft.close()
+            if idempotent_run:
+                try:
+                    idempotent_run.complete()
+                except Exception as e:
+                    log(session_id,
+                        f"complete idempotent run error: {e}", LogLevel.ERROR)
+            if getattr(session, "fencing_token", None) == session_lock.token:
+                session.set_fence(None, None)
+            session_lock.release()
             # Save history after generator ends
             if collected_responses:
                 try:
                     history_manager.save_interaction(
-                        session_id, user_input, collected_responses, "")
+                        session_id, user_input, collected_responses, user_id)
                 except Exception as e:
                     print(
                         f"Error saving history for session {session_id}: {e}")
@@ -195,8 +361,13 @@ async def stream_invoke(req: StreamRequest, request: Request):
 
 
 @app.get(base_url + "session-history/{session_id}")
-async def get_session_history_api(session_id: str, request: Request, limit: int = 50):
-    """Get session history"""
+async def get_session_history_api(session_id: str, request: Request, limit: int = 50,
+                                  before: Optional[int] = None, after: Optional[int] = None,
+                                  page_token: Optional[str] = None, fields: Optional[str] = None):
+    """
+    Get session history, the latest `limit` interactions or a page before/after an index.
+    Supports page tokens, field projection (e.g. fields=user_input,text,timestamp) and If-None-Match.
+    """
     # JWT authentication check
     header_info = get_headers(request)
     user_id = header_info["user_id"]
@@ -204,13 +375,31 @@ async def get_session_history_api(session_id: str, request: Request, limit: int
         raise HTTPException(
             status_code=401, detail="Invalid JWT token or UserId not found")
 
+    if page_token:
+        cursor = decode_page_token(page_token)
+        before, after = cursor.get("before"), cursor.get("after")
+    if limit < 0 or (before is not None and before < 0) or (after is not None and after < 0):
+        raise HTTPException(status_code=400, detail="limit, before and after cannot be negative")
+
     try:
-        history = history_manager.get_session_history(session_id, limit)
-        return {
+        params = (limit, before, after, fields)
+        # Unchanged pages are answered from the version key alone
+        etag = make_etag(history_manager.get_history_version(session_id), *params)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        page = history_manager.get_session_history_page(
+            session_id, limit, before, after, parse_fields(fields))
+        return JSONResponse({
             "session_id": session_id,
-            "history": history,
-            "total": len(history)
-        }
+            "history": page["history"],
+            "total": len(page["history"]),
+            "history_length": page["total"],
+            "before": page["before"],
+            "after": page["after"],
+            "next_page_token": encode_page_token({"before": page["before"]}),
+            "prev_page_token": encode_page_token({"after": page["after"]})
+        }, headers={"ETag": make_etag(page["version"], *params)})
     except Exception as e:
         log(session_id, f"get session history error: {e}", LogLevel.ERROR)
         return {"error": str(e)}
@@ -239,8 +428,42 @@ async def clear_session_history_api(session_id: str, request: Request):
 
 
 @app.get(base_url + "user-sessions")
-async def get_user_sessions_api(request: Request, limit: int = 100):
-    """Get all user session lists and metadata"""
+async def get_user_sessions_api(request: Request, limit: int = 100, cursor: Optional[str] = None,
+                                fields: Optional[str] = None):
+    """
+    Get user sessions and metadata, newest first. Pass next_cursor to get the following page,
+    fields projects the session attributes (e.g. fields=title), supports If-None-Match.
+    """
+    # JWT authentication check
+    header_info = get_headers(request)
+    user_id = header_info["user_id"]
+    if not user_id:
+        raise HTTPException(
+            status_code=401, detail="Invalid JWT token or UserId not found")
+
+    try:
+        params = (limit, cursor, fields)
+        etag = make_etag(
+            history_manager.get_user_sessions_version(user_id), *params)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        sessions, next_cursor = history_manager.get_user_sessions_with_meta_page(
+            user_id, limit, cursor, parse_fields(fields))
+        return JSONResponse({
+            "user_id": user_id,
+            "sessions": sessions,
+            "total": len(sessions),
+            "next_cursor": next_cursor
+        }, headers={"ETag": etag})
+    except Exception as e:
+        log(user_id, f"get user sessions error: {e}", LogLevel.ERROR)
+        return {"error": str(e)}
+
+
+@app.get(base_url + "user-sessions/search")
+async def search_user_sessions_api(request: Request, q: str, offset: int = 0, limit: int = 20):
+    """Full-text search over the user's session titles and history"""
     # JWT authentication check
     header_info = get_headers(request)
     user_id = header_info["user_id"]
@@ -249,14 +472,17 @@ async def get_user_sessions_api(request: Request, limit: int = 100):
             status_code=401, detail="Invalid JWT token or UserId not found")
 
     try:
-        sessions = history_manager.get_user_sessions_with_meta(user_id, limit)
+        sessions, total = history_manager.search_sessions(
+            q, user_id, offset, limit)
         return {
             "user_id": user_id,
+            "query": q,
             "sessions": sessions,
-            "total": len(sessions)
+            "offset": offset,
+            "total": total
         }
     except Exception as e:
-        log(user_id, f"get user sessions error: {e}", LogLevel.ERROR)
+        log(user_id, f"search user sessions error: {e}", LogLevel.ERROR)
         return {"error": str(e)}
 
 
@@ -271,22 +497,16 @@ async def clear_user_sessions_api(request: Request):
             status_code=401, detail="Invalid JWT token or UserId not found")
 
     try:
-        # First get all user session IDs
-        session_ids = history_manager.get_user_sessions(user_id)
-
-        # Clear history for each session
-        cleared_sessions = 0
-        for session_id in session_ids:
-            if history_manager.clear_session_history(session_id):
-                cleared_sessions += 1
-
-        # Clear user session list
-        success = history_manager.clear_user_sessions(user_id)
+        # Unlink every key owned by the user's sessions in pipelined batches
+        result = session_deletion_service.delete_user_sessions(user_id)
+        cleared_sessions = result["sessions"]
+        success = result["keys"] > 0
 
         return {
             "user_id": user_id,
             "success": success,
             "cleared_sessions": cleared_sessions,
+            "deleted_keys": result["keys"],
             "message": f"Cleared {cleared_sessions} session records for user {user_id}" if success else "Clear failed"
         }
     except Exception as e:
@@ -335,7 +555,8 @@ async def get_session_meta_api(session_id: str, request: Request):
             status_code=401, detail="Invalid JWT token or UserId not found")
 
     try:
-        meta = history_manager.get_session_meta(session_id)
+        # Access decisions read the primary, not the per-process cache or a lagging replica
+        meta = history_manager.get_session_meta(session_id, use_cache=False)
 
         # Verify if user has permission to access this session
         if meta.get("user_id") != user_id:
@@ -370,8 +591,8 @@ async def update_session_meta_api(session_id: str, request: Request):
         if not title:
             raise HTTPException(status_code=400, detail="Title is required")
 
-        # Verify if user has permission to modify this session
-        existing_meta = history_manager.get_session_meta(session_id)
+        # Verify if user has permission to modify this session, on uncached metadata from the primary
+        existing_meta = history_manager.get_session_meta(session_id, use_cache=False)
         if existing_meta.get("user_id") != user_id:
             raise HTTPException(status_code=403, detail="Access denied")
 
@@ -391,6 +612,100 @@ async def update_session_meta_api(session_id: str, request: Request):
         return {"error": str(e)}
 
 
+@app.get(base_url + "download/{session_id}")
+async def download_data_api(session_id: str, request: Request):
+    """Download the session's manuscript, supports Range, If-Range and If-None-Match"""
+    # Syncing the manuscript cache takes a file lock and may rebuild the file, keep it off the event loop
+    return await run_in_threadpool(download_data, session_id, request.headers.get("range"),
+                                   request.headers.get("if-range"), request.headers.get("if-none-match"))
+
+
+@app.on_event("startup")
+async def start_background_jobs():
+    """Start the orphan key collector when ORPHAN_GC_INTERVAL is set, workers take turns through its run lock"""
+    orphan_collector.start()
+
+
+@app.get("/actuator/health")
+async def health_api():
+    """Health check, probes Redis with a cached result"""
+    health = check_health()
+    return JSONResponse(health, status_code=200 if health["status"] == "UP" else 503)
+
+
+@app.get("/metrics")
+async def metrics_api():
+    """Prometheus metrics, aggregated over all workers in multi-process mode"""
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+@app.post(base_url + "batch/")
+async def submit_batch_api(req: BatchRequest, request: Request):
+    """Submit a headless batch generation job, every tool call is auto-confirmed"""
+    header_info = get_headers(request)
+    user_id = header_info["user_id"]
+    if not user_id:
+        raise HTTPException(
+            status_code=401, detail="Invalid JWT token or UserId not found")
+
+    if not req.prompts:
+        raise HTTPException(status_code=400, detail="Prompts are required")
+
+    try:
+        job_id = batch_job_manager.submit_job(
+            req.prompts, req.concurrency, req.env, user_id)
+        return {
+            "job_id": job_id,
+            "total": len(req.prompts),
+            "status": batch_job_manager.get_job_status(job_id).get("status")
+        }
+    except BatchCapacityError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except Exception as e:
+        log("batch", f"submit batch job error: {e}", LogLevel.ERROR)
+        return {"error": str(e)}
+
+
+@app.get(base_url + "batch/{job_id}")
+async def get_batch_status_api(job_id: str, request: Request):
+    """Get batch job progress"""
+    header_info = get_headers(request)
+    user_id = header_info["user_id"]
+    if not user_id:
+        raise HTTPException(
+            status_code=401, detail="Invalid JWT token or UserId not found")
+
+    # Jobs of other users are reported as missing
+    status = batch_job_manager.get_job_status(job_id, user_id)
+    if not status:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "job_id": job_id,
+        **status
+    }
+
+
+@app.get(base_url + "batch/{job_id}/result")
+async def get_batch_result_api(job_id: str, request: Request):
+    """Get batch job per-prompt results, sessions can be downloaded once completed"""
+    header_info = get_headers(request)
+    user_id = header_info["user_id"]
+    if not user_id:
+        raise HTTPException(
+            status_code=401, detail="Invalid JWT token or UserId not found")
+
+    # Jobs of other users are reported as missing
+    status = batch_job_manager.get_job_status(job_id, user_id)
+    if not status:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "job_id": job_id,
+        "status": status.get("status"),
+        "results": batch_job_manager.get_job_result(job_id)
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
     import os
@@ -403,6 +718,12 @@ if __name__ == "__main__":
     # When workers>1, use import string; when workers=1, pass app object directly
     if workers_count > 1:
         app = "server:app"
+        # Workers share metrics through mmap files, start from an empty directory
+        metrics_dir = os.environ.setdefault(
+            "PROMETHEUS_MULTIPROC_DIR", "/tmp/diy_agent_metrics")
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            os.remove(os.path.join(metrics_dir, name))
     uvicorn.run(
         app,  # Use import string
         host="0.0.0.0",
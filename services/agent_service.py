@@ -1,28 +1,110 @@
+import bisect
 from session import Session
 from tools import ToolCallToConfirm
-from typing import Generator
+from typing import Generator, List, Optional, Tuple
 from agents import main_agent
-from utils.index_store import IndexStore
-from fastapi.responses import StreamingResponse
+from utils import log, LogLevel
+from utils.index_store import IndexStore, CHUNK_SEPARATOR
+from services.manuscript_cache import manuscript_cache
+from fastapi.responses import FileResponse, Response, StreamingResponse
 
 
 def agent_call(session: Session, user_input: str, tool_calls_to_confirm_feedback: list[ToolCallToConfirm]) -> Generator:
     yield from main_agent.call(session, user_input, tool_calls_to_confirm_feedback)
 
 
-def download_data(session_id: str) -> Generator:
+def parse_range(range_header: Optional[str], total: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single `bytes=start-end` or `bytes=-suffix` range into inclusive offsets.
+    Returns None when the header is absent or has several ranges, raises ValueError when unsatisfiable.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    if not start:
+        suffix = int(end)
+        if suffix <= 0 or total == 0:
+            raise ValueError(range_header)
+        return max(0, total - suffix), total - 1
+    start = int(start)
+    end = min(int(end), total - 1) if end else total - 1
+    if start >= total or end < start:
+        raise ValueError(range_header)
+    return start, end
+
+
+def read_manuscript(index_store: IndexStore, chunks: List[Tuple[int, int, int]], version: str,
+                    start: int, end: int, client=None) -> Generator:
+    """
+    Stream the bytes start..end (inclusive) of the manuscript, chunks in order each followed by a separator.
+    Only the chunks overlapping the range are fetched, a window at a time. The stream stops early if
+    the manuscript changes, the client sees a short body and resumes with If-Range.
+    """
+    separator = CHUNK_SEPARATOR.encode('utf-8')
+    # Byte offset where each chunk starts
+    offsets = [0]
+    for _, size, _ in chunks:
+        offsets.append(offsets[-1] + size + len(separator))
+    rank = max(0, bisect.bisect_right(offsets, start) - 1)
+
+    for window_version, window in index_store.iter_windows(rank, client=client):
+        if window_version != version:
+            log(index_store.name, f"manuscript changed during download ({version} -> {window_version})",
+                LogLevel.WARNING)
+            return
+        for _, content in window:
+            chunk_start = offsets[rank]
+            part = content + separator
+            rank += 1
+            if chunk_start + len(part) <= start:
+                continue
+            yield part[max(0, start - chunk_start):end + 1 - chunk_start]
+            if chunk_start + len(part) > end:
+                return
+
+
+def download_data(session_id: str, range_header: Optional[str] = None, if_range: Optional[str] = None,
+                  if_none_match: Optional[str] = None) -> Response:
+    """
+    Download the manuscript of a session with Range, resume and ETag support. The assembled file cache is
+    sent when enabled, otherwise or when the manuscript is being written the chunks are streamed in order.
+    """
+    cached = manuscript_cache.sync(session_id)
+    if cached:
+        etag = f'"{session_id}-{cached["version"]}"'
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers={"ETag": etag})
+        # FileResponse answers Range and If-Range itself against the ETag
+        return FileResponse(cached["path"], stat_result=cached["stat"], media_type="text/plain; charset=utf-8",
+                            filename=f"{session_id}.txt", headers={"ETag": etag})
+
     index_store = IndexStore(session_id)
-    data = index_store.get_all()
-    count = index_store.count()
+    index_store.ensure_index()
+    client = index_store.reader_client()
+    version, chunks = index_store.chunk_list(client)
+    total = sum(size for _, size, _ in chunks) + len(CHUNK_SEPARATOR.encode('utf-8')) * len(chunks)
+    etag = f'"{session_id}-{version}"'
+    headers = {
+        "Content-Disposition": f"attachment; filename={session_id}.txt",
+        "Accept-Ranges": "bytes",
+        "ETag": etag
+    }
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
 
-    def generate():
-        for i in range(count):
-            yield data[str(i)]
+    # A stale If-Range validator means the client's partial copy is outdated, send everything
+    try:
+        byte_range = parse_range(range_header, total) if not if_range or if_range == etag else None
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{total}"})
+    start, end = byte_range or (0, total - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{total}"
 
     return StreamingResponse(
-        content=generate(),
-        media_type="text/plain",
-        headers={
-            "Content-Disposition": f"attachment; filename={session_id}.txt"
-        }
+        content=read_manuscript(index_store, chunks, version, start, end, client) if total else iter(()),
+        status_code=206 if byte_range else 200,
+        media_type="text/plain; charset=utf-8",
+        headers=headers
     )
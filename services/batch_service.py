@@ -0,0 +1,291 @@
+import json
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Callable, Optional
+from redis import Redis
+from utils.metrics import MetricsRedis
+from env import (get_redis_env, BATCH_MAX_CONCURRENCY, BATCH_DEFAULT_CONCURRENCY, BATCH_MAX_ROUNDS, BATCH_JOB_TTL,
+                 BATCH_MAX_JOBS, BATCH_JOB_LEASE_TTL)
+from agents import main_agent
+from session import Session, session_manager
+from tools import ToolCallToConfirm
+from tools.tools import ToolConfirmType
+from utils import log, LogLevel
+from utils.index_store import IndexStore
+from utils.llm import LLMRetry
+
+
+# Admit a job if fewer than ARGV[3] (0 is unlimited) jobs hold a live lease, leases are scored by expiry
+_ADMIT_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local max_jobs = tonumber(ARGV[3])
+if max_jobs > 0 and redis.call('ZCARD', KEYS[1]) >= max_jobs then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+return 1
+"""
+
+# Extend the lease of a job that still holds one
+_RENEW_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+return redis.call('ZADD', KEYS[1], 'XX', 'CH', now + tonumber(ARGV[2]), ARGV[1])
+"""
+
+# Fail a queued or running job whose lease expired, its worker died without recording the outcome
+_EXPIRE_SCRIPT = """
+local status = redis.call('HGET', KEYS[2], 'status')
+if status ~= 'queued' and status ~= 'running' then
+    return 0
+end
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local expiry = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if expiry and tonumber(expiry) > now then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[2], 'status', 'failed', 'error', ARGV[2], 'finished_at', ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+return 1
+"""
+
+
+class BatchCapacityError(Exception):
+    """Raised when a job is submitted while BATCH_MAX_JOBS jobs are running"""
+
+
+class BatchJobStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+def auto_confirm(tool_call_dicts: list[dict], action: ToolConfirmType = ToolConfirmType.CONFIRMED) -> list[ToolCallToConfirm]:
+    """
+    Auto-confirm policy for headless runs: answer every pending tool confirmation with the same action
+    """
+    return [ToolCallToConfirm(
+        tool_call_name=tool_call["tool_call_name"],
+        tool_call_id=tool_call["tool_call_id"],
+        tool_call_args=tool_call["tool_call_args"],
+        tool_confirm_action=action,
+    ) for tool_call in tool_call_dicts]
+
+
+def run_headless(session: Session, user_input: str, max_rounds: int = BATCH_MAX_ROUNDS):
+    """
+    Drive main_agent without a client, confirming every tool call until the agent stops asking.
+    Returns the last answer produced by the agent.
+    """
+    answer = None
+    feedback = None
+    for _ in range(max_rounds):
+        pending = None
+        text = ""
+        for content in main_agent.call(session, user_input, feedback):
+            if isinstance(content, list):
+                # Tool call confirmation request
+                pending = content
+            elif isinstance(content, str):
+                text += content
+            elif isinstance(content, LLMRetry):
+                text = content.drop(text)
+            elif isinstance(content, dict):
+                # Final answer of finish tool
+                answer = content
+        if text:
+            answer = answer or text
+        if not pending:
+            return answer
+        user_input, feedback = "", auto_confirm(pending)
+    log(session.session_id,
+        f"headless run stopped after {max_rounds} rounds", LogLevel.WARNING)
+    return answer
+
+
+def run_batch_item(job_id: str, index: int, prompt: str, env: dict = None, user_id: str = None):
+    """Worker process entry: generate one novel and record its progress in Redis"""
+    job_manager = BatchJobManager()
+    session_id = f"batch_{job_id}_{index}"
+    job_manager.update_item(job_id, index, status=BatchJobStatus.RUNNING,
+                            session_id=session_id, started_at=datetime.now().isoformat())
+    try:
+        session = session_manager.get_session(session_id)
+        session.set_ctx("session_id", session_id)
+        session.set_ctx("env", env or {})
+        if user_id:
+            session.set_ctx("user_id", user_id)
+        answer = run_headless(session, prompt)
+        job_manager.update_item(job_id, index, status=BatchJobStatus.COMPLETED,
+                                answer=answer, chunk_count=IndexStore(session_id).count(),
+                                finished_at=datetime.now().isoformat())
+        job_manager.redis.hincrby(job_manager.job_key(job_id), "completed", 1)
+    except Exception as e:
+        log(session_id, f"batch item {index} of job {job_id} failed: {e}",
+            LogLevel.ERROR)
+        job_manager.update_item(job_id, index, status=BatchJobStatus.FAILED,
+                                error=str(e), finished_at=datetime.now().isoformat())
+        job_manager.redis.hincrby(job_manager.job_key(job_id), "failed", 1)
+
+
+class BatchJobManager:
+    """
+    Headless batch generation jobs.
+    Job state lives in Redis so any server worker can answer status and result queries,
+    the items of a job run on a process pool owned by the worker that accepted it. Pool
+    processes are spawned, not forked, so they do not inherit the server worker's Redis
+    connections, locks and background threads.
+    A running job holds a lease renewed by its worker, at most max_jobs leases are live across
+    workers. A job whose lease expired, because its worker restarted, is reported failed when read.
+    """
+
+    def __init__(self, redis_client: Redis = None, max_jobs: int = BATCH_MAX_JOBS,
+                 lease_ttl: float = BATCH_JOB_LEASE_TTL):
+        self.redis = redis_client or MetricsRedis(**get_redis_env())
+        self.job_prefix = "batch_job:"
+        self.items_prefix = "batch_job_items:"
+        # Job ids scored by the expiry of their lease
+        self.running_key = "batch_jobs:running"
+        self.max_jobs = max_jobs
+        self.lease_ttl_ms = int(lease_ttl * 1000)
+        self._admit_script = self.redis.register_script(_ADMIT_SCRIPT)
+        self._renew_script = self.redis.register_script(_RENEW_SCRIPT)
+        self._expire_script = self.redis.register_script(_EXPIRE_SCRIPT)
+
+    def job_key(self, job_id: str) -> str:
+        return f"{self.job_prefix}{job_id}"
+
+    def items_key(self, job_id: str) -> str:
+        return f"{self.items_prefix}{job_id}"
+
+    def update_item(self, job_id: str, index: int, **fields):
+        """Merge fields into the stored state of one job item"""
+        items_key = self.items_key(job_id)
+        raw = self.redis.hget(items_key, index)
+        item = json.loads(raw) if raw else {}
+        item.update(fields)
+        self.redis.hset(items_key, index, json.dumps(item, ensure_ascii=False))
+
+    def submit_job(self, prompts: list[str], concurrency: int = None, env: dict = None,
+                   user_id: str = None, worker_initializer: Optional[Callable] = None,
+                   wait: bool = False) -> str:
+        """
+        Submit a batch of prompts, each prompt produces one novel in its own session.
+        worker_initializer runs once in every worker process, e.g. to install a fake LLM in tests.
+        """
+        if not prompts:
+            raise ValueError("prompts cannot be empty")
+        concurrency = max(
+            1, min(concurrency or BATCH_DEFAULT_CONCURRENCY, BATCH_MAX_CONCURRENCY, len(prompts)))
+        job_id = str(uuid.uuid4())
+        if not self._admit_script(keys=[self.running_key], args=[job_id, self.lease_ttl_ms, self.max_jobs]):
+            raise BatchCapacityError(f"{self.max_jobs} batch jobs are already running, please retry later")
+
+        pipe = self.redis.pipeline()
+        pipe.hset(self.job_key(job_id), mapping={
+            "status": BatchJobStatus.QUEUED,
+            "total": len(prompts),
+            "completed": 0,
+            "failed": 0,
+            "concurrency": concurrency,
+            "user_id": user_id or "",
+            "created_at": datetime.now().isoformat(),
+        })
+        for index, prompt in enumerate(prompts):
+            pipe.hset(self.items_key(job_id), index, json.dumps({
+                "prompt": prompt,
+                "status": BatchJobStatus.QUEUED,
+            }, ensure_ascii=False))
+        pipe.execute()
+
+        runner = threading.Thread(target=self._run_job, args=(
+            job_id, prompts, concurrency, env, user_id, worker_initializer), daemon=True)
+        runner.start()
+        if wait:
+            runner.join()
+        return job_id
+
+    def _heartbeat(self, job_id: str, stop_event: threading.Event):
+        """Renew the job's lease every lease_ttl/3 until the job ends"""
+        while not stop_event.wait(self.lease_ttl_ms / 3000):
+            try:
+                if not self._renew_script(keys=[self.running_key], args=[job_id, self.lease_ttl_ms]):
+                    log(job_id, "batch job lease was lost", LogLevel.WARNING)
+            except Exception as e:
+                log(job_id, f"batch job heartbeat error: {e}", LogLevel.ERROR)
+
+    def _run_job(self, job_id: str, prompts: list[str], concurrency: int, env: dict,
+                 user_id: str, worker_initializer: Optional[Callable]):
+        job_key = self.job_key(job_id)
+        stop_event = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job_id, stop_event),
+                         name=f"batch-job-{job_id}", daemon=True).start()
+        self.redis.hset(job_key, "status", BatchJobStatus.RUNNING)
+        log(job_id, f"batch job started, total: {len(prompts)}, concurrency: {concurrency}",
+            LogLevel.INFO)
+        try:
+            with ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=worker_initializer) as executor:
+                futures = {executor.submit(run_batch_item, job_id, index, prompt, env, user_id): index
+                           for index, prompt in enumerate(prompts)}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # The worker process died before it could record the failure
+                        index = futures[future]
+                        log(job_id, f"batch item {index} crashed: {e}",
+                            LogLevel.ERROR)
+                        self.update_item(
+                            job_id, index, status=BatchJobStatus.FAILED, error=str(e))
+                        self.redis.hincrby(job_key, "failed", 1)
+            self.redis.hset(job_key, "status", BatchJobStatus.COMPLETED)
+        except Exception as e:
+            log(job_id, f"batch job failed: {e}", LogLevel.ERROR)
+            self.redis.hset(job_key, mapping={
+                "status": BatchJobStatus.FAILED, "error": str(e)})
+        finally:
+            stop_event.set()
+            self.redis.zrem(self.running_key, job_id)
+            self.redis.hset(job_key, "finished_at", datetime.now().isoformat())
+            self.redis.expire(job_key, BATCH_JOB_TTL)
+            self.redis.expire(self.items_key(job_id), BATCH_JOB_TTL)
+            log(job_id, "batch job finished", LogLevel.INFO)
+
+    def get_job_status(self, job_id: str, user_id: str = None) -> dict:
+        """Get job progress, empty dict if the job does not exist or, given a user_id, belongs to another user"""
+        self._expire_script(keys=[self.running_key, self.job_key(job_id), self.items_key(job_id)],
+                            args=[job_id, "the worker running the job stopped", datetime.now().isoformat(),
+                                  BATCH_JOB_TTL])
+        meta = self.redis.hgetall(self.job_key(job_id))
+        status = {k.decode('utf-8'): v.decode('utf-8')
+                  for k, v in meta.items()}
+        if user_id is not None and status.get("user_id") != user_id:
+            return {}
+        for field in ("total", "completed", "failed", "concurrency"):
+            if field in status:
+                status[field] = int(status[field])
+        return status
+
+    def get_job_result(self, job_id: str) -> list[dict]:
+        """Get per-prompt results ordered by submission index"""
+        items = self.redis.hgetall(self.items_key(job_id))
+        results = []
+        for index, raw in sorted(items.items(), key=lambda kv: int(kv[0])):
+            item = json.loads(raw)
+            item["index"] = int(index)
+            results.append(item)
+        return results
+
+
+# Global batch job manager instance
+batch_job_manager = BatchJobManager()
@@ -0,0 +1,40 @@
+import threading
+import time
+from env import get_redis_env, HEALTH_CACHE_TTL
+from utils.metrics import MetricsRedis
+
+# Dedicated client with short timeouts so a stuck Redis fails the probe instead of hanging it
+_redis_client = MetricsRedis(
+    **get_redis_env(), socket_timeout=1, socket_connect_timeout=1)
+_cache_lock = threading.Lock()
+_cache = {"checked_at": 0.0, "result": None}
+
+
+def probe_redis() -> dict:
+    """Ping Redis, the result is cached for HEALTH_CACHE_TTL seconds so frequent probes stay cheap"""
+    with _cache_lock:
+        now = time.monotonic()
+        if _cache["result"] is not None and now - _cache["checked_at"] < HEALTH_CACHE_TTL:
+            return _cache["result"]
+
+        start = time.perf_counter()
+        try:
+            _redis_client.ping()
+            result = {"status": "UP", "latency_ms": round(
+                (time.perf_counter() - start) * 1000, 2)}
+        except Exception as e:
+            result = {"status": "DOWN", "error": str(e)}
+        _cache["checked_at"] = now
+        _cache["result"] = result
+        return result
+
+
+def check_health() -> dict:
+    """Aggregate health of the service dependencies"""
+    redis_health = probe_redis()
+    return {
+        "status": redis_health["status"],
+        "components": {
+            "redis": redis_health
+        }
+    }
@@ -0,0 +1,203 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Callable, Iterable, List, Optional
+from env import MANUSCRIPT_CACHE_DIR
+from utils import log, LogLevel
+from utils.index_store import IndexStore, CHUNK_SEPARATOR
+
+
+class ManuscriptChangedError(Exception):
+    """The manuscript was written while it was being assembled"""
+
+
+class ManuscriptCache:
+    """
+    Local cache of assembled manuscripts. Each session has a directory of generation files named by
+    store version and an index of chunk offsets. Redis stays the source of truth: a sync compares the chunk
+    list with the index, copies the unchanged prefix in the kernel and only fetches the chunks after the
+    first change, so appending a chunk fetches one chunk and editing one rewrites the tail after it.
+    Published files are never modified, they can be sent with FileResponse while the next one is built.
+    The directory is disposable and rebuilt on the next sync.
+    """
+
+    def __init__(self, directory: str = MANUSCRIPT_CACHE_DIR):
+        self.directory = directory
+        # Chunks reused and fetched by the last sync of this process
+        self.last_sync = {"reused": 0, "fetched": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _session_dir(self, session_id: str) -> str:
+        # Session ids come from URLs, hash them rather than use them as paths
+        return os.path.join(self.directory, hashlib.sha1(session_id.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _load_index(session_dir: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(session_dir, "index.json"), encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return index if os.path.exists(os.path.join(session_dir, index["file"])) else None
+
+    @staticmethod
+    def _entry(session_dir: str, index: dict) -> dict:
+        path = os.path.join(session_dir, index["file"])
+        return {"path": path, "version": index["version"], "size": index["size"], "stat": os.stat(path)}
+
+    @staticmethod
+    def _copy_prefix(src_path: str, out, size: int):
+        """Copy the first `size` bytes of a file, in the kernel where copy_file_range is supported"""
+        copied = 0
+        with open(src_path, "rb") as src:
+            try:
+                while copied < size:
+                    n = os.copy_file_range(
+                        src.fileno(), out.fileno(), size - copied, copied, copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except (AttributeError, OSError):
+                src.seek(copied)
+                out.seek(copied)
+                while copied < size:
+                    data = src.read(min(1 << 20, size - copied))
+                    if not data:
+                        break
+                    out.write(data)
+                    copied += len(data)
+        if copied != size:
+            raise OSError(f"cached manuscript {src_path} is shorter than its index")
+        out.seek(size)
+
+    def sync(self, session_id: str) -> Optional[dict]:
+        """
+        Bring the session's manuscript file up to date with Redis and return its path, version, size and
+        stat, or None when the cache is disabled, the session has no chunks or the manuscript changed while
+        it was assembled. Empty manuscripts leave nothing on disk.
+        """
+        if not self.enabled:
+            return None
+        session_dir = self._session_dir(session_id)
+        index_store = IndexStore(session_id)
+        if not index_store.ensure_index():
+            self.evict(session_id)
+            return None
+        os.makedirs(session_dir, exist_ok=True)
+
+        # One builder per session across workers
+        with open(os.path.join(session_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            client = index_store.reader_client()
+            version, chunks = index_store.chunk_list(client)
+            index = self._load_index(session_dir)
+            if index and index["version"] == version:
+                self.last_sync = {"reused": len(chunks), "fetched": 0}
+                return self._entry(session_dir, index)
+
+            # Longest prefix of chunks untouched since the cached file was built
+            cached: List[list] = index["chunks"] if index else []
+            keep = 0
+            while keep < min(len(cached), len(chunks)):
+                chunk_index, size, chunk_version = chunks[keep]
+                if cached[keep][:2] != [chunk_index, chunk_version] or cached[keep][3] != size:
+                    break
+                keep += 1
+            prefix_size = cached[keep][2] if keep < len(cached) else (
+                index["size"] if index else 0)
+
+            tmp_path = os.path.join(session_dir, f"{version}.tmp")
+            try:
+                entries = self._build(index_store, client, version, chunks, cached[:keep],
+                                      session_dir, index, prefix_size, tmp_path)
+            except (ManuscriptChangedError, OSError) as e:
+                log(session_id, f"manuscript cache not updated: {e}", LogLevel.WARNING)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return None
+
+            new_index = {"session_id": session_id, "version": version, "file": f"{version}.txt",
+                         "size": os.path.getsize(tmp_path), "chunks": entries}
+            os.replace(tmp_path, os.path.join(session_dir, new_index["file"]))
+            with open(os.path.join(session_dir, "index.tmp"), "w", encoding='utf-8') as f:
+                json.dump(new_index, f)
+            os.replace(os.path.join(session_dir, "index.tmp"),
+                       os.path.join(session_dir, "index.json"))
+            # Keep the previous generation for downloads that are still sending it
+            self._prune(session_dir, {new_index["file"], index["file"] if index else None})
+            self.last_sync = {"reused": keep, "fetched": len(chunks) - keep}
+            return self._entry(session_dir, new_index)
+
+    def _build(self, index_store: IndexStore, client, version: str, chunks: list, entries: List[list],
+               session_dir: str, index: Optional[dict], prefix_size: int, tmp_path: str) -> List[list]:
+        """Write the next generation file, returns its index entries [chunk, chunk version, offset, size]"""
+        separator = CHUNK_SEPARATOR.encode('utf-8')
+        rank = len(entries)
+        with open(tmp_path, "wb") as out:
+            if prefix_size:
+                self._copy_prefix(os.path.join(
+                    session_dir, index["file"]), out, prefix_size)
+            offset = prefix_size
+            if rank == len(chunks):
+                return entries
+            for window_version, window in index_store.iter_windows(rank, client=client):
+                if window_version != version:
+                    raise ManuscriptChangedError(
+                        f"version {version} -> {window_version}")
+                for chunk_index, content in window:
+                    entries.append(
+                        [chunk_index, chunks[rank][2], offset, len(content)])
+                    out.write(content)
+                    out.write(separator)
+                    offset += len(content) + len(separator)
+                    rank += 1
+        return entries
+
+    @staticmethod
+    def _prune(session_dir: str, keep: set):
+        for name in os.listdir(session_dir):
+            if name.endswith(".txt") and name not in keep:
+                os.remove(os.path.join(session_dir, name))
+
+    def evict(self, session_id: str):
+        """Drop the cached files of a session"""
+        if self.enabled:
+            shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def sweep(self, alive: Callable[[List[str]], Iterable[str]], min_idle: float) -> int:
+        """
+        Remove the directories of sessions that no longer exist, e.g. expired by TTL or reclaimed by
+        the orphan collector. Directories modified within min_idle seconds are kept, as are those of the
+        sessions `alive` returns. Returns the number of directories removed.
+        """
+        if not self.enabled or not os.path.isdir(self.directory):
+            return 0
+        idle = {}
+        now = time.time()
+        for name in os.listdir(self.directory):
+            session_dir = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(session_dir).st_mtime < min_idle:
+                    continue
+                with open(os.path.join(session_dir, "index.json"), encoding='utf-8') as f:
+                    idle[session_dir] = json.load(f).get("session_id")
+            except (OSError, ValueError):
+                # Without a readable index the directory cannot be used, it is rebuilt on the next sync
+                idle[session_dir] = None
+        alive_ids = set(alive([session_id for session_id in set(idle.values()) if session_id]))
+        removed = 0
+        for session_dir, session_id in idle.items():
+            if session_id not in alive_ids:
+                shutil.rmtree(session_dir, ignore_errors=True)
+                removed += 1
+        return removed
+
+
+# Global manuscript cache instance
+manuscript_cache = ManuscriptCache()
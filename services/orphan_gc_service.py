@@ -0,0 +1,166 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import List, Optional
+from redis import Redis
+from env import ORPHAN_GC_INTERVAL, ORPHAN_GC_RATE, ORPHAN_GC_MIN_IDLE, SCAN_COUNT
+from services.manuscript_cache import manuscript_cache
+from utils import log, LogLevel
+from utils.history import history_manager
+from utils.key_registry import parse_session_key
+from utils.redis_scan import scan_batches
+
+# Release the run lock only if we still own it
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class OrphanCollector:
+    """
+    Incrementally finds keys owned by sessions that no longer exist and reclaims them.
+    A session is alive while its message list, history or metadata exists, and a key is only
+    an orphan once it has been idle for min_idle seconds, so sessions being created are never touched.
+    Orphans are unlinked at a bounded rate to keep Redis latency flat. Reclaiming runs also remove the
+    local manuscript cache of sessions that are gone, including sessions whose keys all expired.
+    """
+
+    def __init__(self, redis_client: Redis = None, rate: int = ORPHAN_GC_RATE,
+                 min_idle: int = ORPHAN_GC_MIN_IDLE, scan_count: int = SCAN_COUNT):
+        self.redis = redis_client or history_manager.redis
+        self.rate = rate
+        self.min_idle = min_idle
+        self.scan_count = scan_count
+        self.lock_key = "orphan_gc:lock"
+        self.report_key = "orphan_gc:report"
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def _alive_sessions(self, session_ids: List[str]) -> set:
+        pipe = self.redis.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.exists(session_id,
+                        f"{history_manager.history_prefix}{session_id}",
+                        f"{history_manager.session_meta_prefix}{session_id}")
+        return {session_id for session_id, count in zip(session_ids, pipe.execute()) if count}
+
+    def _find_orphans(self, keys: List[str]) -> List[dict]:
+        """Orphans among a batch of keys with their memory usage"""
+        candidates = []
+        for key in keys:
+            parsed = parse_session_key(key)
+            if parsed:
+                candidates.append((key, *parsed))
+        if not candidates:
+            return []
+
+        alive = self._alive_sessions(
+            list({owner for _, _, owner in candidates}))
+        candidates = [c for c in candidates if c[2] not in alive]
+        if not candidates:
+            return []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key, _, _ in candidates:
+            pipe.object("idletime", key)
+            pipe.memory_usage(key)
+        results = pipe.execute(raise_on_error=False)
+
+        orphans = []
+        for i, (key, kind, owner) in enumerate(candidates):
+            idle, memory = results[2 * i], results[2 * i + 1]
+            # Keys whose idle time is unknown (e.g. LFU eviction policy) are kept
+            if isinstance(idle, Exception) or idle is None or idle < self.min_idle:
+                continue
+            orphans.append({"key": key, "kind": kind, "session_id": owner,
+                            "memory": 0 if isinstance(memory, Exception) else memory or 0})
+        return orphans
+
+    def _reclaim(self, orphans: List[dict]) -> int:
+        """Unlink orphans in batches paced to `rate` keys per second"""
+        reclaimed = 0
+        batch_size = max(1, min(100, self.rate))
+        for start in range(0, len(orphans), batch_size):
+            batch = orphans[start:start + batch_size]
+            paced = len(batch)
+            # Sessions may have come back since the scan
+            alive = self._alive_sessions(
+                list({orphan["session_id"] for orphan in batch}))
+            batch = [o for o in batch if o["session_id"] not in alive]
+            for orphan in batch:
+                if orphan["kind"] == "search_tokens":
+                    # Drop the session from the token sets along with its token list
+                    history_manager.search_index.remove_session(
+                        orphan["key"][len(history_manager.search_index.session_prefix):])
+            keys = [o["key"] for o in batch]
+            if keys:
+                reclaimed += self.redis.unlink(*keys)
+            time.sleep(paced / self.rate)
+        return reclaimed
+
+    def run(self, reclaim: bool = False, max_keys: int = None, parallel: bool = False) -> dict:
+        """
+        Scan the keyspace once and report orphaned keys and reclaimable memory,
+        unlinking them as they are found when reclaim is set. Only one run at a time across workers.
+        """
+        token = str(uuid.uuid4())
+        if not self.redis.set(self.lock_key, token, nx=True, ex=3600):
+            return {"status": "skipped", "reason": "another collection is running"}
+
+        report = {"scanned": 0, "orphans": 0, "reclaimable_bytes": 0, "reclaimed": 0}
+        by_kind = Counter()
+        start = time.monotonic()
+        try:
+            for keys in scan_batches(self.redis, "*", self.scan_count, parallel=parallel):
+                report["scanned"] += len(keys)
+                orphans = self._find_orphans(keys)
+                report["orphans"] += len(orphans)
+                report["reclaimable_bytes"] += sum(o["memory"] for o in orphans)
+                by_kind.update(o["kind"] for o in orphans)
+                if reclaim and orphans:
+                    report["reclaimed"] += self._reclaim(orphans)
+                if self._stop_event.is_set() or (max_keys and report["scanned"] >= max_keys):
+                    break
+            if reclaim:
+                report["evicted_manuscripts"] = manuscript_cache.sweep(self._alive_sessions, self.min_idle)
+        finally:
+            self.redis.eval(_RELEASE_SCRIPT, 1, self.lock_key, token)
+
+        report["by_kind"] = dict(by_kind)
+        report["duration_seconds"] = round(time.monotonic() - start, 2)
+        report["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.redis.hset(self.report_key, mapping={
+            k: str(v) for k, v in report.items()})
+        log("orphan_gc", f"orphan collection finished: {report}", LogLevel.INFO)
+        return report
+
+    def get_last_report(self) -> dict:
+        report = self.redis.hgetall(self.report_key)
+        return {k.decode('utf-8'): v.decode('utf-8') for k, v in report.items()}
+
+    def start(self, interval: int = ORPHAN_GC_INTERVAL):
+        """Run a reclaiming collection every `interval` seconds on a daemon thread, 0 disables it"""
+        if interval <= 0 or self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.run(reclaim=True)
+                except Exception as e:
+                    log("orphan_gc", f"orphan collection error: {e}", LogLevel.ERROR)
+
+        self._thread = threading.Thread(
+            target=loop, name="orphan-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+# Global orphan collector instance
+orphan_collector = OrphanCollector()
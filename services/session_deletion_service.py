@@ -0,0 +1,89 @@
+from typing import List
+from redis import Redis
+from env import SESSION_DELETE_BATCH
+from session import session_manager
+from utils import log, LogLevel
+from utils.history import history_manager
+from utils.key_registry import key_registry, owned_sessions, session_keys
+from services.manuscript_cache import manuscript_cache
+from agents.sub_agent import sub_agent_sessions
+
+
+class SessionDeletionService:
+    """
+    Deletes sessions with everything they own, including sub-agent sessions.
+    Keys come from the naming convention and the per-session key registry and are freed with UNLINK in pipelined batches,
+    so Redis reclaims the memory in the background and the caller does not wait on large values.
+    """
+
+    def __init__(self, redis_client: Redis = None, batch_size: int = SESSION_DELETE_BATCH):
+        self.redis = redis_client or history_manager.redis
+        self.batch_size = batch_size
+
+    def _unindex(self, session_ids: List[str]):
+        """Remove the sessions from the search token sets before their token lists are unlinked"""
+        search_index = history_manager.search_index
+        pipe = self.redis.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.zrange(f"{search_index.session_prefix}{session_id}", 0, -1)
+        token_lists = pipe.execute()
+
+        pipe = self.redis.pipeline(transaction=False)
+        for session_id, tokens in zip(session_ids, token_lists):
+            for token in tokens:
+                pipe.zrem(
+                    f"{search_index.token_prefix}{token.decode('utf-8')}", session_id)
+                if len(pipe) >= self.batch_size:
+                    pipe.execute()
+        pipe.execute()
+
+    def _unlink(self, keys: List[str]) -> int:
+        """UNLINK keys, batch_size keys per command and a few commands per round trip"""
+        unlinked = 0
+        pipe = self.redis.pipeline(transaction=False)
+        for start in range(0, len(keys), self.batch_size):
+            pipe.unlink(*keys[start:start + self.batch_size])
+            if len(pipe) >= 10:
+                unlinked += sum(pipe.execute())
+        unlinked += sum(pipe.execute())
+        return unlinked
+
+    def delete_sessions(self, session_ids: List[str], user_id: str = None) -> dict:
+        """Delete the sessions and all their keys, and drop them from the user's session index"""
+        all_session_ids = [sid for session_id in session_ids
+                           for sid in owned_sessions(session_id)]
+        self._unindex(all_session_ids)
+        keys = {key for session_id in session_ids
+                for key in session_keys(session_id)}
+        keys.update(key_registry.get_keys(session_ids))
+        unlinked = self._unlink(sorted(keys))
+        key_registry.forget(session_ids)
+
+        for session_id in all_session_ids:
+            history_manager._invalidate_meta(session_id)
+            session_manager.sessions.pop(session_id, None)
+            manuscript_cache.evict(session_id)
+            sub_agent_sessions.drop(session_id)
+        if user_id and session_ids:
+            user_sessions_key = f"{history_manager.user_sessions_prefix}{user_id}"
+            history_manager._user_sessions_call(
+                user_sessions_key, lambda: self.redis.zrem(user_sessions_key, *session_ids))
+            history_manager.bump_user_sessions_version(user_id)
+
+        log(user_id or "session_deletion",
+            f"deleted {len(session_ids)} sessions, unlinked {unlinked} keys", LogLevel.INFO)
+        return {"sessions": len(session_ids), "keys": unlinked}
+
+    def delete_user_sessions(self, user_id: str) -> dict:
+        """Delete every session of a user and the user's session index"""
+        user_sessions_key = f"{history_manager.user_sessions_prefix}{user_id}"
+        session_ids = history_manager._user_sessions_call(
+            user_sessions_key, lambda: [s.decode('utf-8') for s in self.redis.zrange(user_sessions_key, 0, -1)])
+        result = self.delete_sessions(session_ids)
+        result["keys"] += self.redis.unlink(user_sessions_key)
+        history_manager.bump_user_sessions_version(user_id)
+        return result
+
+
+# Global session deletion service instance
+session_deletion_service = SessionDeletionService()
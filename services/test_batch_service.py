@@ -0,0 +1,109 @@
+import time
+import uuid
+from langchain_core.language_models.fake_chat_models import FakeMessagesListChatModel
+from langchain_core.messages import AIMessage
+from services.batch_service import batch_job_manager, BatchJobManager, BatchJobStatus, BatchCapacityError
+from services.session_deletion_service import session_deletion_service
+from utils.index_store import IndexStore
+
+
+class FakeToolLLM(FakeMessagesListChatModel):
+    """Fake chat model replaying tool calls, tools binding is a no-op"""
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+
+def _tool_call_message(name: str, args: dict, call_id: str) -> AIMessage:
+    return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": call_id}])
+
+
+def install_fake_llm():
+    """Worker initializer: replace the agent LLM with a scripted fake"""
+    import agents.agent
+    agents.agent.job_intent_llm = FakeToolLLM(responses=[
+        _tool_call_message("prompt_title", {"title": "Fake Novel", "reason": "title"}, "call_title"),
+        _tool_call_message("prompt_chunk_content", {
+            "chunk_index": 1, "content": "Once upon a time.", "reason": "chunk"}, "call_chunk"),
+        _tool_call_message("finish_novel", {"answer": "done", "reason": "finish"}, "call_finish"),
+        AIMessage(content="The novel is finished."),
+    ])
+
+
+def test_batch_job():
+    """Test a headless batch job end-to-end with a fake LLM"""
+    print("=== Testing BatchJobManager ===")
+
+    try:
+        batch_job_manager.redis.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping batch tests (Redis service may not be running)\n")
+        return
+
+    prompts = ["A short fairy tale", "Another short fairy tale"]
+    job_id = batch_job_manager.submit_job(
+        prompts, concurrency=2, user_id="test_batch_user", worker_initializer=install_fake_llm, wait=True)
+    results = batch_job_manager.get_job_result(job_id)
+    try:
+        status = batch_job_manager.get_job_status(job_id, "test_batch_user")
+        print(f"Batch job status: {status}")
+        assert batch_job_manager.get_job_status(job_id, "another_user") == {}, \
+            "Jobs should be hidden from other users"
+        assert status["status"] == BatchJobStatus.COMPLETED, f"Expected completed, actual: {status['status']}"
+        assert status["total"] == 2 and status["completed"] == 2 and status["failed"] == 0, \
+            f"Expected 2 completed items, actual: {status}"
+        assert batch_job_manager.redis.zscore(batch_job_manager.running_key, job_id) is None, \
+            "Finished jobs should release their lease"
+
+        assert [r["index"] for r in results] == [0, 1], "Results should be ordered by index"
+        for result in results:
+            assert result["status"] == BatchJobStatus.COMPLETED, f"Item should be completed: {result}"
+            assert result["prompt"] == prompts[result["index"]], "Item should keep its prompt"
+            index_store = IndexStore(result["session_id"])
+            assert index_store.count() == 1, "Auto-confirmed chunk should be stored"
+        print("BatchJobManager tests passed!\n")
+    finally:
+        session_deletion_service.delete_sessions([r["session_id"] for r in results if r.get("session_id")])
+        batch_job_manager.redis.delete(batch_job_manager.job_key(job_id), batch_job_manager.items_key(job_id))
+
+
+def test_batch_job_leases():
+    """Test the global job cap and jobs whose worker died"""
+    print("=== Testing batch job leases ===")
+
+    try:
+        batch_job_manager.redis.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping batch lease tests (Redis service may not be running)\n")
+        return
+
+    manager = BatchJobManager(batch_job_manager.redis, max_jobs=1)
+    manager.running_key = f"test_batch_running_{uuid.uuid4()}"
+    redis_client = manager.redis
+    job_id = str(uuid.uuid4())
+    try:
+        # A job of a worker that restarted: still running, its lease expired
+        redis_client.hset(manager.job_key(job_id), mapping={"status": BatchJobStatus.RUNNING, "user_id": "u"})
+        redis_client.zadd(manager.running_key, {job_id: 0})
+        status = manager.get_job_status(job_id, "u")
+        assert status["status"] == BatchJobStatus.FAILED and "stopped" in status["error"], \
+            f"A job without a live lease should be reported failed: {status}"
+        assert redis_client.ttl(manager.job_key(job_id)) > 0, "A failed job should expire like a finished one"
+
+        # A live job fills the cap
+        redis_client.zadd(manager.running_key, {"live_job": time.time() * 1000 + 60000})
+        try:
+            manager.submit_job(["A prompt"])
+            assert False, "Jobs beyond the cap should be rejected"
+        except BatchCapacityError:
+            pass
+        print("Batch lease tests passed!\n")
+    finally:
+        redis_client.delete(manager.running_key, manager.job_key(job_id), manager.items_key(job_id))
+
+
+if __name__ == "__main__":
+    test_batch_job()
+    test_batch_job_leases()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import uuid
+from redis import Redis
+from env import get_redis_env
+from utils.index_store import IndexStore
+from services.manuscript_cache import ManuscriptCache
+
+
+def test_manuscript_cache():
+    """Test incremental manuscript file syncs and sweeping the files of deleted sessions"""
+    print("=== Testing ManuscriptCache ===")
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping ManuscriptCache tests (Redis service may not be running)\n")
+        return
+
+    session_id = f"test_manuscript_cache_{uuid.uuid4()}"
+    index_store = IndexStore(session_id)
+    chunks = {}
+
+    def check(reused: int, fetched: int, message: str):
+        entry = cache.sync(session_id)
+        with open(entry["path"], "rb") as f:
+            content = f.read()
+        expected = "".join(chunks[i] + "\n\n" for i in sorted(chunks)).encode('utf-8')
+        assert content == expected, f"{message}: file should match Redis"
+        assert cache.last_sync == {"reused": reused, "fetched": fetched}, \
+            f"{message}: expected {reused} reused and {fetched} fetched, actual {cache.last_sync}"
+        return entry
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ManuscriptCache(directory)
+        try:
+            assert cache.sync(session_id) is None, "Sessions without chunks should not be cached"
+            assert os.listdir(directory) == [], "Sessions without chunks should leave nothing on disk"
+
+            for i in range(1, 5):
+                chunks[i] = f"第{i}章"
+                index_store.add(i, chunks[i])
+            first = check(0, 4, "Initial build")
+            check(4, 0, "Unchanged manuscript")
+
+            chunks[5] = "第5章"
+            index_store.add(5, chunks[5])
+            check(4, 1, "Appended chunk")
+
+            chunks[2] = "第2章 修改"
+            index_store.update(2, chunks[2])
+            check(1, 4, "Edited chunk rewrites the tail")
+
+            del chunks[5]
+            index_store.delete(5)
+            entry = check(4, 0, "Deleted last chunk truncates")
+            assert not os.path.exists(first["path"]), "Old generations should be pruned"
+
+            cache.evict(session_id)
+            assert not os.path.exists(entry["path"]), "Evicted files should be removed"
+            check(0, 4, "Evicted cache rebuilds")
+
+            assert cache.sweep(lambda session_ids: session_ids, min_idle=0) == 0, "Live sessions should be kept"
+            assert cache.sweep(lambda session_ids: [], min_idle=3600) == 0, "Recent files should be kept"
+            assert cache.sweep(lambda session_ids: [], min_idle=0) == 1, "Deleted sessions should be swept"
+            assert os.listdir(directory) == [], "Swept files should be removed"
+            print("ManuscriptCache tests passed\n")
+        finally:
+            redis_client.delete(*index_store._chunk_keys, f"session_keys:{session_id}")
+
+
+if __name__ == "__main__":
+    test_manuscript_cache()
@@ -0,0 +1,55 @@
+import json
+import uuid
+from redis import Redis
+from env import get_redis_env
+from langchain_core.messages import HumanMessage
+from session import RedisSession
+from utils.history import history_manager
+from utils.index_store import IndexStore
+from utils.key_registry import session_keys
+from services.session_deletion_service import SessionDeletionService
+
+
+def test_delete_user_sessions():
+    """Test bulk deletion of every key owned by a user's sessions"""
+    print("=== Testing SessionDeletionService ===")
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping SessionDeletionService tests (Redis service may not be running)\n")
+        return
+
+    user_id = f"test_delete_user_{uuid.uuid4()}"
+    session_ids = [f"test_delete_{uuid.uuid4()}" for _ in range(3)]
+    for session_id in session_ids:
+        session = RedisSession(session_id, redis_client)
+        session.add_message(HumanMessage(content="写一部小说"))
+        session.set_ctx("user_id", user_id)
+        RedisSession(f"{session_id}_sub_agent_critic", redis_client).add_message(
+            HumanMessage(content="critic"))
+        IndexStore(session_id).add(1, "第一章")
+        history_manager.add_user_session(user_id, session_id)
+        history_manager.save_interaction(session_id, "写一部小说", [
+            f"data: {json.dumps({'content': '好的'}, ensure_ascii=False)}\n\n"])
+        history_manager.save_session_meta(session_id, title="小说", user_id=user_id)
+
+    # A small batch size exercises the batching
+    result = SessionDeletionService(redis_client, batch_size=4).delete_user_sessions(user_id)
+    print(f"Deletion result: {result}")
+    assert result["sessions"] == 3, f"Expected 3 sessions deleted, actual: {result['sessions']}"
+
+    leftover = [key for session_id in session_ids for key in session_keys(session_id)
+                if redis_client.exists(key)]
+    assert not leftover, f"Keys left after deletion: {leftover}"
+    assert not redis_client.exists(f"user_sessions:{user_id}"), "User session index should be deleted"
+    found, _ = history_manager.search_sessions("小说", limit=1000)
+    assert not any(s["session_id"] in session_ids for s in found), \
+        "Deleted sessions should be removed from the search index"
+    print("SessionDeletionService tests passed\n")
+
+
+if __name__ == "__main__":
+    test_delete_user_sessions()
@@ -1,16 +1,29 @@
 import abc
 import json
-from typing import Awaitable, Any
+from typing import Awaitable, Any, Callable
 from redis import Redis
+from redis.client import Pipeline
+from redis.exceptions import WatchError
+from utils.metrics import MetricsRedis
 from env import get_redis_env
 from langchain_core.messages import BaseMessage, AIMessage, HumanMessage, SystemMessage
 from langchain_core.load import load
 from utils import log, LogLevel
+from utils.session_lock import SessionLockLostError
+from utils.key_registry import key_registry
 from collections import deque
 from typing import List
 
 _n_humans = 30
 
+# Append only while the caller still owns the session lease
+_FENCED_RPUSH_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('RPUSH', KEYS[2], ARGV[2])
+end
+return -1
+"""
+
 
 class Session(abc.ABC):
     """
@@ -120,6 +133,12 @@ class Session(abc.ABC):
         """
         pass
 
+    def set_fence(self, lock_key: str = None, fencing_token: str = None):
+        """
+        Guard message writes with a session lease, no-op for non-shared storage
+        """
+        pass
+
     def set_ctx(self, key: str, value):
         """
         Set context information
@@ -260,13 +279,46 @@ class RedisSession(Session):
     def __init__(self, session_id: str, redis_client: Redis):
         super().__init__(session_id)
         self.redis_client = redis_client
+        self.lock_key: str = None
+        self.fencing_token: str = None
+
+    def set_fence(self, lock_key: str = None, fencing_token: str = None):
+        """
+        Guard every message and context write with a session lease, writes are rejected once
+        the lease has been taken over by another request. Pass None to disable fencing.
+        """
+        self.lock_key = lock_key
+        self.fencing_token = fencing_token
+
+    def _write(self, queue_writes: Callable[[Pipeline], None]):
+        """
+        Run the writes queued by `queue_writes` in one transaction. While fenced the lease key is
+        watched and checked first, so the transaction fails if the lease changes hands meanwhile.
+        """
+        with self.redis_client.pipeline() as pipe:
+            if self.fencing_token is None:
+                queue_writes(pipe)
+                pipe.execute()
+                return
+            try:
+                pipe.watch(self.lock_key)
+                owner = pipe.get(self.lock_key)
+                if owner is None or owner.decode('utf-8') != self.fencing_token:
+                    raise SessionLockLostError(self.session_id, self.fencing_token)
+                pipe.multi()
+                queue_writes(pipe)
+                pipe.execute()
+            except WatchError:
+                raise SessionLockLostError(self.session_id, self.fencing_token)
 
     def set_ctx(self, key: str, value: Any):
         """
         Set context information
         """
-        self.redis_client.hset(
-            f"session_ctx:{self.session_id}", key, json.dumps(value))
+        ctx_key = f"session_ctx:{self.session_id}"
+        key_registry.register(self.session_id, ctx_key)
+        serialized = json.dumps(value)
+        self._write(lambda pipe: pipe.hset(ctx_key, key, serialized))
 
     def get_ctx(self, key: str):
         """
@@ -289,7 +341,15 @@ class RedisSession(Session):
             # span.set_attribute("message_len", len(raw_message))
             message.additional_kwargs["raw_message"] = raw_message
         serialized = json.dumps(message.to_json())
-        self.redis_client.rpush(self.session_id, serialized)
+        key_registry.register(self.session_id, self.session_id)
+        if self.fencing_token is None:
+            self.redis_client.rpush(self.session_id, serialized)
+            return
+
+        result = self.redis_client.eval(
+            _FENCED_RPUSH_SCRIPT, 2, self.lock_key, self.session_id, self.fencing_token, serialized)
+        if result == -1:
+            raise SessionLockLostError(self.session_id, self.fencing_token)
 
     def delete_message(self, index: int):
         raise NotImplementedError(
@@ -299,7 +359,6 @@ class RedisSession(Session):
         raise NotImplementedError(
             "RedisSession does not support delete_reverse_messages")
 
-    # fixme: this method is not efficient, need to optimize
     def delete_reverse_message(self, index: int):
         """
         Delete the index-th message from the end
@@ -310,50 +369,31 @@ class RedisSession(Session):
         if index <= 0:
             return
 
-        # Get current total message count
-        total_count = self.redis_client.llen(self.session_id)
-
-        if index > total_count:
+        # LREM deletes by value and could hit a duplicate, rebuild the list without the target position
+        all_messages = self.redis_client.lrange(self.session_id, 0, -1)
+        if index > len(all_messages):
             return  # Cannot delete messages beyond range
+        delete_pos = len(all_messages) - index
+        self._replace_messages(
+            [message for i, message in enumerate(all_messages) if i != delete_pos])
 
-        try:
-            # In Redis, the position of the index-th message from the end is -index
-            # Using lrem to delete elements at specific positions is complex, we adopt the following strategy:
-            # 1. First get the element to be deleted
-            # 2. Then delete the first matching element
-
-            # Get the message to be deleted
-            target_message = self.redis_client.lindex(self.session_id, -index)
-            if target_message is None:
-                return
-
-            # Since Redis lrem deletes by value, it may delete wrong messages (if there are duplicate contents)
-            # A safer method is to rebuild the entire list, excluding messages at the target position
-
-            # Get all messages
-            all_messages = self.redis_client.lrange(self.session_id, 0, -1)
-
-            # Calculate the position of the message to be deleted in forward index
-            delete_pos = total_count - index
+    def _replace_messages(self, serialized_messages: list):
+        """Replace the whole message list in one transaction"""
+        key_registry.register(self.session_id, self.session_id)
 
-            # Delete the entire list
-            self.redis_client.delete(self.session_id)
-
-            # Re-add all messages except those at the target position
-            for i, message in enumerate(all_messages):
-                if i != delete_pos:
-                    self.redis_client.rpush(self.session_id, message)
-
-        except Exception as e:
-            # If operation fails, log error but don't throw exception
-            print(
-                f"Warning: Failed to delete reverse message at index {index}: {e}")
+        def queue_writes(pipe: Pipeline):
+            pipe.delete(self.session_id)
+            if serialized_messages:
+                pipe.rpush(self.session_id, *serialized_messages)
+        self._write(queue_writes)
 
     def update_message(self, index: int, message: BaseMessage):
         try:
             # Serialize and store
             serialized = json.dumps(message.to_json())
-            self.redis_client.lset(self.session_id, index, serialized)
+            self._write(lambda pipe: pipe.lset(self.session_id, index, serialized))
+        except SessionLockLostError:
+            raise
         except Exception:
             pass  # Ignore when index is out of range
 
@@ -363,7 +403,9 @@ class RedisSession(Session):
         try:
             # Serialize and store
             serialized = json.dumps(message.to_json())
-            self.redis_client.lset(self.session_id, -index, serialized)
+            self._write(lambda pipe: pipe.lset(self.session_id, -index, serialized))
+        except SessionLockLostError:
+            raise
         except Exception:
             pass  # Ignore when index is out of range
 
@@ -509,30 +551,27 @@ class RedisSession(Session):
         """
         Clear all messages
         """
-        self.redis_client.delete(self.session_id)
+        self._write(lambda pipe: pipe.delete(self.session_id))
 
     def cleanup_tool_call_messages(self):
         """
         Clean up AIMessage containing tool_call, search backward from the end for the last AIMessage containing tool_calls
         Delete the last AIMessage containing tool_calls and all messages after it
         """
-        # Get all messages
-        all_messages = self.get_all_messages()
+        all_messages = self.redis_client.lrange(self.session_id, 0, -1)
 
         # Search backward from the end for the last AIMessage containing tool_calls
-        cleanup_index = -1
         for i in range(len(all_messages) - 1, -1, -1):
-            message = all_messages[i]
+            try:
+                message = self._deserialize_message(all_messages[i])
+            except Exception as e:
+                print(f"Warning: Failed to deserialize message: {e}")
+                continue
             if hasattr(message, 'tool_calls') and message.tool_calls:
-                cleanup_index = i
+                # Rebuild the session in one transaction, only keep messages before it
+                self._replace_messages(all_messages[:i])
                 break
 
-        if cleanup_index >= 0:
-            # Need to rebuild session, only keep messages before cleanup_index
-            self.clear_all_messages()
-            for i in range(cleanup_index):
-                self.add_message(all_messages[i])
-
 
 class SessionManager:
     """
@@ -549,7 +588,7 @@ class SessionManager:
                 self.sessions[session_id] = self.session_type(session_id)
             elif self.session_type == RedisSession:
                 print(f"get_redis_env: {get_redis_env()}")
-                redis_client = Redis(**get_redis_env())
+                redis_client = MetricsRedis(**get_redis_env())
                 self.sessions[session_id] = self.session_type(
                     session_id, redis_client)
             else:
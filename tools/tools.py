@@ -1,8 +1,10 @@
 from langchain_core.messages import ToolMessage, AIMessage
 import json
+import time
 from dataclasses import dataclass
 from langchain_core.messages.base import BaseMessage
 from utils import log, LogLevel
+from utils.metrics import TOOL_EXECUTION
 from session import Session
 from typing import Optional
 from typing import Generator
@@ -264,6 +266,7 @@ class ToolExecutor:
                     tool_call["args"]["session_id"] = session.session_id
                     log(session.session_id, f"invoke tool_call: {tool_call}",
                         level=LogLevel.DEBUG)
+                    start = time.perf_counter()
                     tool_result = self.tools_by_name[tool_call["name"]].invoke(
                         tool_call["args"],
                     )
@@ -278,6 +281,8 @@ class ToolExecutor:
                     # If tool returns a generator, handle it in streaming mode
                     if isinstance(tool_result, Generator):
                         tool_result = yield from tool_result
+                        TOOL_EXECUTION.labels(tool_call["name"]).observe(
+                            time.perf_counter() - start)
                         log(session.session_id, f"yield from tool_result: {tool_result}",
                             level=LogLevel.DEBUG)
                         # If tool returns a generator, handle as stream data, llm no longer further processes tool results
@@ -289,6 +294,8 @@ class ToolExecutor:
                         ))
                         return [], []
 
+                    TOOL_EXECUTION.labels(tool_call["name"]).observe(
+                        time.perf_counter() - start)
                     tool_messages.append(
                         ToolMessage(
                             content=json.dumps(
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark user session listing over a Redis with simulated network latency
+
+Usage:
+python -m utils.bench_history --sessions 100 --latency-ms 1
+"""
+
+import argparse
+import time
+import uuid
+from redis import Redis
+from redis.client import Pipeline
+from env import get_redis_env
+from utils.history import HistoryManager
+
+
+class LatencyPipeline(Pipeline):
+    """Pipeline paying one simulated round trip per execute"""
+
+    def execute(self, raise_on_error: bool = True):
+        time.sleep(self.latency)
+        return super().execute(raise_on_error)
+
+
+class LatencyRedis(Redis):
+    """Redis client paying a simulated round trip per command"""
+
+    def __init__(self, latency: float, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    def execute_command(self, *args, **options):
+        time.sleep(self.latency)
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        pipe = LatencyPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.latency = self.latency
+        return pipe
+
+
+def list_sessions_n_plus_one(history_manager: HistoryManager, user_id: str, limit: int) -> list:
+    """Previous listing: one HGETALL per session"""
+    sessions = []
+    for session_id in history_manager.get_user_sessions(user_id, limit):
+        meta = history_manager.get_session_meta(session_id, use_cache=False)
+        sessions.append({"session_id": session_id, "title": meta.get("title")})
+    return sessions
+
+
+def list_sessions_pipelined(history_manager: HistoryManager, user_id: str, limit: int) -> list:
+    """Pipelined listing with a cold cache"""
+    history_manager._meta_cache.clear()
+    return history_manager.get_user_sessions_with_meta(user_id, limit)
+
+
+def timed(func, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark user session listing')
+    parser.add_argument('--sessions', type=int, default=100,
+                        help='Sessions per user')
+    parser.add_argument('--latency-ms', type=float, default=1.0,
+                        help='Simulated round trip latency')
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='Rounds per measurement')
+    args = parser.parse_args()
+
+    redis_client = LatencyRedis(args.latency_ms / 1000, **get_redis_env())
+    history_manager = HistoryManager(redis_client)
+    user_id = f"bench_{uuid.uuid4()}"
+    session_ids = [f"bench_{uuid.uuid4()}" for _ in range(args.sessions)]
+
+    for session_id in session_ids:
+        history_manager.add_user_session(
+            user_id, session_id, max_sessions=args.sessions)
+        history_manager.save_session_meta(
+            session_id, title=f"Title {session_id[:8]}", user_id=user_id)
+
+    try:
+        n_plus_one = timed(lambda: list_sessions_n_plus_one(
+            history_manager, user_id, args.sessions), args.rounds)
+        pipelined = timed(lambda: list_sessions_pipelined(
+            history_manager, user_id, args.sessions), args.rounds)
+        cached = timed(lambda: history_manager.get_user_sessions_with_meta(
+            user_id, args.sessions), args.rounds)
+
+        print(
+            f"{args.sessions} sessions, {args.latency_ms}ms simulated latency, {args.rounds} rounds")
+        print(f"  N+1 HGETALL:       {n_plus_one:8.2f} ms")
+        print(f"  pipelined:         {pipelined:8.2f} ms")
+        print(f"  pipelined + cache: {cached:8.2f} ms")
+    finally:
+        history_manager.clear_user_sessions(user_id)
+        for session_id in session_ids:
+            history_manager.delete_session_meta(session_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import json
+import re
+from typing import Dict, List, Optional
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage, ToolMessage
+from env import CHAPTER_MEMORY_TAIL, CHAPTER_MEMORY_FIELD_CHARS, CRITIC_FEEDBACK_CHUNKS
+from utils.index_store import IndexStore, redis_client
+from utils.key_registry import key_registry
+
+# Tool writing chunks, its calls carry the full chunk text
+CHUNK_TOOL = "prompt_chunk_content"
+
+_SENTENCE_END = re.compile(r"(?<=[。！？!?.…])\s*")
+
+
+def _clip(text: str, limit: int = CHAPTER_MEMORY_FIELD_CHARS) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def extract_beats(content: str) -> str:
+    """Fallback plot beats of a chunk without a summary: its opening and closing sentences"""
+    sentences = [s for s in _SENTENCE_END.split(content.strip()) if s.strip()]
+    if len(sentences) <= 2:
+        return _clip(content)
+    half = CHAPTER_MEMORY_FIELD_CHARS // 2
+    return f"{_clip(sentences[0], half)} … {_clip(sentences[-1], half)}"
+
+
+class ChapterMemory:
+    """
+    Short structured summary of each chunk (plot beats, character states) stored next to the chunks.
+    The main agent's prompt carries these summaries and the tail of the last chunk instead of the full text
+    of every previous chunk, so the input of each step stays about the same size as the novel grows.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.index_store = IndexStore(session_id)
+        # chunk -> JSON {"beats", "characters"}
+        self.key = f"is:{session_id}:n:"
+        # chunk -> JSON {"version": chunk version reviewed, "feedback"} of the critic
+        self.feedback_key = f"is:{session_id}:f:"
+
+    def set(self, chunk_index: int, beats: str, characters: Optional[str] = None):
+        key_registry.register(self.session_id, self.key)
+        summary = {"beats": _clip(beats), "characters": _clip(characters or "")}
+        redis_client.hset(self.key, chunk_index, json.dumps(summary, ensure_ascii=False))
+
+    def remember(self, chunk_index: int, content: str, beats: Optional[str] = None,
+                 characters: Optional[str] = None):
+        """Store the summary of a written chunk, plot beats are taken from the text when not given"""
+        self.set(chunk_index, beats or extract_beats(content), characters)
+
+    def delete(self, chunk_index: int):
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hdel(self.key, chunk_index)
+        pipe.hdel(self.feedback_key, chunk_index)
+        pipe.execute()
+
+    def summaries(self) -> Dict[int, dict]:
+        """Summaries of the chunks in the store, in chunk order"""
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrange(self.index_store.order_key, 0, -1)
+        pipe.hgetall(self.key)
+        order, summaries = pipe.execute()
+        summaries = {int(k): v for k, v in summaries.items()}
+        return {int(chunk): json.loads(summaries[int(chunk)])
+                for chunk in order if int(chunk) in summaries}
+
+    def set_feedback(self, chunk_index: int, chunk_version: int, feedback: str):
+        key_registry.register(self.session_id, self.feedback_key)
+        redis_client.hset(self.feedback_key, chunk_index, json.dumps(
+            {"version": int(chunk_version), "feedback": feedback}, ensure_ascii=False))
+
+    def feedback(self, chunk_index: int = None, limit: int = CRITIC_FEEDBACK_CHUNKS) -> Dict[int, str]:
+        """
+        Critic feedback of the current content of a chunk, or of the latest `limit` chunks.
+        Feedback on content that was rewritten since is left out.
+        """
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(self.feedback_key)
+        pipe.hgetall(self.index_store.chunk_versions_key)
+        reviews, versions = pipe.execute()
+        current = {}
+        for chunk, review in reviews.items():
+            review = json.loads(review)
+            if int(versions.get(chunk, 0)) == review["version"]:
+                current[int(chunk)] = review["feedback"]
+        if chunk_index is not None:
+            return {chunk_index: current[chunk_index]} if chunk_index in current else {}
+        return {chunk: current[chunk] for chunk in sorted(current)[-limit:]} if limit > 0 else {}
+
+    def render_feedback(self) -> str:
+        """Prompt section with the critic feedback of the latest chunks, empty without feedback"""
+        feedback = self.feedback()
+        if not feedback:
+            return ""
+        lines = ["# Critic feedback",
+                 "Reviews of the latest chunks, regenerate a chunk with prompt_chunk_content when its review "
+                 "asks for changes that matter, otherwise go on with the next chunk:"]
+        for chunk, text in feedback.items():
+            lines.append(f"## chunk {chunk}\n{text.strip()}")
+        return "\n".join(lines)
+
+    def render(self, summaries: Dict[int, dict] = None, tail_chars: int = CHAPTER_MEMORY_TAIL) -> str:
+        """Prompt section with every chunk summary and the tail of the last chunk, empty without chunks"""
+        summaries = self.summaries() if summaries is None else summaries
+        if not summaries:
+            return ""
+        lines = ["# Chapter memory",
+                 "Chunks already confirmed, their full text is stored and not repeated here:"]
+        for chunk, summary in summaries.items():
+            line = f"- chunk {chunk}: {summary['beats']}"
+            if summary.get("characters"):
+                line += f" | characters: {summary['characters']}"
+            lines.append(line)
+        last = max(summaries)
+        content = self.index_store.get(last)
+        if content is not None:
+            tail = content.decode('utf-8')[-tail_chars:]
+            lines += ["", f"End of chunk {last}, continue from here:", tail]
+        return "\n".join(lines)
+
+
+def _compact_call(tool_call: dict) -> dict:
+    args = dict(tool_call["args"])
+    content = args.get("content")
+    if isinstance(content, str):
+        args["content"] = f"[chunk {args.get('chunk_index')} stored, {len(content)} characters, see chapter memory]"
+    return {**tool_call, "args": args}
+
+
+def compact_history(session_id: str, history: List[BaseMessage]) -> List[BaseMessage]:
+    """
+    History sent to the main agent's LLM: chunk texts in earlier tool calls and tool results are replaced by
+    placeholders and the chapter memory is added to the system prompt. The session itself is not changed.
+    """
+    memory = ChapterMemory(session_id)
+    summaries = memory.summaries()
+    stored = set(summaries)
+    if not stored:
+        return history
+    compacted: List[BaseMessage] = []
+    # tool call id -> chunk, tool results are named after the call's reason rather than the tool
+    chunk_calls: Dict[str, int] = {}
+    for message in history:
+        if isinstance(message, AIMessage) and message.tool_calls:
+            calls = []
+            for call in message.tool_calls:
+                if call["name"] == CHUNK_TOOL and call["args"].get("chunk_index") in stored:
+                    chunk_calls[call["id"]] = call["args"]["chunk_index"]
+                    call = _compact_call(call)
+                calls.append(call)
+            message = message.model_copy(update={"tool_calls": calls})
+        elif isinstance(message, ToolMessage) and message.tool_call_id in chunk_calls:
+            # Results written before the memory existed echoed the chunk text
+            message = message.model_copy(update={"content": json.dumps(
+                f"Confirmed chunk_index: {chunk_calls[message.tool_call_id]}", ensure_ascii=False)})
+        compacted.append(message)
+
+    section = "\n\n".join(
+        part for part in (memory.render(summaries), memory.render_feedback()) if part)
+    if compacted and isinstance(compacted[0], SystemMessage):
+        compacted[0] = compacted[0].model_copy(
+            update={"content": f"{compacted[0].content}\n\n{section}"})
+    else:
+        compacted.insert(0, SystemMessage(content=section))
+    return compacted
@@ -0,0 +1,134 @@
+import re
+import threading
+from enum import StrEnum
+from typing import Dict, List, Optional, Tuple
+from env import (CRITIC_GATE_MIN_WORDS, CRITIC_GATE_NGRAM, CRITIC_GATE_REVIEW_REPETITION,
+                 CRITIC_GATE_REGENERATE_REPETITION, CRITIC_GATE_MIN_DIALOGUE, CRITIC_GATE_MAX_DIALOGUE,
+                 CRITIC_GATE_MIN_SCRIPT)
+from utils.index_store import text_counts
+from utils.metrics import CRITIC_GATE
+from utils.search_index import CJK_CHAR
+
+_CJK = re.compile(CJK_CHAR)
+_LATIN = re.compile(r"[A-Za-zÀ-ɏ]")
+_DIALOGUE = re.compile(r"“[^”]*”|「[^」]*」|『[^』]*』|\"[^\"]*\"")
+
+# Script expected for a story language, matched on the language name given to set_story_language
+_LANGUAGE_SCRIPTS = {
+    "cjk": ("chinese", "mandarin", "cantonese", "japanese", "korean", "中文", "汉语", "漢語", "日本語",
+            "日语", "韩语", "한국어", "zh", "ja", "ko"),
+    "latin": ("english", "french", "spanish", "german", "italian", "portuguese", "dutch", "英文", "英语",
+              "en", "fr", "es", "de", "it", "pt"),
+}
+
+
+def expected_script(language: Optional[str]) -> Optional[str]:
+    """"cjk" or "latin" for a story language, None when it is unknown"""
+    if not language:
+        return None
+    words = set(re.split(r"[\s,/()_-]+", language.lower()))
+    for script, names in _LANGUAGE_SCRIPTS.items():
+        if any(name in words or (len(name) > 2 and name in language.lower()) for name in names):
+            return script
+    return None
+
+
+def analyze_chunk(text: str, ngram: int = CRITIC_GATE_NGRAM) -> Dict[str, float]:
+    """Length, repetition (share of repeated character n-grams), dialogue share and script shares of a chunk"""
+    words, chars = text_counts(text)
+    compact = "".join(text.split())
+    grams = [compact[i:i + ngram] for i in range(max(0, len(compact) - ngram + 1))]
+    repetition = 1 - len(set(grams)) / len(grams) if grams else 0.0
+    dialogue = sum(len("".join(m.group(0).split())) for m in _DIALOGUE.finditer(text))
+    cjk, latin = len(_CJK.findall(text)), len(_LATIN.findall(text))
+    return {
+        "words": words,
+        "chars": chars,
+        "repetition": round(repetition, 4),
+        "dialogue": round(dialogue / chars, 4) if chars else 0.0,
+        "cjk": round(cjk / (cjk + latin), 4) if cjk + latin else 0.0,
+        "latin": round(latin / (cjk + latin), 4) if cjk + latin else 0.0,
+    }
+
+
+class GateDecision(StrEnum):
+    SKIP = "skip"  # passes every check, no critic review
+    REVIEW = "review"  # borderline, the critic reviews it
+    REGENERATE = "regenerate"  # obviously broken, regenerated without a review
+
+
+class CriticGate:
+    """
+    Cheap local checks before the critic LLM: chunks that pass every check skip the review, borderline ones
+    are reviewed and obviously broken ones (too short, heavily repeated, wrong language) are sent back for
+    regeneration. Decisions are counted per process and in the critic_gate_decisions_total metric.
+    """
+
+    def __init__(self, min_words: int = CRITIC_GATE_MIN_WORDS,
+                 review_repetition: float = CRITIC_GATE_REVIEW_REPETITION,
+                 regenerate_repetition: float = CRITIC_GATE_REGENERATE_REPETITION,
+                 dialogue_range: Tuple[float, float] = (CRITIC_GATE_MIN_DIALOGUE, CRITIC_GATE_MAX_DIALOGUE),
+                 min_script: float = CRITIC_GATE_MIN_SCRIPT):
+        self.min_words = min_words
+        self.review_repetition = review_repetition
+        self.regenerate_repetition = regenerate_repetition
+        self.dialogue_range = dialogue_range
+        self.min_script = min_script
+        self._lock = threading.Lock()
+        self._stats = {decision.value: 0 for decision in GateDecision}
+
+    def decide(self, analysis: Dict[str, float], language: Optional[str] = None) -> Tuple[GateDecision, List[str]]:
+        """Decision on an analyzed chunk and the reasons for it"""
+        regenerate, review = [], []
+        if analysis["words"] < self.min_words:
+            regenerate.append("too_short")
+        if analysis["repetition"] > self.regenerate_repetition:
+            regenerate.append("repetition")
+        elif analysis["repetition"] > self.review_repetition:
+            review.append("repetition")
+        script = expected_script(language)
+        if script and analysis["cjk"] + analysis["latin"] and analysis[script] < self.min_script:
+            regenerate.append("language")
+        low, high = self.dialogue_range
+        if not low <= analysis["dialogue"] <= high:
+            review.append("dialogue")
+        if regenerate:
+            return GateDecision.REGENERATE, regenerate
+        if review:
+            return GateDecision.REVIEW, review
+        return GateDecision.SKIP, []
+
+    def check(self, text: str, language: Optional[str] = None) -> Tuple[GateDecision, List[str], Dict[str, float]]:
+        """Analyze a chunk, decide and record the decision"""
+        analysis = analyze_chunk(text)
+        decision, reasons = self.decide(analysis, language)
+        with self._lock:
+            self._stats[decision.value] += 1
+        for reason in reasons or ["passed"]:
+            CRITIC_GATE.labels(decision.value, reason).inc()
+        return decision, reasons, analysis
+
+    def get_stats(self) -> dict:
+        """Decisions of this process, and the share of chunks the critic did not have to review"""
+        with self._lock:
+            stats = dict(self._stats)
+        total = sum(stats.values())
+        stats["critic_calls_saved"] = round(
+            (total - stats[GateDecision.REVIEW.value]) / total, 4) if total else 0.0
+        return stats
+
+
+def gate_feedback(decision: GateDecision, reasons: List[str], analysis: Dict[str, float]) -> Optional[str]:
+    """Feedback given instead of a critic review, None when the critic should review the chunk"""
+    measures = (f"{analysis['words']} words, repetition {analysis['repetition']:.0%}, "
+                f"dialogue {analysis['dialogue']:.0%}")
+    if decision == GateDecision.SKIP:
+        return f"The chunk passed the automatic checks ({measures}), no critic review was needed. Go on with the next chunk."
+    if decision == GateDecision.REGENERATE:
+        return (f"The chunk failed the automatic checks: {', '.join(reasons)} ({measures}). "
+                f"Regenerate this chunk with prompt_chunk_content.")
+    return None
+
+
+# Global critic gate instance
+critic_gate = CriticGate()
@@ -1,96 +1,532 @@
-from typing import List
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
 from redis import Redis
-from env import get_redis_env
+from redis.exceptions import ResponseError, WatchError
+from utils.metrics import MetricsRedis
+from concurrent.futures import ThreadPoolExecutor
+from env import get_redis_env, SESSION_META_CACHE_TTL, SESSION_META_CACHE_SIZE, HISTORY_COMPRESS_THRESHOLD, \
+    TITLE_DEADLINE, TITLE_RESPONSE_CHARS, TITLE_RESPONSE_WAIT, TITLE_WORKERS
 import json
 from datetime import datetime
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
+from utils.llm_scheduler import llm_scheduler, Priority
+from utils.search_index import SessionSearchIndex
+from utils.key_registry import key_registry
+from utils.read_router import ReadRouter
+
+# Convert a legacy user session list (newest first) into a sorted set scored by activity, in place
+_MIGRATE_USER_SESSIONS_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'list' then
+    return -1
+end
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+local now = tonumber(ARGV[1])
+for i, session_id in ipairs(items) do
+    redis.call('ZADD', KEYS[1], 'NX', now - i * 0.001, session_id)
+end
+return #items
+"""
+
+# Version of the compact interaction record, legacy records store the raw SSE frames
+HISTORY_RECORD_VERSION = 2
+# Marker of zlib compressed records, JSON records always start with '{'
+_COMPRESSED_PREFIX = b"z:"
+# Order of events recorded at the same text offset when frames are rebuilt
+_EVENT_ORDER = {"tool_message": 0, "tool_call": 1, "error": 2}
+
+
+def compact_responses(frames: List[str]) -> dict:
+    """
+    Normalize the SSE frames of one interaction: assistant deltas are merged into a single
+    text, tool results, confirmation requests and errors are kept with the text offset they followed
+    """
+    text_parts = []
+    length = 0
+    tool_events, confirmations, errors = [], [], []
+    for frame in frames:
+        event, _, payload = frame.partition(": ")
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            print(f"Skipping malformed history frame: {frame[:50]}")
+            continue
+        if event == "data":
+            if data.get("type") == "error":
+                errors.append({"offset": length, **data})
+            elif data.get("type") == "retry":
+                # The aborted attempt's text is streamed again by the retry
+                text = "".join(text_parts)[:max(0, length - data.get("discard", 0))]
+                text_parts, length = [text], len(text)
+            else:
+                content = data.get("content") or ""
+                text_parts.append(content)
+                length += len(content)
+        elif event == "tool_message":
+            # The retry path sends the whole serialized message
+            tool_events.append(
+                {"offset": length, "message": data.get("kwargs", data)})
+        elif event == "tool_call":
+            confirmations.append({"offset": length, "tool_calls": data})
+
+    return {
+        "text": "".join(text_parts),
+        "tool_events": tool_events,
+        "confirmations": confirmations,
+        "errors": errors
+    }
+
+
+def expand_responses(record: dict) -> List[str]:
+    """Rebuild SSE frames from a compact record, text between events is sent as one frame"""
+    text = record.get("text", "")
+    events = [("tool_message", e["offset"], e["message"]) for e in record.get("tool_events", [])] + \
+        [("tool_call", e["offset"], e["tool_calls"]) for e in record.get("confirmations", [])] + \
+        [("error", e["offset"], {k: v for k, v in e.items() if k != "offset"})
+         for e in record.get("errors", [])]
+    events.sort(key=lambda e: (e[1], _EVENT_ORDER[e[0]]))
+
+    frames = []
+    position = 0
+    for event, offset, data in events:
+        if offset > position:
+            frames.append(
+                f"data: {json.dumps({'content': text[position:offset]}, ensure_ascii=False)}\n\n")
+            position = offset
+        event = "data" if event == "error" else event
+        frames.append(f"{event}: {json.dumps(data, ensure_ascii=False)}\n\n")
+    if position < len(text):
+        frames.append(
+            f"data: {json.dumps({'content': text[position:]}, ensure_ascii=False)}\n\n")
+    return frames
+
+
+def encode_interaction(user_input: str, responses: dict, timestamp: str = None) -> bytes:
+    """Serialize a compacted interaction, compressed above the size threshold"""
+    record = {
+        "v": HISTORY_RECORD_VERSION,
+        "user_input": user_input,
+        **responses,
+        "timestamp": timestamp or datetime.now().isoformat()
+    }
+    # Empty event lists are left out
+    record = {k: v for k, v in record.items() if v != []}
+    data = json.dumps(record, ensure_ascii=False,
+                      separators=(",", ":")).encode('utf-8')
+    if 0 < HISTORY_COMPRESS_THRESHOLD < len(data):
+        return _COMPRESSED_PREFIX + zlib.compress(data)
+    return data
+
+
+def decode_interaction(item: bytes, fields: Optional[List[str]] = None) -> dict:
+    """
+    Parse a stored interaction of either format into the history API shape.
+    With fields only those are returned, frames are not rebuilt unless agent_responses is requested.
+    """
+    if item.startswith(_COMPRESSED_PREFIX):
+        item = zlib.decompress(item[len(_COMPRESSED_PREFIX):])
+    data = json.loads(item.decode('utf-8'))
+    if data.get("v") != HISTORY_RECORD_VERSION:
+        # Legacy record, agent_responses holds the raw frames
+        return project_interaction({**data, **compact_responses(data.get("agent_responses", []))}, fields)
+
+    return project_interaction({
+        "user_input": data.get("user_input", ""),
+        "agent_responses": expand_responses(data) if not fields or "agent_responses" in fields else None,
+        "text": data.get("text", ""),
+        "tool_events": data.get("tool_events", []),
+        "confirmations": data.get("confirmations", []),
+        "errors": data.get("errors", []),
+        "timestamp": data.get("timestamp")
+    }, fields)
+
+
+# Stamp a version key with the next value of a global sequence, versions never repeat even after a key is deleted
+_STAMP_VERSION_SCRIPT = """
+local version = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], version)
+return version
+"""
+
+
+# Set a title only if the session has none (ARGV[3] empty) or its title has the expected source, so a
+# fallback never replaces a title and a generated title never replaces the user's. Returns the old
+# title ('' if none) when written, nil when the condition failed
+_SET_TITLE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'title')
+if ARGV[3] == '' then
+    if current then
+        return nil
+    end
+elseif redis.call('HGET', KEYS[1], 'title_source') ~= ARGV[3] then
+    return nil
+end
+redis.call('HSET', KEYS[1], 'title', ARGV[1], 'title_source', ARGV[2], 'updated_at', ARGV[4])
+redis.call('HSETNX', KEYS[1], 'created_at', ARGV[4])
+if ARGV[5] ~= '' then
+    redis.call('HSET', KEYS[1], 'user_id', ARGV[5])
+end
+return current or ''
+"""
+
 
-quick_llm = ChatOpenAI(model="qwen-turbo-latest",
+def project_interaction(interaction: dict, fields: Optional[List[str]]) -> dict:
+    """Keep only the requested fields of an interaction, the index is always kept"""
+    if not fields:
+        return interaction
+    return {k: v for k, v in interaction.items() if k in fields or k == "index"}
+
+
+# Title generation is bounded by a deadline and has a fallback, so it is never retried
+quick_llm = ChatOpenAI(model="qwen-turbo-latest", max_retries=0,
                        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1", extra_body={"enable_thinking": False})
+_title_executor = ThreadPoolExecutor(
+    max_workers=TITLE_WORKERS, thread_name_prefix="title")
+
+
+class TitleSource:
+    FALLBACK = "fallback"  # derived from the user input while the title is generated
+    GENERATED = "generated"
+    USER = "user"
+
+
+def fallback_title(user_input: str) -> str:
+    """Immediate title of a new session: the start of the user input"""
+    text = " ".join((user_input or "").split())
+    if not text:
+        return f"Conversation {datetime.now().strftime('%m-%d %H:%M')}"
+    return text if len(text) <= 20 else text[:17] + "..."
+
+
+class TitleDraft:
+    """
+    Start of the first response collected from a running stream for title generation,
+    ready once enough text arrived or the stream ended
+    """
+
+    def __init__(self, max_chars: int = TITLE_RESPONSE_CHARS):
+        self.max_chars = max_chars
+        self._parts: List[str] = []
+        self._length = 0
+        self._ready = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._ready.is_set()
+
+    def feed(self, text: str):
+        if self._ready.is_set() or not text:
+            return
+        self._parts.append(text)
+        self._length += len(text)
+        if self._length >= self.max_chars:
+            self._ready.set()
+
+    def close(self):
+        self._ready.set()
+
+    def wait(self, timeout: float) -> str:
+        self._ready.wait(max(0.0, timeout))
+        return "".join(self._parts)[:self.max_chars]
 
 
 class HistoryManager:
     """History record manager"""
 
-    def __init__(self, redis_client: Redis = None):
-        self.redis = redis_client or Redis(**get_redis_env())
+    def __init__(self, redis_client: Redis = None, replicas: Optional[List[Redis]] = None):
+        self.redis = redis_client or MetricsRedis(**get_redis_env())
+        # Read-only calls go to the configured replicas
+        self.router = ReadRouter(self.redis, replicas)
         self.history_prefix = "session_history:"
-        self.user_sessions_prefix = "user_sessions:"  # New: user session list prefix
+        # User session index: sorted set of session ids scored by last activity timestamp
+        self.user_sessions_prefix = "user_sessions:"
         self.session_meta_prefix = "session_meta:"  # New: session metadata prefix
+        # Versions of a session's history and of a user's session list, used as ETags
+        self.history_version_prefix = "history_version:"
+        self.user_sessions_version_prefix = "user_sessions_version:"
+        self.version_seq_key = "version_seq"
+        self._stamp_version = self.redis.register_script(
+            _STAMP_VERSION_SCRIPT)
+        self._set_title_script = self.redis.register_script(_SET_TITLE_SCRIPT)
+        # Short-lived per-process metadata cache: session_id -> (expires_at, meta)
+        self._meta_cache: Dict[str, Tuple[float, dict]] = {}
+        self._meta_cache_lock = threading.Lock()
+        self.search_index = SessionSearchIndex(self.redis)
 
     def save_interaction(self, session_id: str, user_input: str, agent_responses: List[str], user_id: str = None):
-        """Save a complete interaction (user input + agent response)"""
-        interaction_data = {
-            "user_input": user_input,
-            "agent_responses": agent_responses,
-            "timestamp": datetime.now().isoformat()
-        }
-
+        """Save a complete interaction (user input + agent response frames) in the compact form"""
+        responses = compact_responses(agent_responses)
         history_key = f"{self.history_prefix}{session_id}"
-        self.redis.rpush(history_key, json.dumps(interaction_data))
+        key_registry.register(session_id, history_key,
+                              f"{self.history_version_prefix}{session_id}")
+        pipe = self.redis.pipeline()
+        pipe.rpush(history_key, encode_interaction(user_input, responses))
+        self._bump_history_version(session_id, pipe)
+        self.router.note_write(
+            f"{self.history_version_prefix}{session_id}", pipe.execute()[-1])
+        try:
+            self.search_index.index_text(
+                session_id, [user_input, responses["text"]])
+        except Exception as e:
+            print(f"Failed to index interaction of session {session_id}: {e}")
 
         # If user_id is provided, update the position of this session in user session list (move to front)
         if user_id:
             self.add_user_session(user_id, session_id)
 
-            # Check if session has title, generate if not
-            if not self.get_session_title(session_id):
-                self._generate_and_save_title(
-                    session_id, user_input, agent_responses, user_id)
+            # Title sessions that did not get a speculative title when the stream started
+            self.start_title_generation(
+                session_id, user_input, user_id, response_text=responses["text"])
+
+    def _bump_history_version(self, session_id: str, pipe=None):
+        """Stamp a new history version, queued on `pipe` if given, the caller then records the write"""
+        version_key = f"{self.history_version_prefix}{session_id}"
+        version = self._stamp_version(
+            keys=[version_key, self.version_seq_key], client=pipe or self.redis)
+        if pipe is None:
+            self.router.note_write(version_key, version)
+
+    def bump_user_sessions_version(self, user_id: str, pipe=None):
+        """Mark a user's session list as changed, queued on `pipe` if given, the caller then records the write"""
+        if user_id:
+            version_key = f"{self.user_sessions_version_prefix}{user_id}"
+            version = self._stamp_version(
+                keys=[version_key, self.version_seq_key], client=pipe or self.redis)
+            if pipe is None:
+                self.router.note_write(version_key, version)
+
+    def get_history_version(self, session_id: str) -> str:
+        """Version of a session's history, changes on every write"""
+        version_key = f"{self.history_version_prefix}{session_id}"
+        version = self.router.read(
+            lambda client: client.get(version_key), version_key, lambda version: version)
+        return version.decode('utf-8') if version else "0"
+
+    def get_user_sessions_version(self, user_id: str) -> str:
+        """Version of a user's session list and the metadata of its sessions"""
+        version_key = f"{self.user_sessions_version_prefix}{user_id}"
+        version = self.router.read(
+            lambda client: client.get(version_key), version_key, lambda version: version)
+        return version.decode('utf-8') if version else "0"
+
+    def get_session_history_page(self, session_id: str, limit: int = 50, before: Optional[int] = None,
+                                 after: Optional[int] = None, fields: Optional[List[str]] = None) -> dict:
+        """
+        Get a page of history by list index. Without a cursor the latest `limit` interactions are returned,
+        `before` pages towards older interactions and `after` towards newer ones. Each item carries its index
+        and the page reports the cursors of its neighbours, history is append-only so indexes are stable.
+        """
+        if limit < 0 or (before is not None and before < 0) or (after is not None and after < 0):
+            raise ValueError("limit, before and after cannot be negative")
+        history_key = f"{self.history_prefix}{session_id}"
+        if after is not None:
+            start, end = after + 1, after + limit
+        elif before is not None:
+            start, end = max(0, before - limit), before - 1
+        else:
+            start, end = None, None
+        # Negative LRANGE ends count from the tail, an empty page must not turn into the whole list
+        empty = limit == 0 or (start is not None and end < start)
+
+        version_key = f"{self.history_version_prefix}{session_id}"
+
+        def fetch(client: Redis):
+            pipe = client.pipeline()
+            pipe.llen(history_key)
+            pipe.get(version_key)
+            if empty:
+                return pipe.execute() + [[]]
+            if start is not None:
+                pipe.lrange(history_key, start, end)
+            else:
+                pipe.lrange(history_key, -limit, -1)
+            return pipe.execute()
+
+        total, version, results = self.router.read(
+            fetch, version_key, lambda result: result[1])
+        if start is None:
+            start = max(0, total - limit)
+
+        history = []
+        for index, item in enumerate(results, start):
+            try:
+                history.append(
+                    {"index": index, **decode_interaction(item, fields)})
+            except Exception as e:
+                print(f"Failed to parse history item: {e}")
+
+        last = start + len(results) - 1
+        return {
+            "history": history,
+            "total": total,
+            "version": version.decode('utf-8') if version else "0",
+            "before": start if results and start > 0 else None,
+            "after": last if results and last < total - 1 else None
+        }
 
     def get_session_history(self, session_id: str, limit: int = 50) -> List[dict]:
         """Get session history records"""
         history_key = f"{self.history_prefix}{session_id}"
-        results = self.redis.lrange(history_key, -limit, -1)
+        version_key = f"{self.history_version_prefix}{session_id}"
+
+        def fetch(client: Redis):
+            pipe = client.pipeline()
+            pipe.lrange(history_key, -limit, -1)
+            pipe.get(version_key)
+            return pipe.execute()
+
+        results, _ = self.router.read(
+            fetch, version_key, lambda result: result[1])
 
         history = []
         for item in results:
             try:
-                data = json.loads(item.decode('utf-8'))
-                history.append(data)
+                history.append(decode_interaction(item))
             except Exception as e:
                 print(f"Failed to parse history item: {e}")
 
         return history
 
+    def migrate_history_key(self, history_key: str) -> int:
+        """Rewrite the legacy records of one history list in the compact form, returns the number converted"""
+        if isinstance(history_key, bytes):
+            history_key = history_key.decode('utf-8')
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(history_key)
+                    items = pipe.lrange(history_key, 0, -1)
+                    records = []
+                    converted = 0
+                    for item in items:
+                        data = None if item.startswith(
+                            _COMPRESSED_PREFIX) else json.loads(item.decode('utf-8'))
+                        if data is None or data.get("v") == HISTORY_RECORD_VERSION:
+                            records.append(item)
+                            continue
+                        records.append(encode_interaction(
+                            data.get("user_input", ""),
+                            compact_responses(data.get("agent_responses", [])),
+                            data.get("timestamp")))
+                        converted += 1
+                    if not converted:
+                        pipe.unwatch()
+                        return 0
+                    ttl = pipe.pttl(history_key)
+                    pipe.multi()
+                    pipe.delete(history_key)
+                    pipe.rpush(history_key, *records)
+                    if ttl > 0:
+                        pipe.pexpire(history_key, ttl)
+                    session_id = history_key[len(self.history_prefix):]
+                    self._bump_history_version(session_id, pipe)
+                    self.router.note_write(
+                        f"{self.history_version_prefix}{session_id}", pipe.execute()[-1])
+                    return converted
+                except WatchError:
+                    # A new interaction was appended meanwhile, convert again
+                    continue
+
+    def migrate_history(self) -> int:
+        """One-off conversion of all stored interactions into the compact form"""
+        converted = 0
+        for history_key in self.redis.scan_iter(match=f"{self.history_prefix}*", _type="list"):
+            converted += self.migrate_history_key(history_key)
+        return converted
+
     def clear_session_history(self, session_id: str) -> bool:
         """Clear session history records and metadata"""
         history_key = f"{self.history_prefix}{session_id}"
-        history_deleted = self.redis.delete(history_key) > 0
-
-        # Also delete metadata
+        version_key = f"{self.history_version_prefix}{session_id}"
+        # The version goes with the history, versions come from a global sequence so a cleared
+        # session ("0") and a refilled one never match an ETag of the old history
+        pipe = self.redis.pipeline()
+        pipe.delete(history_key)
+        pipe.delete(version_key)
+        history_deleted = pipe.execute()[0] > 0
+        self.router.note_write(version_key)
+
+        # Also delete metadata and search index entries
         self.delete_session_meta(session_id)
+        self.search_index.remove_session(session_id)
 
         return history_deleted
 
+    def _user_sessions_call(self, user_sessions_key: str, func: Callable):
+        """Run a command on the user session index, migrating a legacy list index on WRONGTYPE"""
+        try:
+            return func()
+        except ResponseError as e:
+            if "WRONGTYPE" not in str(e):
+                raise
+            self.migrate_user_sessions_key(user_sessions_key)
+            return func()
+
+    def migrate_user_sessions_key(self, user_sessions_key: str) -> int:
+        """Convert one legacy user_sessions list into a sorted set, returns migrated count or -1"""
+        return self.redis.eval(_MIGRATE_USER_SESSIONS_SCRIPT, 1, user_sessions_key, time.time())
+
+    def migrate_user_sessions(self) -> int:
+        """Convert all legacy user_sessions lists into sorted sets, returns the number of keys migrated"""
+        migrated = 0
+        for key in self.redis.scan_iter(match=f"{self.user_sessions_prefix}*", _type="list"):
+            if self.migrate_user_sessions_key(key) >= 0:
+                migrated += 1
+        return migrated
+
     def add_user_session(self, user_id: str, session_id: str, max_sessions: int = 20):
-        """Add session ID to user's session list, maintain the most recent max_sessions sessions"""
+        """Add session ID to user's session index, maintain the most recent max_sessions sessions"""
         if not user_id or not session_id:
             return
 
         user_sessions_key = f"{self.user_sessions_prefix}{user_id}"
 
-        # Check if session ID already exists and its position
-        existing_sessions = self.redis.lrange(user_sessions_key, 0, -1)
-        existing_sessions_str = [s.decode('utf-8') for s in existing_sessions]
+        def touch():
+            # Score by activity and drop the oldest beyond max_sessions, one round trip
+            pipe = self.redis.pipeline()
+            pipe.zadd(user_sessions_key, {session_id: time.time()})
+            pipe.zremrangebyrank(user_sessions_key, 0, -(max_sessions + 1))
+            self.bump_user_sessions_version(user_id, pipe)
+            self.router.note_write(
+                f"{self.user_sessions_version_prefix}{user_id}", pipe.execute()[-1])
 
-        if existing_sessions_str and existing_sessions_str[0] == session_id:
-            # If session is already at the front, no operation needed
-            return
+        self._user_sessions_call(user_sessions_key, touch)
 
-        if session_id in existing_sessions_str:
-            # If session exists but not at front, remove it first (will be added to front later)
-            self.redis.lrem(user_sessions_key, 0, session_id)
+    def _read_user_sessions(self, user_id: str, queue: Callable):
+        """Read the user session index on a replica, checked against this process' writes by its version"""
+        user_sessions_key = f"{self.user_sessions_prefix}{user_id}"
+        version_key = f"{self.user_sessions_version_prefix}{user_id}"
+
+        def fetch(client: Redis):
+            pipe = client.pipeline(transaction=False)
+            queue(pipe)
+            pipe.get(version_key)
+            return pipe.execute()
+
+        results, _ = self._user_sessions_call(user_sessions_key, lambda: self.router.read(
+            fetch, version_key, lambda result: result[1]))
+        return results
+
+    def get_user_sessions_page(self, user_id: str, limit: int = 100, cursor: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+        """
+        Get a page of user session IDs sorted from newest to oldest.
+        cursor is the next_cursor of the previous page, it is the last activity score so pages
+        stay stable while new sessions are added. next_cursor is None on the last page.
+        """
+        if not user_id or limit <= 0:
+            return [], None
 
-        # Add session to the front of the list (newest)
-        self.redis.lpush(user_sessions_key, session_id)
+        user_sessions_key = f"{self.user_sessions_prefix}{user_id}"
+        max_score = f"({cursor}" if cursor else "+inf"
+        results = self._read_user_sessions(user_id, lambda pipe: pipe.zrevrangebyscore(
+            user_sessions_key, max_score, "-inf", start=0, num=limit, withscores=True))
 
-        # Keep list length not exceeding max_sessions, delete oldest sessions
-        current_length = self.redis.llen(user_sessions_key)
-        if current_length > max_sessions:
-            # Delete oldest sessions exceeding limit
-            self.redis.ltrim(user_sessions_key, 0, max_sessions - 1)
+        session_ids = [item.decode('utf-8') for item, _ in results]
+        next_cursor = repr(results[-1][1]) if len(results) == limit else None
+        return session_ids, next_cursor
 
     def get_user_sessions(self, user_id: str, limit: int = 100) -> List[str]:
         """Get all user session ID list (sorted from newest to oldest)"""
@@ -98,18 +534,20 @@ class HistoryManager:
             return []
 
         user_sessions_key = f"{self.user_sessions_prefix}{user_id}"
-        # Get newest sessions from the beginning of the list (because we use lpush to add to front)
-        results = self.redis.lrange(user_sessions_key, 0, limit - 1)
+        results = self._read_user_sessions(
+            user_id, lambda pipe: pipe.zrevrange(user_sessions_key, 0, limit - 1))
 
         return [item.decode('utf-8') for item in results]
 
     def remove_user_session(self, user_id: str, session_id: str):
-        """Remove specified session ID from user session list and clean metadata"""
+        """Remove specified session ID from user session index and clean metadata"""
         if not user_id or not session_id:
             return
 
         user_sessions_key = f"{self.user_sessions_prefix}{user_id}"
-        self.redis.lrem(user_sessions_key, 0, session_id)
+        self._user_sessions_call(
+            user_sessions_key, lambda: self.redis.zrem(user_sessions_key, session_id))
+        self.bump_user_sessions_version(user_id)
 
         # Also delete session metadata
         self.delete_session_meta(session_id)
@@ -120,13 +558,39 @@ class HistoryManager:
             return False
 
         user_sessions_key = f"{self.user_sessions_prefix}{user_id}"
-        return self.redis.delete(user_sessions_key) > 0
-
-    def _generate_and_save_title(self, session_id: str, user_input: str, agent_responses: List[str], user_id: str):
-        """Generate and save session title based on conversation content"""
+        deleted = self.redis.delete(user_sessions_key) > 0
+        self.bump_user_sessions_version(user_id)
+        return deleted
+
+    def start_title_generation(self, session_id: str, user_input: str, user_id: str = None,
+                               draft: Optional['TitleDraft'] = None, response_text: str = None) -> bool:
+        """
+        Give a new session a title without delaying anything: a fallback title from the user input is
+        written right away and the generated title replaces it in the background once ready.
+        The response snippet comes from `draft`, fed by the running stream, or from `response_text`.
+        Returns False when the session already has a title.
+        """
+        if self.get_session_title(session_id):
+            return False
+        # Checked again atomically, a title written meanwhile (e.g. just generated) is kept
+        if not self._set_title_if(session_id, fallback_title(user_input), TitleSource.FALLBACK, user_id):
+            return False
+        deadline = time.monotonic() + TITLE_DEADLINE
+        _title_executor.submit(self._generate_and_save_title, session_id, user_input,
+                               draft, response_text, user_id, deadline)
+        return True
+
+    def _generate_and_save_title(self, session_id: str, user_input: str, draft: Optional['TitleDraft'],
+                                 response_text: Optional[str], user_id: str, deadline: float):
+        """Generate the session title from the user input and the start of the first response"""
         try:
+            if draft is not None:
+                response_text = draft.wait(
+                    min(TITLE_RESPONSE_WAIT, deadline - time.monotonic()))
+            response_text = (response_text or "")[:TITLE_RESPONSE_CHARS]
+
             # Build prompt for generating title
-            conversation_text = f"User: {user_input}\nAssistant: {' '.join(agent_responses)}"
+            conversation_text = f"User: {user_input[:TITLE_RESPONSE_CHARS * 2]}\nAssistant: {response_text}"
 
             title_prompt = f"""
 Please generate a concise conversation title (no more than 20 characters) based on the following conversation content:
@@ -146,35 +610,60 @@ Requirements:
                 HumanMessage(content=title_prompt)
             ]
 
-            # Call LLM to generate title
-            response = quick_llm.invoke(messages)
+            # Call LLM to generate title, lowest priority, the fallback title stays when shed or past the deadline
+            with llm_scheduler.acquire(user_id, Priority.TITLE,
+                                       timeout=max(0.0, deadline - time.monotonic())):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("title deadline exceeded")
+                response = quick_llm.invoke(messages, timeout=remaining)
             title = response.content.strip()
 
             # Ensure title length does not exceed limit
             if len(title) > 20:
                 title = title[:17] + "..."
 
-            # Save title
-            self.save_session_meta(session_id, title=title, user_id=user_id)
+            # Only replaces the fallback title, titles set meanwhile by the user are kept
+            if title:
+                self._set_title_if(session_id, title, TitleSource.GENERATED, user_id,
+                                   expected_source=TitleSource.FALLBACK)
 
         except Exception as e:
-            print(f"Error generating title for session {session_id}: {e}")
-            # If generation fails, use default title
-            default_title = f"Conversation {datetime.now().strftime('%m-%d %H:%M')}"
-            self.save_session_meta(
-                session_id, title=default_title, user_id=user_id)
-
-    def save_session_meta(self, session_id: str, title: str = None, user_id: str = None):
+            print(f"Error generating title for session {session_id}, keeping the fallback title: {e}")
+
+    def _set_title_if(self, session_id: str, title: str, title_source: str, user_id: str = None,
+                      expected_source: str = None) -> bool:
+        """
+        Write a title in one atomic check-and-set: only if the session has no title yet, or, given
+        expected_source, only if its current title came from that source. Returns whether it was written.
+        """
+        meta_key = f"{self.session_meta_prefix}{session_id}"
+        key_registry.register(session_id, meta_key)
+        old_title = self._set_title_script(
+            keys=[meta_key],
+            args=[title, title_source, expected_source or "", datetime.now().isoformat(), user_id or ""])
+        if old_title is None:
+            return False
+        old_title = old_title.decode('utf-8') or None
+        self._invalidate_meta(session_id)
+        self.router.note_write(meta_key)
+        self.bump_user_sessions_version(user_id)
+        if title != old_title:
+            self.search_index.index_title(session_id, old_title, title)
+        return True
+
+    def save_session_meta(self, session_id: str, title: str = None, user_id: str = None, title_source: str = None):
         """Save session metadata"""
         meta_key = f"{self.session_meta_prefix}{session_id}"
 
         # Get existing metadata
-        existing_meta = self.get_session_meta(session_id)
+        existing_meta = self.get_session_meta(session_id, use_cache=False)
 
         # Update metadata
         meta_data = {
             "title": title or existing_meta.get("title"),
             "user_id": user_id or existing_meta.get("user_id"),
+            "title_source": title_source or (TitleSource.USER if title else existing_meta.get("title_source")),
             "created_at": existing_meta.get("created_at") or datetime.now().isoformat(),
             "updated_at": datetime.now().isoformat()
         }
@@ -182,15 +671,79 @@ Requirements:
         # Remove None values
         meta_data = {k: v for k, v in meta_data.items() if v is not None}
 
-        self.redis.hset(meta_key, mapping=meta_data)
+        key_registry.register(session_id, meta_key)
+        pipe = self.redis.pipeline()
+        pipe.hset(meta_key, mapping=meta_data)
+        self.bump_user_sessions_version(meta_data.get("user_id"), pipe)
+        self._note_meta_write(session_id, meta_data.get("user_id"), pipe.execute())
+        if title and title != existing_meta.get("title"):
+            self.search_index.index_title(
+                session_id, existing_meta.get("title"), title)
+
+    def _note_meta_write(self, session_id: str, user_id: Optional[str], results: list):
+        """Record a metadata write that also bumped the user's session list version if user_id is set"""
+        self._invalidate_meta(session_id)
+        self.router.note_write(f"{self.session_meta_prefix}{session_id}")
+        if user_id:
+            self.router.note_write(
+                f"{self.user_sessions_version_prefix}{user_id}", results[-1])
 
-    def get_session_meta(self, session_id: str) -> dict:
+    def _cache_meta(self, session_id: str, meta: dict):
+        if SESSION_META_CACHE_TTL <= 0:
+            return
+        with self._meta_cache_lock:
+            self._meta_cache.pop(session_id, None)
+            self._meta_cache[session_id] = (
+                time.monotonic() + SESSION_META_CACHE_TTL, meta)
+            # Evict the oldest entries, dicts keep insertion order
+            while len(self._meta_cache) > SESSION_META_CACHE_SIZE:
+                self._meta_cache.pop(next(iter(self._meta_cache)))
+
+    def _invalidate_meta(self, session_id: str):
+        with self._meta_cache_lock:
+            self._meta_cache.pop(session_id, None)
+
+    def get_session_metas(self, session_ids: List[str], use_cache: bool = True) -> Dict[str, dict]:
+        """
+        Get metadata of many sessions, cache misses are fetched in one pipeline.
+        Cached reads are served by replicas, use_cache=False reads the primary for read-modify-write.
+        """
+        metas: Dict[str, dict] = {}
+        missing: List[str] = []
+        now = time.monotonic()
+        with self._meta_cache_lock:
+            for session_id in session_ids:
+                cached = self._meta_cache.get(
+                    session_id) if use_cache else None
+                if cached and cached[0] > now:
+                    metas[session_id] = dict(cached[1])
+                else:
+                    missing.append(session_id)
+
+        if missing:
+            meta_keys = [
+                f"{self.session_meta_prefix}{session_id}" for session_id in missing]
+
+            def fetch(client: Redis):
+                pipe = client.pipeline(transaction=False)
+                for meta_key in meta_keys:
+                    pipe.hgetall(meta_key)
+                return pipe.execute()
+
+            results = self.router.read(
+                fetch, meta_keys) if use_cache else fetch(self.redis)
+            for session_id, meta_data in zip(missing, results):
+                # Convert bytes to string
+                meta = {k.decode('utf-8'): v.decode('utf-8')
+                        for k, v in meta_data.items()}
+                self._cache_meta(session_id, meta)
+                metas[session_id] = dict(meta)
+
+        return metas
+
+    def get_session_meta(self, session_id: str, use_cache: bool = True) -> dict:
         """Get session metadata"""
-        meta_key = f"{self.session_meta_prefix}{session_id}"
-        meta_data = self.redis.hgetall(meta_key)
-
-        # Convert bytes to string
-        return {k.decode('utf-8'): v.decode('utf-8') for k, v in meta_data.items()}
+        return self.get_session_metas([session_id], use_cache)[session_id]
 
     def get_session_title(self, session_id: str) -> str:
         """Get session title"""
@@ -200,33 +753,98 @@ Requirements:
     def update_session_title(self, session_id: str, title: str):
         """Update session title"""
         meta_key = f"{self.session_meta_prefix}{session_id}"
-        self.redis.hset(meta_key, "title", title)
-        self.redis.hset(meta_key, "updated_at", datetime.now().isoformat())
+        old_meta = self.get_session_meta(session_id, use_cache=False)
+        old_title = old_meta.get("title")
+        pipe = self.redis.pipeline()
+        pipe.hset(meta_key, mapping={
+            "title": title,
+            "title_source": TitleSource.USER,
+            "updated_at": datetime.now().isoformat()
+        })
+        self.bump_user_sessions_version(old_meta.get("user_id"), pipe)
+        self._note_meta_write(session_id, old_meta.get("user_id"), pipe.execute())
+        if title != old_title:
+            self.search_index.index_title(session_id, old_title, title)
 
     def get_user_sessions_with_meta(self, user_id: str, limit: int = 100) -> List[dict]:
         """Get all user session ID list and their metadata (sorted from newest to oldest)"""
         if not user_id:
             return []
 
-        session_ids = self.get_user_sessions(user_id, limit)
+        return self._sessions_with_meta(self.get_user_sessions(user_id, limit))
+
+    def get_user_sessions_with_meta_page(self, user_id: str, limit: int = 100, cursor: Optional[str] = None,
+                                         fields: Optional[List[str]] = None) -> Tuple[List[dict], Optional[str]]:
+        """A page of get_user_sessions_with_meta, see get_user_sessions_page for the cursor"""
+        session_ids, next_cursor = self.get_user_sessions_page(
+            user_id, limit, cursor)
+        return self._sessions_with_meta(session_ids, fields), next_cursor
+
+    def _sessions_with_meta(self, session_ids: List[str], fields: Optional[List[str]] = None) -> List[dict]:
+        # Metadata is not fetched when only session ids are requested
+        metas = self.get_session_metas(session_ids) if not fields or set(fields) - {"session_id"} \
+            else {session_id: {} for session_id in session_ids}
         sessions_with_meta = []
 
         for session_id in session_ids:
-            meta = self.get_session_meta(session_id)
-            sessions_with_meta.append({
+            meta = metas[session_id]
+            session = {
                 "session_id": session_id,
                 "title": meta.get("title", f"Session {session_id[:8]}..."),
                 "user_id": meta.get("user_id"),
                 "created_at": meta.get("created_at"),
                 "updated_at": meta.get("updated_at")
-            })
+            }
+            if fields:
+                session = {k: v for k, v in session.items()
+                           if k in fields or k == "session_id"}
+            sessions_with_meta.append(session)
 
         return sessions_with_meta
 
+    def search_sessions(self, query: str, user_id: str = None, offset: int = 0, limit: int = 20) -> Tuple[List[dict], int]:
+        """Full-text search over session titles and history, best matches first. Returns (sessions, total)"""
+        if user_id:
+            # Scoped to the user's sessions by intersecting with the user index
+            scope_key = f"{self.user_sessions_prefix}{user_id}"
+            matches, total = self._user_sessions_call(
+                scope_key, lambda: self.search_index.search(query, offset, limit, scope_key))
+        else:
+            matches, total = self.search_index.search(query, offset, limit)
+        sessions = self._sessions_with_meta(
+            [session_id for session_id, _ in matches])
+        for session, (_, score) in zip(sessions, matches):
+            session["score"] = score
+        return sessions, total
+
+    def rebuild_search_index(self) -> int:
+        """Rebuild the search index from stored history and titles, returns the number of sessions indexed"""
+        self.search_index.clear()
+        session_ids = set()
+        for prefix in (self.history_prefix, self.session_meta_prefix):
+            for key in self.redis.scan_iter(match=f"{prefix}*", count=1000):
+                session_ids.add(key.decode('utf-8')[len(prefix):])
+
+        for session_id in session_ids:
+            texts = []
+            for item in self.redis.lrange(f"{self.history_prefix}{session_id}", 0, -1):
+                try:
+                    interaction = decode_interaction(item)
+                    texts.extend([interaction.get("user_input", ""),
+                                  interaction.get("text", "")])
+                except Exception as e:
+                    print(f"Failed to parse history item: {e}")
+            self.search_index.index_text(session_id, texts)
+            self.search_index.index_title(
+                session_id, None, self.get_session_meta(session_id, use_cache=False).get("title"))
+        return len(session_ids)
+
     def delete_session_meta(self, session_id: str):
         """Delete session metadata"""
         meta_key = f"{self.session_meta_prefix}{session_id}"
         self.redis.delete(meta_key)
+        self._invalidate_meta(session_id)
+        self.router.note_write(meta_key)
 
 
 # Global history manager instance
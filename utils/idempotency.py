@@ -0,0 +1,184 @@
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Generator, Optional
+from redis import Redis
+from utils.metrics import MetricsRedis
+from env import get_redis_env, IDEMPOTENCY_TTL, IDEMPOTENCY_LEASE_TTL
+from utils import log, LogLevel
+
+
+class RunStatus:
+    RUNNING = "running"
+    COMPLETED = "completed"
+
+
+# Claim a key that is free, or whose running owner stopped renewing its lease. Returns 1 if claimed
+_BEGIN_SCRIPT = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if status == 'running' and redis.call('EXISTS', KEYS[3]) == 0 then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    status = false
+end
+if status then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', 'running', 'session_id', ARGV[1], 'created_at', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SET', KEYS[3], '1', 'PX', ARGV[4])
+return 1
+"""
+
+# Frame sent to duplicates when the run they follow lost its owner
+_RUN_LOST_FRAME = "data: " + json.dumps({
+    "type": "error",
+    "code": "run_lost",
+    "content": "The original request stopped before finishing, please retry"
+}) + "\n\n"
+
+
+class IdempotentRun:
+    """
+    Event log writer of the request that owns an idempotency key.
+    Frames are buffered and flushed in small batches to keep Redis round trips off the token path.
+    """
+
+    def __init__(self, store: 'IdempotencyStore', key: str, flush_size: int = 20, flush_interval: float = 0.1):
+        self.store = store
+        self.key = key
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer: list[str] = []
+        self._last_flush = time.monotonic()
+        self._stop_event = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+
+    def start_heartbeat(self):
+        """Start a daemon thread renewing the run's lease every lease_ttl/3 until it completes"""
+        if self._heartbeat_thread is not None:
+            return
+        interval = self.store.lease_ttl_ms / 3000
+
+        def heartbeat():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.store.redis.pexpire(self.store.lease_key(self.key), self.store.lease_ttl_ms)
+                except Exception as e:
+                    log(self.key, f"idempotent run heartbeat error: {e}", LogLevel.ERROR)
+
+        self._heartbeat_thread = threading.Thread(
+            target=heartbeat, name=f"idempotent-run-{self.key}", daemon=True)
+        self._heartbeat_thread.start()
+
+    def append(self, frame: str):
+        self._buffer.append(frame)
+        if len(self._buffer) >= self.flush_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            # Keep the key alive for runs longer than the ttl
+            pipe = self.store.redis.pipeline()
+            pipe.rpush(self.store.events_key(self.key), *self._buffer)
+            pipe.expire(self.store.events_key(self.key), self.store.ttl)
+            pipe.expire(self.store.state_key(self.key), self.store.ttl)
+            pipe.execute()
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def complete(self):
+        """Flush remaining frames and mark the run completed, duplicates will replay the log"""
+        self._stop_event.set()
+        self.flush()
+        pipe = self.store.redis.pipeline()
+        pipe.hset(self.store.state_key(self.key), mapping={
+            "status": RunStatus.COMPLETED,
+            "finished_at": datetime.now().isoformat()
+        })
+        pipe.expire(self.store.state_key(self.key), self.store.ttl)
+        pipe.expire(self.store.events_key(self.key), self.store.ttl)
+        pipe.delete(self.store.lease_key(self.key))
+        pipe.execute()
+
+    def abandon(self):
+        """Forget the key when the run never started, so a retry can run it"""
+        self._stop_event.set()
+        self.store.redis.delete(self.store.state_key(self.key), self.store.events_key(self.key),
+                                self.store.lease_key(self.key))
+
+
+class IdempotencyStore:
+    """
+    Deduplicates retried /stream requests.
+    The first request with a key owns the run and records its SSE frames, duplicates attach
+    to that event log and replay it instead of running the agent again. Keys are scoped by
+    user, the session of a run is checked by the caller. The owner holds a short lease while
+    it runs, a duplicate following a run whose lease lapsed fails and its retry runs again.
+    """
+
+    def __init__(self, redis_client: Redis = None, ttl: int = IDEMPOTENCY_TTL,
+                 lease_ttl: float = IDEMPOTENCY_LEASE_TTL):
+        self.redis = redis_client or MetricsRedis(**get_redis_env())
+        self.ttl = ttl
+        self.lease_ttl_ms = int(lease_ttl * 1000)
+        self.state_prefix = "idempotency:"
+        self.events_prefix = "idempotency_events:"
+        self.lease_prefix = "idempotency_lease:"
+        self._begin_script = self.redis.register_script(_BEGIN_SCRIPT)
+
+    @staticmethod
+    def scoped_key(key: str, user_id: Optional[str]) -> str:
+        """The client's key within the namespace of its user"""
+        return f"{user_id or 'anonymous'}:{key}"
+
+    def state_key(self, key: str) -> str:
+        return f"{self.state_prefix}{key}"
+
+    def events_key(self, key: str) -> str:
+        return f"{self.events_prefix}{key}"
+
+    def lease_key(self, key: str) -> str:
+        return f"{self.lease_prefix}{key}"
+
+    def begin(self, key: str, session_id: str) -> Optional[IdempotentRun]:
+        """Claim a scoped key, returns the run writer or None if a live request already owns it"""
+        claimed = self._begin_script(
+            keys=[self.state_key(key), self.events_key(key), self.lease_key(key)],
+            args=[session_id, datetime.now().isoformat(), self.ttl, self.lease_ttl_ms])
+        if not claimed:
+            return None
+        return IdempotentRun(self, key)
+
+    def get_state(self, key: str) -> dict:
+        state = self.redis.hgetall(self.state_key(key))
+        return {k.decode('utf-8'): v.decode('utf-8') for k, v in state.items()}
+
+    def replay(self, key: str, poll_interval: float = 0.2) -> Generator[str, None, None]:
+        """Yield the recorded frames of a run, following the log until the run completes"""
+        events_key = self.events_key(key)
+        position = 0
+        while True:
+            # Read the status before the frames, the owner flushes all frames before completing
+            status = self.redis.hget(self.state_key(key), "status")
+            frames = self.redis.lrange(events_key, position, -1)
+            for frame in frames:
+                yield frame.decode('utf-8')
+            position += len(frames)
+            if status is None:
+                # The owner abandoned the run or the key expired
+                log(key, "idempotent run disappeared while replaying",
+                    LogLevel.WARNING)
+                return
+            if status.decode('utf-8') == RunStatus.COMPLETED:
+                return
+            if not self.redis.exists(self.lease_key(key)):
+                # The owner died without completing, a retry will claim the key again
+                log(key, "idempotent run lost its owner while replaying", LogLevel.WARNING)
+                yield _RUN_LOST_FRAME
+                return
+            time.sleep(poll_interval)
+
+
+# Global idempotency store instance
+idempotency_store = IdempotencyStore()
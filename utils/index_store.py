@@ -1,9 +1,187 @@
+import difflib
+import hashlib
+import json
+import re
+import zlib
 from redis import Redis
-from env import get_redis_env
-from typing import Generator
+from redis.exceptions import WatchError
+from utils.metrics import MetricsRedis
+from utils.key_registry import key_registry
+from utils.read_router import ReadRouter
+from utils.search_index import CJK_CHAR
+from env import get_redis_env, MANUSCRIPT_WINDOW, CHUNK_REVISION_BUDGET
+from typing import Dict, Generator, List, Optional, Tuple
 
 
-redis_client = Redis(**get_redis_env())
+redis_client = MetricsRedis(**get_redis_env())
+# Chunk listings are served by the configured read replicas
+read_router = ReadRouter(redis_client)
+
+# Written after every chunk when the manuscript is assembled
+CHUNK_SEPARATOR = "\n\n"
+
+# Every CJK character is a word, as are runs of latin letters and digits
+_WORD_PATTERN = re.compile(f"{CJK_CHAR}|[a-z0-9]+", re.IGNORECASE)
+
+
+def text_counts(text: str) -> Tuple[int, int]:
+    """(words, characters) of a text, CJK characters count as words and whitespace is not counted"""
+    return len(_WORD_PATTERN.findall(text)), sum(not c.isspace() for c in text)
+
+
+def make_delta(new: str, old: str) -> bytes:
+    """Reverse delta rebuilding `old` from `new`: ranges copied from `new` and literal text, zlib compressed"""
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, new, old).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(old[j1:j2])
+    return zlib.compress(json.dumps(ops, ensure_ascii=False).encode('utf-8'))
+
+
+def apply_delta(new: str, delta: bytes) -> str:
+    """Rebuild the older text from the newer one and the delta made by make_delta"""
+    return "".join(new[op[0]:op[1]] if isinstance(op, list) else op
+                   for op in json.loads(zlib.decompress(delta)))
+
+
+# Scripts take the keys of IndexStore._chunk_keys: data, order, version, stats, chunk versions,
+# revisions and revision queue
+
+# Build the chunk index of a store written before it existed, shared by the write scripts
+_BUILD_INDEX_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    for _, chunk in ipairs(redis.call('HKEYS', KEYS[1])) do
+        redis.call('ZADD', KEYS[2], tonumber(chunk) or 0, chunk)
+    end
+    redis.call('INCR', KEYS[3])
+end
+"""
+
+_BUILD_INDEX_SCRIPT = _BUILD_INDEX_LUA + """
+return redis.call('ZCARD', KEYS[2])
+"""
+
+# Move a chunk's word and character counts to new values and the totals by the difference.
+# Stores written before the counters have no stats hash, it is built by IndexStore.stats() instead.
+_COUNT_LUA = """
+local function count(chunk, words, chars)
+    local old = redis.call('HMGET', KEYS[4], chunk .. ':words', chunk .. ':chars')
+    redis.call('HINCRBY', KEYS[4], 'words', words - tonumber(old[1] or 0))
+    redis.call('HINCRBY', KEYS[4], 'chars', chars - tonumber(old[2] or 0))
+    if words == 0 and chars == 0 then
+        redis.call('HDEL', KEYS[4], chunk .. ':words', chunk .. ':chars')
+    else
+        redis.call('HSET', KEYS[4], chunk .. ':words', words, chunk .. ':chars', chars)
+    end
+end
+local counted = redis.call('EXISTS', KEYS[4]) == 1 or redis.call('EXISTS', KEYS[1]) == 0
+"""
+
+# Write a chunk, keep it in the sorted chunk index and the counters, and bump the version.
+# The chunk remembers the version that wrote it so caches can tell which chunks changed.
+# The previous content becomes a revision stored as a reverse delta from the new content ("{chunk}:{revision}"),
+# "{chunk}:head" is the current revision and "{chunk}:base" the oldest kept. Past the byte budget the oldest
+# revisions of the session are dropped. Returns -1 without writing when the chunk no longer has the content
+# the delta was made from.
+# ARGV: chunk index, content, words, chars, delta ('' when there is no previous content to keep),
+#       sha1 of the previous content ('' when absent), revision budget
+_WRITE_CHUNK_SCRIPT = _BUILD_INDEX_LUA + _COUNT_LUA + """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if (current and redis.sha1hex(current) or '') ~= ARGV[6] then
+    return -1
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], tonumber(ARGV[1]), ARGV[1])
+if counted then
+    count(ARGV[1], tonumber(ARGV[3]), tonumber(ARGV[4]))
+end
+local version = redis.call('INCR', KEYS[3])
+redis.call('HSET', KEYS[5], ARGV[1], version)
+
+-- Chunks written before revisions existed start at revision 1
+local head = tonumber(redis.call('HGET', KEYS[6], ARGV[1] .. ':head') or (current and 1 or 0))
+if ARGV[5] ~= '' then
+    local field = ARGV[1] .. ':' .. head
+    redis.call('HSET', KEYS[6], field, ARGV[5])
+    redis.call('HSETNX', KEYS[6], ARGV[1] .. ':base', head)
+    redis.call('HINCRBY', KEYS[6], 'bytes', string.len(ARGV[5]))
+    redis.call('ZADD', KEYS[7], version, field)
+    head = head + 1
+end
+redis.call('HSET', KEYS[6], ARGV[1] .. ':head', math.max(head, 1))
+
+while tonumber(redis.call('HGET', KEYS[6], 'bytes') or 0) > tonumber(ARGV[7]) do
+    local oldest = redis.call('ZPOPMIN', KEYS[7])
+    if #oldest == 0 then
+        break
+    end
+    local chunk, revision = string.match(oldest[1], '^(.*):(%d+)$')
+    redis.call('HINCRBY', KEYS[6], 'bytes', -redis.call('HSTRLEN', KEYS[6], oldest[1]))
+    redis.call('HDEL', KEYS[6], oldest[1])
+    redis.call('HSET', KEYS[6], chunk .. ':base', tonumber(revision) + 1)
+end
+return version
+"""
+
+# ARGV: chunk index
+_DELETE_CHUNK_SCRIPT = _BUILD_INDEX_LUA + _COUNT_LUA + """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[5], ARGV[1])
+if counted then
+    count(ARGV[1], 0, 0)
+end
+local base = redis.call('HGET', KEYS[6], ARGV[1] .. ':base')
+if base then
+    for revision = tonumber(base), tonumber(redis.call('HGET', KEYS[6], ARGV[1] .. ':head')) - 1 do
+        local field = ARGV[1] .. ':' .. revision
+        redis.call('HINCRBY', KEYS[6], 'bytes', -redis.call('HSTRLEN', KEYS[6], field))
+        redis.call('HDEL', KEYS[6], field)
+        redis.call('ZREM', KEYS[7], field)
+    end
+end
+redis.call('HDEL', KEYS[6], ARGV[1] .. ':head', ARGV[1] .. ':base')
+return redis.call('INCR', KEYS[3])
+"""
+
+# Version followed by (chunk index, byte length, chunk version) of every chunk in order,
+# chunks written before chunk versions existed report 0
+_CHUNK_LIST_SCRIPT = """
+local result = {redis.call('GET', KEYS[3]) or '0'}
+for _, chunk in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+    result[#result + 1] = chunk
+    result[#result + 1] = redis.call('HSTRLEN', KEYS[1], chunk)
+    result[#result + 1] = tonumber(redis.call('HGET', KEYS[5], chunk) or 0)
+end
+return result
+"""
+
+# Version followed by (chunk index, content) of the chunks ranked ARGV[1]..ARGV[2]
+_CHUNK_WINDOW_SCRIPT = """
+local result = {redis.call('GET', KEYS[3]) or '0'}
+local chunks = redis.call('ZRANGE', KEYS[2], ARGV[1], ARGV[2])
+if #chunks > 0 then
+    local contents = redis.call('HMGET', KEYS[1], unpack(chunks))
+    for i, chunk in ipairs(chunks) do
+        result[#result + 1] = chunk
+        result[#result + 1] = contents[i] or ''
+    end
+end
+return result
+"""
+
+# Optimistic writes retry when the chunk changes between reading it and writing the delta
+_WRITE_ATTEMPTS = 5
+
+_write_chunk = redis_client.register_script(_WRITE_CHUNK_SCRIPT)
+_delete_chunk = redis_client.register_script(_DELETE_CHUNK_SCRIPT)
+_build_index = redis_client.register_script(_BUILD_INDEX_SCRIPT)
+_chunk_list = redis_client.register_script(_CHUNK_LIST_SCRIPT)
+_chunk_window = redis_client.register_script(_CHUNK_WINDOW_SCRIPT)
 
 
 class IndexStore:
@@ -12,27 +190,204 @@ class IndexStore:
         self.name = name
         self.meta_key = f"is:{self.name}:m:"
         self.data_key = f"is:{self.name}:d:"
+        # Chunk numbers sorted by position and a version bumped on every chunk write
+        self.order_key = f"is:{self.name}:i:"
+        self.version_key = f"is:{self.name}:v:"
+        # Word and character counts per chunk ("{chunk}:words") and in total ("words")
+        self.stats_key = f"is:{self.name}:s:"
+        # Store version that last wrote each chunk
+        self.chunk_versions_key = f"is:{self.name}:c:"
+        # Previous drafts of each chunk as compressed deltas, and their write order for the memory budget
+        self.revisions_key = f"is:{self.name}:r:"
+        self.revision_queue_key = f"is:{self.name}:q:"
+        self.revision_budget = CHUNK_REVISION_BUDGET
+
+    @property
+    def _chunk_keys(self) -> List[str]:
+        return [self.data_key, self.order_key, self.version_key, self.stats_key, self.chunk_versions_key,
+                self.revisions_key, self.revision_queue_key]
 
     def add_meta(self, meta: dict):
+        key_registry.register(self.name, self.meta_key)
         self.redis_client.hset(self.meta_key, mapping=meta)
+        read_router.note_write(self.meta_key)
 
     def add_meta_item(self, key: str, value: str):
+        key_registry.register(self.name, self.meta_key)
         self.redis_client.hset(self.meta_key, key, value)
+        read_router.note_write(self.meta_key)
 
     def add(self, chunk_index: int, content: str):
-        self.redis_client.hset(self.data_key, chunk_index, content)
+        """Write a chunk, its previous content is kept as a revision"""
+        key_registry.register(self.name, *self._chunk_keys)
+        counts = text_counts(content)
+        for _ in range(_WRITE_ATTEMPTS):
+            current = self.redis_client.hget(self.data_key, chunk_index)
+            previous = current.decode('utf-8') if current is not None else None
+            delta = make_delta(content, previous) if previous not in (None, content) else b""
+            sha = hashlib.sha1(current).hexdigest() if current is not None else ""
+            if _write_chunk(keys=self._chunk_keys,
+                            args=[chunk_index, content, *counts, delta, sha, self.revision_budget]) != -1:
+                read_router.note_write(self.data_key)
+                return
+        raise RuntimeError(
+            f"chunk {chunk_index} of {self.name} kept changing while it was written")
 
     def update(self, chunk_index: int, content: str):
-        self.redis_client.hset(self.data_key, chunk_index, content)
+        self.add(chunk_index, content)
 
     def delete(self, chunk_index: int):
-        self.redis_client.hdel(self.data_key, chunk_index)
+        _delete_chunk(keys=self._chunk_keys, args=[chunk_index])
+        read_router.note_write(self.data_key)
 
     def count(self):
-        return self.redis_client.hlen(self.data_key)
+        return read_router.read(lambda client: client.hlen(self.data_key), self.data_key)
 
     def get(self, chunk_index: int):
         return self.redis_client.hget(self.data_key, chunk_index)
 
     def get_all(self):
-        return self.redis_client.hgetall(self.data_key)
+        return read_router.read(lambda client: client.hgetall(self.data_key), self.data_key)
+
+    def stats(self) -> Dict[str, int]:
+        """Word, character and chunk totals of the manuscript in one round trip"""
+        def fetch(client: Redis):
+            pipe = client.pipeline(transaction=False)
+            pipe.hmget(self.stats_key, "words", "chars")
+            pipe.hlen(self.data_key)
+            pipe.exists(self.stats_key)
+            return pipe.execute()
+
+        (words, chars), chunks, counted = read_router.read(fetch, self.data_key)
+        if chunks and not counted:
+            return self.rebuild_stats()
+        return {"words": int(words or 0), "chars": int(chars or 0), "chunks": chunks}
+
+    def chunk_stats(self, chunk_index: int) -> Dict[str, int]:
+        """Word and character counts of one chunk"""
+        words, chars = read_router.read(lambda client: client.hmget(
+            self.stats_key, f"{chunk_index}:words", f"{chunk_index}:chars"), self.data_key)
+        return {"words": int(words or 0), "chars": int(chars or 0)}
+
+    def rebuild_stats(self) -> Dict[str, int]:
+        """Count every chunk again, for stores written before the counters existed"""
+        with self.redis_client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.data_key)
+                    stats = {"words": 0, "chars": 0}
+                    for chunk, content in pipe.hgetall(self.data_key).items():
+                        words, chars = text_counts(content.decode('utf-8'))
+                        chunk = chunk.decode('utf-8')
+                        stats[f"{chunk}:words"], stats[f"{chunk}:chars"] = words, chars
+                        stats["words"] += words
+                        stats["chars"] += chars
+                    pipe.multi()
+                    pipe.delete(self.stats_key)
+                    pipe.hset(self.stats_key, mapping=stats)
+                    pipe.hlen(self.data_key)
+                    chunks = pipe.execute()[-1]
+                    read_router.note_write(self.data_key)
+                    return {"words": stats["words"], "chars": stats["chars"], "chunks": chunks}
+                except WatchError:
+                    # A chunk was written meanwhile, count again
+                    continue
+
+    def _revision_state(self, chunk_index: int, pipe) -> Tuple[Optional[bytes], int, int]:
+        """Current content, oldest kept and current revision of a chunk, 0 revisions when it does not exist"""
+        pipe.hget(self.data_key, chunk_index)
+        pipe.hmget(self.revisions_key,
+                   f"{chunk_index}:base", f"{chunk_index}:head")
+        current, (base, head) = pipe.execute()
+        if current is None:
+            return None, 0, 0
+        head = int(head or 1)
+        return current, int(base or head), head
+
+    def revisions(self, chunk_index: int) -> List[int]:
+        """Revision numbers of a chunk that can be read, oldest first, the last one is the current content"""
+        _, base, head = self._revision_state(
+            chunk_index, self.redis_client.pipeline())
+        return list(range(base, head + 1)) if head else []
+
+    def get_revision(self, chunk_index: int, revision: int) -> Optional[str]:
+        """Content of a chunk at a revision, rebuilt from the current content by applying deltas backwards"""
+        for _ in range(_WRITE_ATTEMPTS):
+            current, base, head = self._revision_state(
+                chunk_index, self.redis_client.pipeline())
+            if not base <= revision <= head or not head:
+                return None
+            text = current.decode('utf-8')
+            if revision == head:
+                return text
+            pipe = self.redis_client.pipeline()
+            pipe.hmget(self.revisions_key, [
+                       f"{chunk_index}:{r}" for r in range(head - 1, revision - 1, -1)])
+            pipe.hget(self.revisions_key, f"{chunk_index}:head")
+            deltas, latest = pipe.execute()
+            # Rewritten or trimmed meanwhile, the deltas belong to another head
+            if int(latest or 1) != head or None in deltas:
+                continue
+            for delta in deltas:
+                text = apply_delta(text, delta)
+            return text
+        return None
+
+    def diff_revisions(self, chunk_index: int, old: int, new: int) -> Optional[str]:
+        """Unified diff between two revisions of a chunk"""
+        old_text, new_text = self.get_revision(
+            chunk_index, old), self.get_revision(chunk_index, new)
+        if old_text is None or new_text is None:
+            return None
+        return "".join(difflib.unified_diff(
+            old_text.splitlines(keepends=True), new_text.splitlines(keepends=True),
+            f"chunk {chunk_index} r{old}", f"chunk {chunk_index} r{new}"))
+
+    def rollback(self, chunk_index: int, revision: int) -> bool:
+        """Make an earlier revision current again, as a new revision so nothing is lost"""
+        content = self.get_revision(chunk_index, revision)
+        if content is None:
+            return False
+        self.update(chunk_index, content)
+        return True
+
+    def ensure_index(self) -> int:
+        """Index the chunks of a store written without the chunk index, returns the number of chunks"""
+        return _build_index(keys=self._chunk_keys, client=self.redis_client)
+
+    def version(self) -> str:
+        """Version of the manuscript, changes whenever a chunk is written or deleted"""
+        version = read_router.read(
+            lambda client: client.get(self.version_key), self.data_key)
+        return version.decode('utf-8') if version else "0"
+
+    def chunk_list(self, client: Redis = None) -> Tuple[str, List[Tuple[int, int, int]]]:
+        """
+        Version and (chunk index, byte length, chunk version) of every chunk in manuscript order,
+        contents are not read
+        """
+        result = _chunk_list(keys=self._chunk_keys, client=client or self.redis_client)
+        items = result[1:]
+        return result[0].decode('utf-8'), [(int(items[i]), items[i + 1], items[i + 2])
+                                           for i in range(0, len(items), 3)]
+
+    def iter_windows(self, start: int = 0, window: int = MANUSCRIPT_WINDOW,
+                     client: Redis = None) -> Generator[Tuple[str, List[Tuple[int, bytes]]], None, None]:
+        """
+        Yield (version, [(chunk index, content), ...]) for `window` chunks at a time in manuscript order,
+        starting at the chunk ranked `start`. Each window is one round trip, memory stays bounded by the window.
+        """
+        client = client or self.redis_client
+        while True:
+            result = _chunk_window(keys=self._chunk_keys, args=[start, start + window - 1], client=client)
+            pairs = result[1:]
+            if not pairs:
+                return
+            yield result[0].decode('utf-8'), [(int(pairs[i]), pairs[i + 1]) for i in range(0, len(pairs), 2)]
+            if len(pairs) < 2 * window:
+                return
+            start += window
+
+    def reader_client(self) -> Redis:
+        """One client for a multi-call read, so all calls see the same copy of the manuscript"""
+        return read_router.client_for(self.data_key)
@@ -0,0 +1,147 @@
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+from redis import Redis
+from utils.metrics import MetricsRedis
+from env import get_redis_env, KEY_REGISTRY_CACHE_SIZE, KEY_REGISTRY_CACHE_TTL
+
+# Keys owned by a session, by the store that creates them.
+# Session locks are left out, leases expire on their own and must not be pulled from a live stream,
+# and fencing tokens come from one global counter that must outlive any session.
+SESSION_KEY_TEMPLATES = {
+    "messages": "{session_id}",  # RedisSession message list
+    "context": "session_ctx:{session_id}",  # RedisSession ctx hash
+    "index_meta": "is:{session_id}:m:",  # IndexStore meta hash
+    "index_data": "is:{session_id}:d:",  # IndexStore chunk hash
+    "index_order": "is:{session_id}:i:",  # IndexStore sorted chunk numbers
+    "index_version": "is:{session_id}:v:",  # IndexStore manuscript version
+    "index_stats": "is:{session_id}:s:",  # IndexStore word and character counters
+    "index_chunk_versions": "is:{session_id}:c:",  # IndexStore version that wrote each chunk
+    "index_revisions": "is:{session_id}:r:",  # IndexStore compressed chunk revisions
+    "index_revision_queue": "is:{session_id}:q:",  # IndexStore revisions oldest first, for the budget
+    "chapter_memory": "is:{session_id}:n:",  # ChapterMemory chunk summaries
+    "critic_feedback": "is:{session_id}:f:",  # ChapterMemory critic feedback per chunk
+    "history": "session_history:{session_id}",  # HistoryManager interactions
+    "history_version": "history_version:{session_id}",  # HistoryManager history ETag version
+    "meta": "session_meta:{session_id}",  # HistoryManager metadata
+    "search_tokens": "search:s:{session_id}",  # SessionSearchIndex tokens of the session
+    "registry": "session_keys:{session_id}",  # KeyRegistry set of the session's keys
+}
+
+# Sessions of sub-agents are derived from the parent session id
+SUB_AGENT_SUFFIXES = ("_sub_agent_critic",)
+
+# Prefixed templates matched back to (kind, session id), the bare message list cannot be told apart
+_TEMPLATE_PATTERNS = [
+    (kind, re.compile("^" + re.escape(template).replace(
+        re.escape("{session_id}"), "(?P<session_id>.+)") + "$"))
+    for kind, template in SESSION_KEY_TEMPLATES.items() if kind != "messages"
+]
+
+
+def owned_sessions(session_id: str) -> List[str]:
+    """The session and the sub-agent sessions it spawns"""
+    return [session_id] + [f"{session_id}{suffix}" for suffix in SUB_AGENT_SUFFIXES]
+
+
+def owner_session(session_id: str) -> str:
+    """The top-level session owning a session, sub-agent sessions belong to their parent"""
+    for suffix in SUB_AGENT_SUFFIXES:
+        if session_id.endswith(suffix):
+            return session_id[:-len(suffix)]
+    return session_id
+
+
+def session_keys(session_id: str, include_sub_agents: bool = True) -> List[str]:
+    """All keys a session owns by naming convention"""
+    session_ids = owned_sessions(
+        session_id) if include_sub_agents else [session_id]
+    return [template.format(session_id=sid)
+            for sid in session_ids for template in SESSION_KEY_TEMPLATES.values()]
+
+
+def parse_session_key(key: str) -> Optional[tuple[str, str]]:
+    """
+    Match a key back to (kind, owning top-level session id). Bare keys are only
+    recognized as sub-agent message lists, a top-level message list has no prefix to match.
+    """
+    for kind, pattern in _TEMPLATE_PATTERNS:
+        match = pattern.match(key)
+        if match:
+            return kind, owner_session(match.group("session_id"))
+    owner = owner_session(key)
+    if owner != key:
+        return "messages", owner
+    return None
+
+
+class KeyRegistry:
+    """
+    Per-session registry of the keys a session has written, a Redis set under the owning
+    top-level session. Stores register a key when they write it, the registration is
+    remembered in process for cache_ttl seconds so a key costs one SADD per worker and period.
+    Deletions by another worker are not seen here, the expiry bounds how long a key written
+    again after one stays unregistered.
+    """
+
+    def __init__(self, redis_client: Redis = None, cache_size: int = KEY_REGISTRY_CACHE_SIZE,
+                 cache_ttl: float = KEY_REGISTRY_CACHE_TTL):
+        self.redis = redis_client or MetricsRedis(**get_redis_env())
+        self.prefix = "session_keys:"
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # key -> monotonic time it was registered, oldest first
+        self._registered: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def registry_key(self, session_id: str) -> str:
+        return f"{self.prefix}{owner_session(session_id)}"
+
+    def register(self, session_id: str, *keys: str):
+        """Record keys written by a session, sub-agent keys are recorded under the parent"""
+        now = time.monotonic()
+        with self._lock:
+            new_keys = [key for key in keys
+                        if now - self._registered.get(key, float("-inf")) >= self.cache_ttl]
+        if not new_keys:
+            return
+        try:
+            self.redis.sadd(self.registry_key(session_id), *new_keys)
+        except Exception as e:
+            # The registry is advisory, the orphan collector finds what it misses
+            print(f"Failed to register keys of session {session_id}: {e}")
+            return
+        with self._lock:
+            for key in new_keys:
+                # Re-inserted so the dict stays ordered by registration time
+                self._registered.pop(key, None)
+                self._registered[key] = now
+            # Evict the oldest registrations, dicts keep insertion order
+            while len(self._registered) > self.cache_size:
+                self._registered.pop(next(iter(self._registered)))
+
+    def get_keys(self, session_ids: Iterable[str]) -> Set[str]:
+        """Registered keys of the sessions, in one pipeline"""
+        registry_keys = list(dict.fromkeys(
+            self.registry_key(session_id) for session_id in session_ids))
+        pipe = self.redis.pipeline(transaction=False)
+        for registry_key in registry_keys:
+            pipe.smembers(registry_key)
+        keys = set(registry_keys)
+        for members in pipe.execute():
+            keys.update(member.decode('utf-8') for member in members)
+        return keys
+
+    def forget(self, session_ids: Iterable[str]):
+        """Drop in-process registrations of deleted sessions so they register again if reused"""
+        owners = {owner_session(session_id) for session_id in session_ids}
+        with self._lock:
+            for key in list(self._registered):
+                parsed = parse_session_key(key)
+                if (parsed and parsed[1] in owners) or key in owners:
+                    self._registered.pop(key, None)
+
+
+# Global key registry instance
+key_registry = KeyRegistry()
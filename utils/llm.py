@@ -1,9 +1,14 @@
 from langchain_core.messages.ai import AIMessage
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import message_chunk_to_message, AIMessage, BaseMessage
-from typing import Generator, List
+import time
+from typing import Callable, Generator, Iterable, List
 from session import Session
 from utils import log, LogLevel
+from utils.llm_scheduler import llm_scheduler, LLMLease, Priority
+from utils.metrics import LLM_CALL, LLM_TTFT, LLM_INTER_TOKEN, LLM_REPETITION_ABORTS, model_name
+from utils.repetition import StreamRepetitionGuard
+from env import ENABLE_REPETITION_GUARD, REPETITION_RETRY_PARAMS
 
 
 class LLMToolCallError(Exception):
@@ -14,49 +19,163 @@ class LLMToolCallError(Exception):
         self.invalid_ai_messages = invalid_ai_messages
 
 
+class LLMRepetitionError(Exception):
+    """The output kept repeating itself and its stream was aborted."""
+
+    def __init__(self, part):
+        super().__init__(f"Repetitive output in {part}")
+        self.part = part
+
+
+class LLMRetry:
+    """
+    Yielded by llm_tools_stream when an attempt was aborted and is retried, out of band of the text.
+    `discarded` is the text the aborted attempt had streamed, the retry streams its answer from the start.
+    """
+    message = "The output started repeating itself, regenerating"
+
+    def __init__(self, discarded: str):
+        self.discarded = discarded
+
+    def drop(self, text: str) -> str:
+        """Text collected from a stream without the aborted attempt's output"""
+        return text[:len(text) - len(self.discarded)] if text.endswith(self.discarded) else text
+
+
+def stream_text(parts: Iterable) -> str:
+    """Text of an agent stream, without the output of aborted attempts, other events are skipped"""
+    text = ""
+    for part in parts:
+        if isinstance(part, str):
+            text += part
+        elif isinstance(part, LLMRetry):
+            text = part.drop(text)
+    return text
+
+
 def has_invalid_tool_calls(ai_msg: AIMessage) -> bool:
     return getattr(ai_msg, "invalid_tool_calls", False)
 
 
+def _to_message(combined) -> AIMessage:
+    """Message of the merged stream chunks, an empty message when the provider streamed none, as invoke returns"""
+    return AIMessage(content="") if combined is None else message_chunk_to_message(combined)
+
+
+def _stream_chunks(llm: ChatOpenAI, history: List[BaseMessage], model: str, lease: LLMLease) -> Generator:
+    """Provider stream with token timing, closed early when the repetition guard trips"""
+    guard = StreamRepetitionGuard() if ENABLE_REPETITION_GUARD else None
+    first = True
+    start = last = time.perf_counter()
+    stream = llm.stream(history)
+    try:
+        for chunk in stream:
+            now = time.perf_counter()
+            if first:
+                LLM_TTFT.labels(model).observe(now - start)
+                first = False
+            else:
+                LLM_INTER_TOKEN.labels(model).observe(now - last)
+            last = now
+            lease.renew()
+            if guard is not None and guard.feed(chunk):
+                LLM_REPETITION_ABORTS.labels(model).inc()
+                raise LLMRepetitionError(guard.tripped)
+            yield chunk
+    except ValueError as e:
+        # LangChain ends a stream without any chunk with this error, callers get an empty message instead
+        if not first or str(e) != "No generation chunks were returned":
+            raise
+        log(model, "LLM stream returned no chunks", LogLevel.WARNING)
+    finally:
+        # Closing the stream drops the provider connection, the remaining tokens are not generated
+        stream.close()
+
+
 def llm_stream(
     llm: ChatOpenAI,
     history: List[BaseMessage],
+    user_id: str = None,
+    priority: Priority = Priority.INTERACTIVE,
+    streamed: List[str] = None,
 ) -> Generator[str, None, AIMessage]:
+    """Stream the content of the answer, also appended to `streamed` when given, and return the message"""
+    model = model_name(llm)
     combined = None
-
-    for chunk in llm.stream(history):
-        if getattr(chunk, "content", None):
-            yield chunk.content
-        combined = chunk if combined is None else (combined + chunk)
-
-    ai_msg: AIMessage = message_chunk_to_message(combined)
+    start = time.perf_counter()
+
+    # The slot is held until the stream ends, is aborted or the consumer stops reading
+    with llm_scheduler.acquire(user_id, priority) as lease:
+        for chunk in _stream_chunks(llm, history, model, lease):
+            if getattr(chunk, "content", None):
+                if streamed is not None:
+                    streamed.append(chunk.content)
+                yield chunk.content
+            combined = chunk if combined is None else (combined + chunk)
+    LLM_CALL.labels(model, "stream").observe(time.perf_counter() - start)
+
+    ai_msg: AIMessage = _to_message(combined)
     return ai_msg
 
 
 def llm_invoke(
     llm: ChatOpenAI,
     history: List[BaseMessage],
+    user_id: str = None,
+    priority: Priority = Priority.INTERACTIVE,
 ) -> Generator[str, None, AIMessage]:
-    ai_msg: AIMessage = llm.invoke(history)
+    start = time.perf_counter()
+    with llm_scheduler.acquire(user_id, priority) as lease:
+        if ENABLE_REPETITION_GUARD:
+            # Streamed so a looping output is cut off, the message is the same as invoke's
+            combined = None
+            for chunk in _stream_chunks(llm, history, model_name(llm), lease):
+                combined = chunk if combined is None else (combined + chunk)
+            ai_msg: AIMessage = _to_message(combined)
+        else:
+            ai_msg: AIMessage = llm.invoke(history)
+    LLM_CALL.labels(model_name(llm), "invoke").observe(
+        time.perf_counter() - start)
     return ai_msg
 
 
+# Rewrites the session history before it is sent, called with the session id
+HistoryPreparer = Callable[[str, List[BaseMessage]], List[BaseMessage]]
+
+
 def llm_tools_stream(
     llm_with_tools: ChatOpenAI,
     session: Session,
-    retry: int = 5
+    retry: int = 5,
+    priority: Priority = Priority.INTERACTIVE,
+    prepare_history: HistoryPreparer = None
 ) -> Generator[str, None, None]:
     """
     - retry invalid_tool_calls
+    - retry repetitive output with adjusted sampling, announced by an LLMRetry event
     """
     invalid_ai_messages: List[BaseMessage] = []
+    repetition: LLMRepetitionError = None
     index = 0
+    user_id = session.get_ctx("user_id") or session.session_id
 
     while index < retry:
         index += 1
-        history = session.get_last_n_user_messages() + invalid_ai_messages
-
-        ai_msg: AIMessage = yield from llm_stream(llm_with_tools, history)
+        history = session.get_last_n_user_messages()
+        if prepare_history is not None:
+            history = prepare_history(session.session_id, history)
+        history = history + invalid_ai_messages
+
+        streamed = []
+        try:
+            ai_msg: AIMessage = yield from llm_stream(llm_with_tools, history, user_id, priority, streamed)
+        except LLMRepetitionError as e:
+            repetition = e
+            log(session.session_id, f"llm_tools_stream aborted repetitive output, retrying with {REPETITION_RETRY_PARAMS}",
+                level=LogLevel.WARNING)
+            llm_with_tools = llm_with_tools.bind(**REPETITION_RETRY_PARAMS)
+            yield LLMRetry("".join(streamed))
+            continue
 
         if has_invalid_tool_calls(ai_msg):
             # Don't write to session; only update temporary context and retry
@@ -71,25 +190,44 @@ def llm_tools_stream(
 
     log(session.session_id, f"llm_tools_stream failed, invalid_ai_messages: {invalid_ai_messages}",
         level=LogLevel.ERROR)
+    if not invalid_ai_messages:
+        raise repetition
     raise LLMToolCallError(invalid_ai_messages[-1])
 
 
 def llm_tools_invoke(
     llm_with_tools: ChatOpenAI,
     session: Session,
-    retry: int = 5
+    retry: int = 5,
+    priority: Priority = Priority.INTERACTIVE,
+    prepare_history: HistoryPreparer = None
 ) -> AIMessage:
     """
     - retry invalid_tool_calls
+    - retry repetitive output with adjusted sampling
     """
     invalid_ai_messages: List[BaseMessage] = []
+    repetition: LLMRepetitionError = None
     index = 0
+    user_id = session.get_ctx("user_id") or session.session_id
 
     while index < retry:
         index += 1
-        history = session.get_last_n_user_messages() + invalid_ai_messages
+        history = session.get_last_n_user_messages()
+        if prepare_history is not None:
+            history = prepare_history(session.session_id, history)
+        history = history + invalid_ai_messages
+
+        try:
+            ai_msg: AIMessage = llm_invoke(
+                llm_with_tools, history, user_id, priority)
+        except LLMRepetitionError as e:
+            repetition = e
+            log(session.session_id, f"llm_tools_invoke aborted repetitive output, retrying with {REPETITION_RETRY_PARAMS}",
+                level=LogLevel.WARNING)
+            llm_with_tools = llm_with_tools.bind(**REPETITION_RETRY_PARAMS)
+            continue
 
-        ai_msg: AIMessage = llm_invoke(llm_with_tools, history)
         if has_invalid_tool_calls(ai_msg):
             # Don't write to session; only update temporary context and retry
             invalid_ai_messages.append(ai_msg)
@@ -102,4 +240,6 @@ def llm_tools_invoke(
 
     log(session.session_id, f"llm_tools_stream failed, invalid_ai_messages: {invalid_ai_messages}",
         level=LogLevel.ERROR)
+    if not invalid_ai_messages:
+        raise repetition
     raise LLMToolCallError(invalid_ai_messages[-1])
@@ -0,0 +1,318 @@
+import threading
+import time
+import uuid
+from enum import IntEnum
+from typing import Optional
+from redis import Redis
+from utils.metrics import MetricsRedis, LLM_QUEUE, QUEUE_DEPTH
+from env import (get_redis_env, LLM_RATE_LIMIT, LLM_BURST, LLM_USER_RATE_LIMIT, LLM_USER_BURST,
+                 LLM_MAX_CONCURRENCY, LLM_SLOT_TTL, LLM_QUEUE_MAX, LLM_QUEUE_TIMEOUT)
+from utils import log, LogLevel
+
+
+class Priority(IntEnum):
+    """LLM call priority classes, lower value is served first"""
+    INTERACTIVE = 0  # main agent answering the user
+    SUB_AGENT = 1  # critic and other sub-agents
+    TITLE = 2  # background title generation
+
+
+# Fraction of the global burst that must stay in the bucket after a lower priority call,
+# so interactive calls can still be served when the bucket is draining
+_PRIORITY_RESERVE = {
+    Priority.INTERACTIVE: 0.0,
+    Priority.SUB_AGENT: 0.2,
+    Priority.TITLE: 0.5,
+}
+
+# Milliseconds after which a waiter that stopped polling loses its place in line
+_WAITER_TTL_MS = 5000
+
+# Admit a call when it is first in line and both buckets and a concurrency slot are free, or do
+# nothing. Waiters are ordered by priority class, then arrival; a waiter only held back by its own
+# user bucket leaves the line so it does not block other users. A rate or limit <= 0 is unlimited.
+# Returns {admitted, wait_ms}
+_ADMISSION_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+
+local g_rate, g_burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local u_rate, u_burst = tonumber(ARGV[3]), tonumber(ARGV[4])
+local reserve = tonumber(ARGV[5])
+local slots, slot_ttl = tonumber(ARGV[6]), tonumber(ARGV[7])
+local lease, order, waiter_ttl = ARGV[8], tonumber(ARGV[9]), tonumber(ARGV[10])
+local poll_ms = tonumber(ARGV[11])
+
+local function refill(key, rate, burst)
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or burst
+    local ts = tonumber(data[2]) or now
+    return math.min(burst, tokens + math.max(0, now - ts) / 1000 * rate)
+end
+
+local function store(key, tokens, rate, burst)
+    redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+
+-- Waiters of crashed workers stop polling and are dropped, expired slots are returned
+local stale = redis.call('ZRANGEBYSCORE', KEYS[5], '-inf', now - waiter_ttl)
+if #stale > 0 then
+    redis.call('ZREM', KEYS[4], unpack(stale))
+    redis.call('ZREM', KEYS[5], unpack(stale))
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+
+local u = 0
+if u_rate > 0 then
+    u = refill(KEYS[2], u_rate, u_burst)
+    if u < 1 then
+        redis.call('ZREM', KEYS[4], lease)
+        redis.call('ZREM', KEYS[5], lease)
+        store(KEYS[2], u, u_rate, u_burst)
+        return {0, math.ceil((1 - u) / u_rate * 1000)}
+    end
+end
+
+local head = redis.call('ZRANGE', KEYS[4], 0, 0)
+local first = head[1] == nil or head[1] == lease
+local g = 0
+local wait_ms = poll_ms
+local free = true
+if g_rate > 0 then
+    g = refill(KEYS[1], g_rate, g_burst)
+    if g - 1 < reserve then
+        free = false
+        wait_ms = math.max(poll_ms, math.ceil((reserve + 1 - g) / g_rate * 1000))
+    end
+end
+if slots > 0 and redis.call('ZCARD', KEYS[3]) >= slots then
+    free = false
+end
+
+if first and free then
+    if g_rate > 0 then
+        store(KEYS[1], g - 1, g_rate, g_burst)
+    end
+    if u_rate > 0 then
+        store(KEYS[2], u - 1, u_rate, u_burst)
+    end
+    if slots > 0 then
+        redis.call('ZADD', KEYS[3], now + slot_ttl, lease)
+    end
+    redis.call('ZREM', KEYS[4], lease)
+    redis.call('ZREM', KEYS[5], lease)
+    return {1, 0}
+end
+
+redis.call('ZADD', KEYS[4], 'NX', order, lease)
+redis.call('ZADD', KEYS[5], now, lease)
+redis.call('PEXPIRE', KEYS[4], waiter_ttl * 2)
+redis.call('PEXPIRE', KEYS[5], waiter_ttl * 2)
+return {0, wait_ms}
+"""
+
+# Push a held slot's expiry forward, only while it is still held
+_RENEW_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+return redis.call('ZADD', KEYS[1], 'XX', 'CH', now + tonumber(ARGV[2]), ARGV[1])
+"""
+
+
+class LLMAdmissionError(Exception):
+    """Raised when an LLM call is shed because the service is overloaded"""
+
+    def __init__(self, user_id: str, priority: Priority, message: str):
+        super().__init__(message)
+        self.user_id = user_id
+        self.priority = priority
+
+
+class LLMLease:
+    """
+    An admitted LLM call, holding a concurrency slot until it is released.
+    Used as a context manager, or released in a finally block by the caller.
+    """
+
+    def __init__(self, scheduler: Optional['LLMScheduler'], lease_id: str, queue_time: float = 0.0):
+        self.scheduler = scheduler
+        self.lease_id = lease_id
+        self.queue_time = queue_time
+        self._renewed_at = time.monotonic()
+        self._released = False
+
+    def renew(self, force: bool = False):
+        """Keep the slot of a long call, at most once per third of the slot ttl"""
+        if self.scheduler is None or self._released or not self.scheduler.max_concurrency:
+            return
+        now = time.monotonic()
+        if force or now - self._renewed_at >= self.scheduler.slot_ttl / 3:
+            self._renewed_at = now
+            self.scheduler.renew(self.lease_id)
+
+    def release(self):
+        if self.scheduler is None or self._released:
+            return
+        self._released = True
+        self.scheduler.release(self.lease_id)
+
+    def __enter__(self) -> 'LLMLease':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class LLMScheduler:
+    """
+    Admission control in front of provider calls, shared by all workers through Redis.
+    Each call takes one token from the global and the caller's user token bucket and holds one
+    of `max_concurrency` slots until it finishes, lower priority classes leave a token reserve
+    for interactive calls. Callers that cannot be admitted wait in line, served by priority class
+    then arrival; the line is bounded per process.
+    """
+
+    def __init__(self, redis_client: Redis = None,
+                 rate: float = LLM_RATE_LIMIT, burst: float = LLM_BURST,
+                 user_rate: float = LLM_USER_RATE_LIMIT, user_burst: float = LLM_USER_BURST,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY, slot_ttl: float = LLM_SLOT_TTL,
+                 queue_max: int = LLM_QUEUE_MAX, queue_timeout: float = LLM_QUEUE_TIMEOUT,
+                 poll_interval: float = 0.05):
+        self.redis = redis_client or MetricsRedis(**get_redis_env())
+        self.rate = rate
+        self.burst = burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_concurrency = max(0, max_concurrency)
+        self.slot_ttl = slot_ttl
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.poll_interval = poll_interval
+        self.global_key = "llm_bucket:global"
+        self.user_key_prefix = "llm_bucket:user:"
+        self.slots_key = "llm_slots"
+        self.waiters_key = "llm_waiters"
+        self.waiters_seen_key = "llm_waiters:seen"
+        self._script = self.redis.register_script(_ADMISSION_SCRIPT)
+        self._renew_script = self.redis.register_script(_RENEW_SCRIPT)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._stats = {p.name: {"admitted": 0, "shed": 0, "queue_time_total": 0.0, "queue_time_max": 0.0}
+                       for p in Priority}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 or self.max_concurrency > 0
+
+    def _try_take(self, user_id: str, priority: Priority, lease_id: str, order: int) -> tuple[bool, int]:
+        admitted, wait_ms = self._script(
+            keys=[self.global_key, f"{self.user_key_prefix}{user_id}", self.slots_key,
+                  self.waiters_key, self.waiters_seen_key],
+            args=[self.rate, self.burst, self.user_rate, self.user_burst,
+                  self.burst * _PRIORITY_RESERVE[priority],
+                  self.max_concurrency, int(self.slot_ttl * 1000),
+                  lease_id, order, _WAITER_TTL_MS, int(self.poll_interval * 1000)])
+        return bool(admitted), int(wait_ms)
+
+    def _leave_line(self, lease_id: str):
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.waiters_key, lease_id)
+        pipe.zrem(self.waiters_seen_key, lease_id)
+        pipe.execute()
+
+    def renew(self, lease_id: str):
+        if not self._renew_script(keys=[self.slots_key], args=[lease_id, int(self.slot_ttl * 1000)]):
+            log(lease_id, "llm slot expired before the call finished", LogLevel.WARNING)
+
+    def release(self, lease_id: str):
+        """Return the concurrency slot of a finished call"""
+        if not self.max_concurrency:
+            return
+        try:
+            self.redis.zrem(self.slots_key, lease_id)
+        except Exception as e:
+            # The slot expires on its own after slot_ttl
+            log(lease_id, f"llm slot release error: {e}", LogLevel.ERROR)
+
+    def _record(self, priority: Priority, queue_time: float, shed: bool = False):
+        with self._lock:
+            stats = self._stats[priority.name]
+            if shed:
+                stats["shed"] += 1
+            else:
+                stats["admitted"] += 1
+            stats["queue_time_total"] += queue_time
+            stats["queue_time_max"] = max(stats["queue_time_max"], queue_time)
+        LLM_QUEUE.labels(priority.name).observe(queue_time)
+
+    def acquire(self, user_id: str, priority: Priority = Priority.INTERACTIVE, timeout: float = None) -> LLMLease:
+        """
+        Block until the call is admitted and return its lease, release it when the call finishes.
+        Raises LLMAdmissionError when the local queue is full or the wait times out.
+        """
+        if not self.enabled:
+            return LLMLease(None, "")
+        user_id = user_id or "anonymous"
+        timeout = self.queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        lease_id = uuid.uuid4().hex
+        # Priority class first, then arrival in milliseconds
+        order = int(priority) * 10 ** 13 + int(time.time() * 1000)
+
+        admitted, wait_ms = self._try_take(user_id, priority, lease_id, order)
+        if admitted:
+            self._record(priority, 0.0)
+            return LLMLease(self, lease_id)
+
+        with self._lock:
+            if self._waiting >= self.queue_max:
+                queue_full = True
+            else:
+                queue_full = False
+                self._waiting += 1
+                QUEUE_DEPTH.labels("llm_admission").inc()
+        if queue_full:
+            self._leave_line(lease_id)
+            self._record(priority, 0.0, shed=True)
+            log(user_id, f"llm call shed, queue full, priority: {priority.name}",
+                LogLevel.WARNING)
+            raise LLMAdmissionError(
+                user_id, priority, "The service is busy, please try again later")
+
+        try:
+            while True:
+                elapsed = time.monotonic() - start
+                if elapsed + wait_ms / 1000 > timeout:
+                    self._leave_line(lease_id)
+                    self._record(priority, elapsed, shed=True)
+                    log(user_id, f"llm call shed after {elapsed:.2f}s, priority: {priority.name}",
+                        LogLevel.WARNING)
+                    raise LLMAdmissionError(
+                        user_id, priority, "The service is busy, please try again later")
+                # Polls keep the place in line alive, the line decides who is admitted next
+                time.sleep(min(wait_ms / 1000, 1.0))
+                admitted, wait_ms = self._try_take(user_id, priority, lease_id, order)
+                if admitted:
+                    queue_time = time.monotonic() - start
+                    self._record(priority, queue_time)
+                    log(user_id, f"llm call admitted after {queue_time:.2f}s, priority: {priority.name}",
+                        LogLevel.DEBUG)
+                    return LLMLease(self, lease_id, queue_time)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+            QUEUE_DEPTH.labels("llm_admission").dec()
+
+    def queue_depth(self) -> int:
+        """Number of calls waiting for admission in this process"""
+        return self._waiting
+
+    def get_stats(self) -> dict:
+        """Admission and queue-time statistics per priority class in this process"""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+# Global LLM scheduler instance
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,89 @@
+import os
+import time
+from redis import Redis
+from redis.client import Pipeline
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+
+# When PROMETHEUS_MULTIPROC_DIR is set every uvicorn worker writes its samples to mmap files
+# in that directory and /metrics aggregates them, otherwise metrics are per process.
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 40, 80, 160)
+_TOKEN_GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+_REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+LLM_TTFT = Histogram("llm_time_to_first_token_seconds",
+                     "Time from request to first streamed token", ["model"], buckets=_LATENCY_BUCKETS)
+LLM_INTER_TOKEN = Histogram("llm_inter_token_seconds",
+                            "Gap between streamed chunks", ["model"], buckets=_TOKEN_GAP_BUCKETS)
+LLM_CALL = Histogram("llm_call_seconds",
+                     "Provider call latency", ["model", "mode"], buckets=_LATENCY_BUCKETS)
+LLM_REPETITION_ABORTS = Counter("llm_repetition_aborts_total",
+                                "Streams aborted by the repetition guard", ["model"])
+LLM_QUEUE = Histogram("llm_admission_queue_seconds",
+                      "Time spent waiting for LLM admission", ["priority"], buckets=_LATENCY_BUCKETS)
+TOOL_EXECUTION = Histogram("tool_execution_seconds",
+                           "Tool execution latency", ["tool"], buckets=_LATENCY_BUCKETS)
+REDIS_OP = Histogram("redis_op_seconds",
+                     "Redis command latency", ["command"], buckets=_REDIS_BUCKETS)
+SSE_FRAMES = Counter("sse_frames_total", "SSE frames sent", ["type"])
+SSE_BYTES = Counter("sse_bytes_total", "SSE bytes sent", ["type"])
+ACTIVE_STREAMS = Gauge("active_streams", "Streams currently open",
+                       multiprocess_mode="livesum")
+CRITIC_GATE = Counter("critic_gate_decisions_total",
+                      "Pre-critic gate decisions on chunks", ["decision", "reason"])
+QUEUE_DEPTH = Gauge("queue_depth", "Requests waiting in a queue", ["queue"],
+                    multiprocess_mode="livesum")
+
+
+def model_name(llm) -> str:
+    """Get the model name of a chat model or of a bound runnable wrapping one"""
+    llm = getattr(llm, "bound", llm)
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+
+
+class MetricsPipeline(Pipeline):
+    """Pipeline recording the latency of each round trip, as MULTI or PIPELINE, and of commands run while watching"""
+
+    def immediate_execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().immediate_execute_command(*args, **options)
+        finally:
+            REDIS_OP.labels(str(args[0]).upper()).observe(
+                time.perf_counter() - start)
+
+    def execute(self, raise_on_error: bool = True):
+        if not self.command_stack:
+            return super().execute(raise_on_error)
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            REDIS_OP.labels("MULTI" if self.transaction else "PIPELINE").observe(
+                time.perf_counter() - start)
+
+
+class MetricsRedis(Redis):
+    """Redis client recording the latency of every command and pipeline"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            REDIS_OP.labels(str(args[0]).upper()).observe(
+                time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> MetricsPipeline:
+        return MetricsPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Render all metrics in the Prometheus text format, aggregated over workers when enabled"""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
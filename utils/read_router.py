@@ -0,0 +1,141 @@
+import itertools
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar, Union
+from redis import Redis
+from redis.exceptions import RedisError
+from utils import log, LogLevel
+from utils.metrics import MetricsRedis
+from env import get_redis_replica_envs, READ_YOUR_WRITES, READ_YOUR_WRITES_WINDOW, READ_YOUR_WRITES_WAIT_MS
+
+T = TypeVar("T")
+
+# Recent writes remembered per process for read-your-writes
+_MAX_TRACKED_WRITES = 10000
+
+
+def replica_clients(client_class: type = MetricsRedis) -> List[Redis]:
+    """One client per configured read replica"""
+    return [client_class(**env) for env in get_redis_replica_envs()]
+
+
+class ReadRouter:
+    """
+    Sends read-only calls to read replicas round robin, the primary serves them when no replica
+    is configured or the replica fails. Replication is asynchronous, so after a write from this process
+    a scope (a session's history, a user's session list, ...) is read consistently depending on `mode`:
+    - "version": the read returns the replica's version of the scope and is redone on the primary when
+      it is older than the version written. Scopes without a version go to the primary for `window` seconds.
+    - "wait": writes block until every replica has them, for at most `wait_ms`.
+    - "off": replicas may serve reads that miss the latest writes.
+    """
+
+    def __init__(self, primary: Redis, replicas: Optional[List[Redis]] = None, mode: str = READ_YOUR_WRITES,
+                 window: float = READ_YOUR_WRITES_WINDOW, wait_ms: int = READ_YOUR_WRITES_WAIT_MS):
+        self.primary = primary
+        self.replicas = replicas if replicas is not None else replica_clients()
+        self.mode = mode
+        self.window = window
+        self.wait_ms = wait_ms
+        self._next_replica = itertools.cycle(self.replicas)
+        # scope -> (expires_at, version written or None)
+        self._writes: Dict[str, Tuple[float, Optional[int]]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"replica": 0, "primary": 0, "stale": 0, "failed": 0}
+
+    def replica(self) -> Redis:
+        """Next replica, or the primary without replicas"""
+        if not self.replicas:
+            return self.primary
+        with self._lock:
+            return next(self._next_replica)
+
+    def note_write(self, scope: str, version=None):
+        """Record a write to a scope, with the version it produced if the scope is versioned"""
+        if not self.replicas or self.mode == "off":
+            return
+        if self.mode == "wait":
+            self._wait_for_replicas(scope)
+            return
+        with self._lock:
+            self._writes.pop(scope, None)
+            self._writes[scope] = (time.monotonic() + self.window,
+                                   int(version) if version is not None else None)
+            # Evict the oldest writes, dicts keep insertion order
+            while len(self._writes) > _MAX_TRACKED_WRITES:
+                self._writes.pop(next(iter(self._writes)))
+
+    def _wait_for_replicas(self, scope: str, interval: float = 0.002):
+        """
+        Block until every replica processed the primary's replication stream up to now, which includes
+        the write just made, for at most `wait_ms`. Redis WAIT would only cover writes of the connection
+        calling it, and returns without blocking inside MULTI, while writes here come from pooled
+        connections, transactions and scripts, so the replication offsets are compared instead.
+        """
+        try:
+            target = self.primary.info("replication")["master_repl_offset"]
+            deadline = time.monotonic() + self.wait_ms / 1000
+            pending = list(self.replicas)
+            while True:
+                pending = [replica for replica in pending
+                           if replica.info("replication").get("slave_repl_offset", -1) < target]
+                if not pending:
+                    return
+                if time.monotonic() >= deadline:
+                    log("read_router", f"write to {scope} reached {len(self.replicas) - len(pending)}/"
+                        f"{len(self.replicas)} replicas", LogLevel.WARNING)
+                    return
+                time.sleep(interval)
+        except RedisError as e:
+            log("read_router", f"waiting for replicas failed after write to {scope}: {e}", LogLevel.WARNING)
+
+    def _recent_write(self, scopes: List[str]) -> Optional[Tuple[float, Optional[int]]]:
+        """The first of the scopes written by this process within the window"""
+        if self.mode != "version":
+            return None
+        now = time.monotonic()
+        with self._lock:
+            for scope in scopes:
+                write = self._writes.get(scope)
+                if write and write[0] <= now:
+                    self._writes.pop(scope, None)
+                elif write:
+                    return write
+        return None
+
+    def client_for(self, scope: str) -> Redis:
+        """A client for a series of reads that must see one copy of the data, the primary after recent writes"""
+        if self._recent_write([scope]):
+            self.stats["primary"] += 1
+            return self.primary
+        return self.replica()
+
+    def read(self, func: Callable[[Redis], T], scope: Union[str, List[str]] = None,
+             version_of: Callable[[T], Optional[str]] = None) -> T:
+        """
+        Run a read-only `func(client)` on a replica. `version_of` extracts the scope's version
+        from the result, the read is redone on the primary when the replica is behind this process' writes.
+        Reads spanning several scopes take a list of them and no version.
+        """
+        if not self.replicas:
+            return func(self.primary)
+        write = self._recent_write([scope] if isinstance(scope, str) else scope or [])
+        if write and (write[1] is None or version_of is None):
+            self.stats["primary"] += 1
+            return func(self.primary)
+
+        try:
+            result = func(self.replica())
+        except RedisError as e:
+            # Also covers replicas that are loading or resyncing
+            self.stats["failed"] += 1
+            log("read_router", f"replica read failed, using the primary: {e}", LogLevel.WARNING)
+            return func(self.primary)
+
+        if write:
+            replica_version = version_of(result)
+            if int(replica_version or 0) < write[1]:
+                self.stats["stale"] += 1
+                return func(self.primary)
+        self.stats["replica"] += 1
+        return result
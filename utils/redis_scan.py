@@ -0,0 +1,145 @@
+import queue
+import threading
+from typing import Dict, Generator, List, Optional
+from redis import Redis
+from env import SCAN_COUNT
+
+# Length command of each Redis type
+_LENGTH_COMMANDS = {
+    "list": "LLEN",
+    "hash": "HLEN",
+    "zset": "ZCARD",
+    "set": "SCARD",
+    "string": "STRLEN",
+    "stream": "XLEN",
+}
+
+
+def _node_clients(redis_client) -> List[Redis]:
+    """Clients of the primaries of a cluster, or the client itself for a single node"""
+    get_primaries = getattr(redis_client, "get_primaries", None)
+    if get_primaries is None:
+        return [redis_client]
+    return [redis_client.get_redis_connection(node) for node in get_primaries()]
+
+
+def _decode(key) -> str:
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+def _scan_node(node: Redis, match: str, count: int, type_: Optional[str]) -> Generator[List[str], None, None]:
+    cursor = 0
+    while True:
+        cursor, keys = node.scan(cursor, match=match, count=count, _type=type_)
+        if keys:
+            yield [_decode(key) for key in keys]
+        if cursor == 0:
+            return
+
+
+def inspect_keys(redis_client: Redis, keys: List[str], type_: Optional[str] = None,
+                 memory: bool = False) -> List[dict]:
+    """
+    Get type, length and optionally MEMORY USAGE of keys in pipelined round trips.
+    When type_ is known the TYPE lookups are skipped.
+    """
+    if not keys:
+        return []
+    if type_:
+        types = [type_] * len(keys)
+    else:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        types = [_decode(t) for t in pipe.execute()]
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key, key_type in zip(keys, types):
+        if key_type in _LENGTH_COMMANDS:
+            pipe.execute_command(_LENGTH_COMMANDS[key_type], key)
+        if memory:
+            pipe.memory_usage(key)
+    results = iter(pipe.execute(raise_on_error=False))
+
+    stats = []
+    for key, key_type in zip(keys, types):
+        length = next(results) if key_type in _LENGTH_COMMANDS else None
+        info = {"key": key, "type": key_type,
+                "length": None if isinstance(length, Exception) else length}
+        if memory:
+            usage = next(results)
+            info["memory"] = None if isinstance(usage, Exception) else usage
+        stats.append(info)
+    return stats
+
+
+def scan_batches(redis_client: Redis, match: str = "*", count: int = SCAN_COUNT, type_: Optional[str] = None,
+                 parallel: bool = False, inspect: bool = False, memory: bool = False) -> Generator[list, None, None]:
+    """
+    Walk the keyspace with SCAN and yield keys one SCAN reply at a time, never blocking Redis
+    like KEYS does. type_ filters on the server (SCAN ... TYPE, Redis >= 6).
+    On a cluster every primary is scanned, concurrently with parallel=True.
+    With inspect=True batches hold inspect_keys() dicts instead of key names, pipelined on the owning node.
+    """
+    def node_batches(node: Redis):
+        for keys in _scan_node(node, match, count, type_):
+            yield inspect_keys(node, keys, type_, memory) if inspect else keys
+
+    nodes = _node_clients(redis_client)
+    if not parallel or len(nodes) == 1:
+        for node in nodes:
+            yield from node_batches(node)
+        return
+
+    # One scanning thread per node, batches are yielded as soon as any node returns them
+    batches: queue.Queue = queue.Queue(maxsize=len(nodes) * 4)
+    done = object()
+    stop = threading.Event()
+
+    def worker(node: Redis):
+        try:
+            for batch in node_batches(node):
+                if stop.is_set():
+                    return
+                batches.put(batch)
+        except Exception as e:
+            batches.put(e)
+        finally:
+            batches.put(done)
+
+    threads = [threading.Thread(target=worker, args=(node,), daemon=True)
+               for node in nodes]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(threads)
+        while remaining:
+            batch = batches.get()
+            if batch is done:
+                remaining -= 1
+            elif isinstance(batch, Exception):
+                raise batch
+            else:
+                yield batch
+    finally:
+        stop.set()
+        # Unblock workers waiting on a full queue
+        while any(thread.is_alive() for thread in threads):
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def scan_keys(redis_client: Redis, match: str = "*", count: int = SCAN_COUNT, type_: Optional[str] = None,
+              parallel: bool = False) -> Generator[str, None, None]:
+    """Stream key names matching a pattern, see scan_batches"""
+    for keys in scan_batches(redis_client, match, count, type_, parallel):
+        yield from keys
+
+
+def scan_stats(redis_client: Redis, match: str = "*", count: int = SCAN_COUNT, type_: Optional[str] = None,
+               parallel: bool = False, memory: bool = False) -> Generator[Dict, None, None]:
+    """Stream {key, type, length[, memory]} of keys matching a pattern, see scan_batches"""
+    for stats in scan_batches(redis_client, match, count, type_, parallel, inspect=True, memory=memory):
+        yield from stats
@@ -0,0 +1,80 @@
+from collections import deque
+from typing import Dict, Hashable
+from env import REPETITION_NGRAM, REPETITION_WINDOW, REPETITION_THRESHOLD
+
+_MOD = (1 << 61) - 1
+_BASE = 1_000_003
+
+
+class RepetitionDetector:
+    """
+    Incremental loop detection on a growing text. A Rabin-Karp rolling hash of the last `ngram` characters
+    is kept as text arrives; the detector fires when `threshold` of the last `window` n-grams were already
+    seen earlier in the text, i.e. the output keeps repeating what it wrote.
+    """
+
+    def __init__(self, ngram: int = REPETITION_NGRAM, window: int = REPETITION_WINDOW,
+                 threshold: float = REPETITION_THRESHOLD):
+        self.ngram = ngram
+        self.window = window
+        self.threshold = threshold
+        self._drop = pow(_BASE, ngram - 1, _MOD)
+        self._chars = deque()
+        self._hash = 0
+        self._seen = set()
+        self._hits = deque()
+        self._hit_count = 0
+
+    @property
+    def ratio(self) -> float:
+        """Share of the last n-grams that repeat earlier ones"""
+        return self._hit_count / len(self._hits) if self._hits else 0.0
+
+    def feed(self, text: str) -> bool:
+        """Add streamed text, True once the output is repeating itself"""
+        for char in text:
+            code = ord(char)
+            if len(self._chars) == self.ngram:
+                self._hash = (self._hash - self._chars.popleft() * self._drop) % _MOD
+            self._hash = (self._hash * _BASE + code) % _MOD
+            self._chars.append(code)
+            if len(self._chars) < self.ngram:
+                continue
+            hit = self._hash in self._seen
+            self._seen.add(self._hash)
+            self._hits.append(hit)
+            self._hit_count += hit
+            if len(self._hits) > self.window:
+                self._hit_count -= self._hits.popleft()
+        return len(self._hits) >= self.window and self.ratio >= self.threshold
+
+
+class StreamRepetitionGuard:
+    """Repetition detectors for the content and each tool call's arguments of a streamed message"""
+
+    def __init__(self, **detector_kwargs):
+        self.detector_kwargs = detector_kwargs
+        self.detectors: Dict[Hashable, RepetitionDetector] = {}
+        # Part that tripped the guard, "content" or the tool call index
+        self.tripped = None
+
+    def _feed(self, key: Hashable, text: str) -> bool:
+        if not text:
+            return False
+        detector = self.detectors.get(key)
+        if detector is None:
+            detector = self.detectors[key] = RepetitionDetector(**self.detector_kwargs)
+        if detector.feed(text):
+            self.tripped = key
+            return True
+        return False
+
+    def feed(self, chunk) -> bool:
+        """Add a streamed message chunk, True once its content or a tool call's arguments repeat"""
+        content = getattr(chunk, "content", None)
+        if isinstance(content, str) and self._feed("content", content):
+            return True
+        for tool_call in getattr(chunk, "tool_call_chunks", None) or []:
+            if self._feed(("tool", tool_call.get("index")), tool_call.get("args") or ""):
+                return True
+        return False
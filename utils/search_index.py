@@ -0,0 +1,140 @@
+import hashlib
+import re
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+from redis import Redis
+from utils.metrics import MetricsRedis
+from utils.key_registry import key_registry
+from env import get_redis_env, SEARCH_RESULT_TTL
+
+# CJK characters (kana, ideographs, hangul), tokens are runs of them and of latin letters/digits
+CJK_CHAR = r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]"
+_CJK_RUN = CJK_CHAR + "+"
+_TOKEN_PATTERN = re.compile(f"({_CJK_RUN})|([a-z0-9]+)")
+
+# Title tokens weigh more than conversation tokens when ranking
+TITLE_WEIGHT = 5
+
+
+def tokenize(text: str, unigrams: bool = False) -> List[str]:
+    """
+    Split text into index tokens: CJK runs become overlapping bigrams (a single character
+    stays a unigram), latin runs become lowercase words. Indexed text also gets the unigrams
+    of longer CJK runs, so one-character queries match them.
+    """
+    tokens = []
+    for cjk, word in _TOKEN_PATTERN.findall((text or "").lower()):
+        if cjk:
+            if len(cjk) == 1:
+                tokens.append(cjk)
+            else:
+                tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+                if unigrams:
+                    tokens.extend(cjk)
+        elif word:
+            tokens.append(word)
+    return tokens
+
+
+class SessionSearchIndex:
+    """
+    Incremental inverted index from tokens to session ids.
+    Each token is a sorted set of sessions scored by term frequency, and each session keeps
+    a sorted set of its own tokens so it can be removed or re-titled without a scan.
+    Search intersects the sets of the query tokens, so cost follows the matches rather than the history size.
+    """
+
+    def __init__(self, redis_client: Redis = None, result_ttl: int = SEARCH_RESULT_TTL):
+        self.redis = redis_client or MetricsRedis(**get_redis_env())
+        self.result_ttl = result_ttl
+        self.token_prefix = "search:t:"
+        self.session_prefix = "search:s:"
+        self.result_prefix = "search:q:"
+
+    def _add_tokens(self, session_id: str, counts: Counter):
+        pipe = self.redis.pipeline(transaction=False)
+        session_key = f"{self.session_prefix}{session_id}"
+        key_registry.register(session_id, session_key)
+        for token, count in counts.items():
+            pipe.zincrby(f"{self.token_prefix}{token}", count, session_id)
+            pipe.zincrby(session_key, count, token)
+            if count < 0:
+                pipe.zremrangebyscore(
+                    f"{self.token_prefix}{token}", "-inf", 0)
+        if any(count < 0 for count in counts.values()):
+            pipe.zremrangebyscore(session_key, "-inf", 0)
+        pipe.execute()
+
+    def index_text(self, session_id: str, texts: Iterable[str]):
+        """Add the tokens of new conversation text to the session"""
+        counts = Counter()
+        for text in texts:
+            counts.update(tokenize(text, unigrams=True))
+        if counts:
+            self._add_tokens(session_id, counts)
+
+    def index_title(self, session_id: str, old_title: Optional[str], new_title: Optional[str]):
+        """Move the title weight from the tokens of the old title to the new one"""
+        counts = Counter()
+        for token in tokenize(old_title, unigrams=True):
+            counts[token] -= TITLE_WEIGHT
+        for token in tokenize(new_title, unigrams=True):
+            counts[token] += TITLE_WEIGHT
+        counts = Counter({t: c for t, c in counts.items() if c})
+        if counts:
+            self._add_tokens(session_id, counts)
+
+    def remove_session(self, session_id: str):
+        """Drop a session from every token it was indexed under"""
+        session_key = f"{self.session_prefix}{session_id}"
+        tokens = self.redis.zrange(session_key, 0, -1)
+        pipe = self.redis.pipeline(transaction=False)
+        for token in tokens:
+            pipe.zrem(f"{self.token_prefix}{token.decode('utf-8')}", session_id)
+        pipe.delete(session_key)
+        pipe.execute()
+
+    def clear(self) -> int:
+        """Delete the whole index, returns the number of keys removed"""
+        removed = 0
+        batch = []
+        for key in self.redis.scan_iter(match="search:*", count=1000):
+            batch.append(key)
+            if len(batch) >= 500:
+                removed += self.redis.unlink(*batch)
+                batch = []
+        if batch:
+            removed += self.redis.unlink(*batch)
+        return removed
+
+    def search(self, query: str, offset: int = 0, limit: int = 20,
+               scope_key: Optional[str] = None) -> Tuple[List[Tuple[str, float]], int]:
+        """
+        Find sessions containing all query tokens, best matches first.
+        scope_key optionally restricts the result to the members of another sorted set
+        (e.g. a user's session index). Returns ([(session_id, score)], total).
+        Results are kept for a short time so following pages are cheap and stable.
+        """
+        tokens = sorted(set(tokenize(query)))
+        if not tokens:
+            return [], 0
+
+        digest = hashlib.sha1(
+            f"{scope_key or ''}\x00{' '.join(tokens)}".encode('utf-8')).hexdigest()
+        result_key = f"{self.result_prefix}{digest}"
+        # The first page is always fresh, following pages reuse its result set
+        if offset == 0 or not self.redis.exists(result_key):
+            weights = {f"{self.token_prefix}{token}": 1 for token in tokens}
+            if scope_key:
+                # Scope members only filter, their scores do not count
+                weights[scope_key] = 0
+            pipe = self.redis.pipeline()
+            pipe.zinterstore(result_key, weights, aggregate="SUM")
+            pipe.expire(result_key, self.result_ttl)
+            pipe.execute()
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zcard(result_key)
+        pipe.zrevrange(result_key, offset, offset + limit - 1, withscores=True)
+        total, page = pipe.execute()
+        return [(session_id.decode('utf-8'), score) for session_id, score in page], total
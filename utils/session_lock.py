@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+from redis import Redis
+from utils.metrics import MetricsRedis, QUEUE_DEPTH
+from env import get_redis_env, SESSION_LOCK_TTL, SESSION_LOCK_WAIT, SESSION_LOCK_MAX_WAITERS
+from utils import log, LogLevel
+
+
+# Extend the lease only if we still own it
+_EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Delete the lease only if we still own it
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SessionLockError(Exception):
+    """Raised when the session lease cannot be acquired"""
+
+    def __init__(self, session_id: str, status_code: int, message: str):
+        super().__init__(message)
+        self.session_id = session_id
+        self.status_code = status_code
+
+
+class SessionLockLostError(Exception):
+    """Raised when a write is fenced off because the lease was taken over"""
+
+    def __init__(self, session_id: str, token: str):
+        super().__init__(
+            f"Session {session_id} lease lost, fencing token {token} is stale")
+        self.session_id = session_id
+        self.token = token
+
+
+class SessionLock:
+    """
+    Distributed per-session lease.
+    The lock value is a monotonically increasing fencing token, writers can compare it
+    against the lock key to reject stale holders. A heartbeat thread keeps the lease alive
+    while the stream is running.
+    """
+
+    def __init__(self, session_id: str, redis_client: Redis, ttl: float = SESSION_LOCK_TTL):
+        self.session_id = session_id
+        self.redis = redis_client
+        self.ttl_ms = int(ttl * 1000)
+        self.lock_key = f"session_lock:{session_id}"
+        # One counter for all sessions, so tokens keep growing across deletion and re-creation of a session
+        self.fence_key = "session_lock_fence"
+        self.waiters_key = f"session_lock_waiters:{session_id}"
+        self.token: Optional[str] = None
+        self.lost = False
+        self._stop_event = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+
+    def try_acquire(self) -> bool:
+        """Try to acquire the lease once, without waiting"""
+        if self.token is None:
+            self.token = str(self.redis.incr(self.fence_key))
+        acquired = self.redis.set(
+            self.lock_key, self.token, nx=True, px=self.ttl_ms)
+        return bool(acquired)
+
+    def acquire(self, wait: float = 0, interval: float = 0.1) -> bool:
+        """Acquire the lease, waiting up to `wait` seconds"""
+        deadline = time.monotonic() + wait
+        while True:
+            if self.try_acquire():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+
+    async def acquire_async(self, wait: float = SESSION_LOCK_WAIT, interval: float = 0.1,
+                            max_waiters: int = SESSION_LOCK_MAX_WAITERS):
+        """
+        Acquire the lease from an async handler.
+        wait <= 0 rejects immediately with 409 when the session is busy, otherwise the
+        request queues behind the current holder and gets 429 when the queue is full or
+        the wait times out.
+        """
+        if self.try_acquire():
+            return
+        if wait <= 0:
+            raise SessionLockError(
+                self.session_id, 409, f"Session {self.session_id} is busy, please retry later")
+
+        waiters = self.redis.incr(self.waiters_key)
+        self.redis.expire(self.waiters_key, int(wait) + 1)
+        QUEUE_DEPTH.labels("session_lock").inc()
+        try:
+            if waiters > max_waiters:
+                raise SessionLockError(
+                    self.session_id, 429, f"Too many queued requests for session {self.session_id}")
+            deadline = time.monotonic() + wait
+            while time.monotonic() < deadline:
+                await asyncio.sleep(interval)
+                if self.try_acquire():
+                    return
+            raise SessionLockError(
+                self.session_id, 429, f"Timed out waiting for session {self.session_id}")
+        finally:
+            self.redis.decr(self.waiters_key)
+            QUEUE_DEPTH.labels("session_lock").dec()
+
+    def is_held(self) -> bool:
+        """Check whether the lease is still ours"""
+        value = self.redis.get(self.lock_key)
+        return value is not None and value.decode('utf-8') == self.token
+
+    def extend(self) -> bool:
+        """Extend the lease, returns False if it was lost"""
+        extended = self.redis.eval(
+            _EXTEND_SCRIPT, 1, self.lock_key, self.token, self.ttl_ms)
+        if not extended:
+            self.lost = True
+        return bool(extended)
+
+    def start_heartbeat(self):
+        """Start a daemon thread that extends the lease every ttl/3"""
+        if self._heartbeat_thread is not None:
+            return
+        interval = self.ttl_ms / 3000
+
+        def heartbeat():
+            while not self._stop_event.wait(interval):
+                try:
+                    if not self.extend():
+                        log(self.session_id,
+                            f"session lock lost, token: {self.token}", LogLevel.WARNING)
+                        return
+                except Exception as e:
+                    log(self.session_id,
+                        f"session lock heartbeat error: {e}", LogLevel.ERROR)
+
+        self._heartbeat_thread = threading.Thread(
+            target=heartbeat, name=f"session-lock-{self.session_id}", daemon=True)
+        self._heartbeat_thread.start()
+
+    def release(self):
+        """Stop the heartbeat and release the lease if still owned"""
+        self._stop_event.set()
+        if self.token is None:
+            return
+        try:
+            self.redis.eval(_RELEASE_SCRIPT, 1, self.lock_key, self.token)
+        except Exception as e:
+            log(self.session_id,
+                f"session lock release error: {e}", LogLevel.ERROR)
+
+
+class SessionLockManager:
+    """Creates per-session leases on a shared Redis connection"""
+
+    def __init__(self, redis_client: Redis = None):
+        self.redis = redis_client or MetricsRedis(**get_redis_env())
+
+    def get_lock(self, session_id: str, ttl: float = SESSION_LOCK_TTL) -> SessionLock:
+        return SessionLock(session_id, self.redis, ttl)
+
+
+# Global session lock manager instance
+session_lock_manager = SessionLockManager()
@@ -0,0 +1,69 @@
+import json
+import uuid
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from redis import Redis
+from env import get_redis_env
+from utils.chapter_memory import ChapterMemory, compact_history, extract_beats
+
+
+def _chunk_step(chunk_index: int, content: str) -> list:
+    call_id = f"call_{chunk_index}"
+    return [
+        AIMessage(content="", tool_calls=[{"name": "prompt_chunk_content", "id": call_id,
+                                           "args": {"chunk_index": chunk_index, "content": content}}]),
+        ToolMessage(content=json.dumps(f"Confirmed chunk_index: {chunk_index} \n\n Content fragment: {content}",
+                                       ensure_ascii=False),
+                    name="write chunk", tool_call_id=call_id),
+    ]
+
+
+def test_chapter_memory():
+    """Test chunk summaries and the compacted main agent history"""
+    print("=== Testing chapter memory ===")
+
+    assert extract_beats("他醒来。窗外下雨。门开了。") == "他醒来。 … 门开了。", \
+        "Fallback beats should keep the opening and closing sentences"
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping chapter memory tests (Redis service may not be running)\n")
+        return
+
+    session_id = f"test_chapter_memory_{uuid.uuid4()}"
+    memory = ChapterMemory(session_id)
+    history = [SystemMessage(content="system"), HumanMessage(content="write a novel")]
+    assert compact_history(session_id, history) == history, "History without chunks should be unchanged"
+
+    sizes = []
+    try:
+        for i in range(1, 11):
+            content = f"第{i}章开始。" + "雨一直下。" * 400 + f"第{i}章结束。"
+            memory.index_store.add(i, content)
+            memory.remember(i, content, characters=f"主角在第{i}站")
+            history += _chunk_step(i, content)
+            sizes.append(sum(len(str(m.content)) + len(str(getattr(m, "tool_calls", "")))
+                             for m in compact_history(session_id, history)))
+
+        compacted = compact_history(session_id, history)
+        system = compacted[0].content
+        assert system.startswith("system") and "# Chapter memory" in system, "Memory should extend the system prompt"
+        assert all(f"- chunk {i}: 第{i}章开始。" in system for i in range(1, 11)), "Every chunk should be summarized"
+        assert system.endswith("第10章结束。"), "The tail of the last chunk should close the memory"
+        assert "雨一直下。" * 400 not in "".join(str(m) for m in compacted), "Chunk texts should not be sent"
+        assert compacted[-1].content == json.dumps("Confirmed chunk_index: 10"), "Echoed results should be cut"
+        assert "雨一直下。" * 400 in history[-2].tool_calls[0]["args"]["content"], "The session should not change"
+        # Summaries grow by a line per chunk, the chunk texts no longer add up
+        assert sizes[-1] - sizes[0] < 9 * 400, f"Prompt should stay small as chunks are added: {sizes}"
+
+        memory.index_store.delete(10)
+        assert list(memory.summaries()) == list(range(1, 10)), "Deleted chunks should drop out of the memory"
+        print("Chapter memory tests passed\n")
+    finally:
+        redis_client.delete(*memory.index_store._chunk_keys, memory.key, f"session_keys:{session_id}")
+
+
+if __name__ == "__main__":
+    test_chapter_memory()
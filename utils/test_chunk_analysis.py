@@ -0,0 +1,40 @@
+from utils.chunk_analysis import CriticGate, GateDecision, analyze_chunk, expected_script, gate_feedback
+
+
+def test_critic_gate():
+    """Test chunk measures and the pre-critic gate decisions"""
+    print("=== Testing critic gate ===")
+
+    assert expected_script("中文") == "cjk" and expected_script("Simplified Chinese") == "cjk", \
+        "Chinese should expect CJK characters"
+    assert expected_script("English") == "latin" and expected_script("en-US") == "latin", \
+        "English should expect latin letters"
+    assert expected_script("Klingon") is None, "Unknown languages are not checked"
+
+    narrative = "".join(f"第{i}天，他走过第{i}座桥，河水的颜色每天都不一样。“你还记得第{i}个约定吗？”她问。"
+                        for i in range(1, 12))
+    analysis = analyze_chunk(narrative)
+    assert analysis["cjk"] > 0.9 and analysis["repetition"] < 0.5, f"Unexpected measures: {analysis}"
+    assert 0 < analysis["dialogue"] < 0.5, "Quoted text should count as dialogue"
+
+    gate = CriticGate(min_words=100, review_repetition=0.6, regenerate_repetition=0.8)
+    assert gate.check(narrative, "中文")[0] == GateDecision.SKIP, "A clean chunk should skip the critic"
+    decision, reasons, _ = gate.check(narrative, "English")
+    assert decision == GateDecision.REGENERATE and reasons == ["language"], "Wrong language should regenerate"
+    decision, reasons, _ = gate.check("他走了。" * 200, "中文")
+    assert decision == GateDecision.REGENERATE and "repetition" in reasons, "Loops should regenerate"
+    assert gate.check("太短了。", "中文")[:2] == (GateDecision.REGENERATE, ["too_short"]), \
+        "Short chunks should regenerate"
+    decision, reasons, _ = gate.check(narrative.replace("“", "").replace("”", ""), "中文")
+    assert decision == GateDecision.REVIEW and reasons == ["dialogue"], "No dialogue is borderline"
+
+    stats = gate.get_stats()
+    assert stats == {"skip": 1, "review": 1, "regenerate": 3, "critic_calls_saved": 0.8}, f"Unexpected stats: {stats}"
+    assert gate_feedback(GateDecision.REVIEW, ["dialogue"], analysis) is None, "Reviews go to the critic"
+    assert "Regenerate" in gate_feedback(GateDecision.REGENERATE, ["language"], analysis), \
+        "Regeneration should be asked for"
+    print("Critic gate tests passed\n")
+
+
+if __name__ == "__main__":
+    test_critic_gate()
@@ -0,0 +1,277 @@
+import json
+import threading
+import time
+import uuid
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from redis import Redis
+from env import get_redis_env
+import utils.history
+from utils.history import HistoryManager, TitleDraft, TitleSource, encode_interaction, compact_responses
+from utils.search_index import tokenize
+
+
+FRAMES = [
+    f"data: {json.dumps({'content': '你好'}, ensure_ascii=False)}\n\n",
+    f"data: {json.dumps({'content': ', world'}, ensure_ascii=False)}\n\n",
+    f"tool_message: {json.dumps({'content': 'done', 'name': 'search', 'tool_call_id': 'call_1'})}\n\n",
+    f"data: {json.dumps({'content': ' after'})}\n\n",
+    f"tool_call: {json.dumps([{'tool_call_id': 'call_2', 'tool_name': 'write'}])}\n\n",
+]
+
+
+def test_compact_history():
+    """Test compact interaction records, compression and legacy migration"""
+    print("=== Testing compact history ===")
+
+    compact = compact_responses(FRAMES)
+    assert compact["text"] == "你好, world after", f"Unexpected merged text: {compact['text']}"
+    assert compact["tool_events"][0]["offset"] == len("你好, world"), "Tool event offset mismatch"
+    assert len(compact["confirmations"]) == 1, "Confirmation event missing"
+    retried = compact_responses([
+        f"data: {json.dumps({'content': 'intro '})}\n\n",
+        f"data: {json.dumps({'content': 'loop loop'})}\n\n",
+        f"data: {json.dumps({'type': 'retry', 'content': '[regenerating]', 'discard': len('loop loop')})}\n\n",
+        f"data: {json.dumps({'content': 'fresh'})}\n\n"])
+    assert retried["text"] == "intro fresh", f"Aborted attempts should be dropped: {retried['text']}"
+    # One frame per token delta, as streamed
+    token_frames = [f"data: {json.dumps({'content': 'token '})}\n\n"] * 200
+    assert len(encode_interaction("q", compact_responses(token_frames))) * 4 < len("".join(token_frames)), \
+        "Compact record should be much smaller than the raw frames"
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping compact history tests (Redis service may not be running)\n")
+        return
+
+    history_manager = HistoryManager(redis_client)
+    session_id = f"test_history_{uuid.uuid4()}"
+    history_key = f"{history_manager.history_prefix}{session_id}"
+    try:
+        # A legacy record and a large record that gets compressed
+        redis_client.rpush(history_key, json.dumps({
+            "user_input": "legacy", "agent_responses": FRAMES, "timestamp": "2024-01-01T00:00:00"}))
+        history_manager.save_interaction(session_id, "large", [
+            f"data: {json.dumps({'content': 'x' * 5000})}\n\n"])
+        history_manager.save_interaction(session_id, "compact", FRAMES)
+
+        history = history_manager.get_session_history(session_id)
+        assert [h["user_input"] for h in history] == ["legacy", "large", "compact"], "Order mismatch"
+        assert all(h["text"] for h in history), "Every record should expose merged text"
+        assert history[1]["text"] == "x" * 5000, "Compressed record did not round trip"
+        assert [f.split(":", 1)[0] for f in history[2]["agent_responses"]] == \
+            ["data", "tool_message", "data", "tool_call"], "Rebuilt frames lost the event order"
+
+        converted = history_manager.migrate_history_key(history_key)
+        assert converted == 1, f"Expected 1 legacy record converted, actual: {converted}"
+        assert history_manager.migrate_history_key(history_key) == 0, "Migration should be idempotent"
+        migrated = history_manager.get_session_history(session_id)
+        assert migrated[0]["text"] == history[0]["text"], "Migrated text mismatch"
+        assert migrated[0]["timestamp"] == "2024-01-01T00:00:00", "Migration should keep the timestamp"
+        print("Compact history tests passed\n")
+    finally:
+        redis_client.delete(history_key)
+
+
+def test_search_index():
+    """Test the inverted search index maintenance, ranking and scoping"""
+    print("=== Testing search index ===")
+
+    assert tokenize("小说大纲 Chapter 1") == ["小说", "说大", "大纲", "chapter", "1"], "Unexpected tokens"
+    assert tokenize("小说", unigrams=True) == ["小说", "小", "说"], "Indexed CJK runs should add unigrams"
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping search index tests (Redis service may not be running)\n")
+        return
+
+    history_manager = HistoryManager(redis_client)
+    user_id = f"test_search_user_{uuid.uuid4()}"
+    first, second = f"test_search_{uuid.uuid4()}", f"test_search_{uuid.uuid4()}"
+    try:
+        for session_id in (first, second):
+            history_manager.add_user_session(user_id, session_id)
+        history_manager.save_interaction(first, "写一部科幻小说", [
+            f"data: {json.dumps({'content': '好的，科幻小说大纲如下'}, ensure_ascii=False)}\n\n"])
+        history_manager.save_interaction(second, "天气怎么样", [
+            f"data: {json.dumps({'content': '今天晴，也适合读小说'}, ensure_ascii=False)}\n\n"])
+
+        sessions, total = history_manager.search_sessions("科幻小说", user_id)
+        assert total == 1 and sessions[0]["session_id"] == first, f"Expected only the first session: {sessions}"
+        sessions, total = history_manager.search_sessions("小说", user_id, limit=1)
+        assert total == 2 and sessions[0]["session_id"] == first, "More frequent match should rank first"
+        sessions, _ = history_manager.search_sessions("小说", user_id, offset=1, limit=1)
+        assert sessions[0]["session_id"] == second, "Second page should hold the other session"
+        sessions, total = history_manager.search_sessions("晴", user_id)
+        assert total == 1 and sessions[0]["session_id"] == second, "One-character queries should match"
+        assert history_manager.search_sessions("小说", "another_user")[1] == 0, "Search should be scoped to the user"
+
+        history_manager.save_session_meta(second, title="Weather chat")
+        assert history_manager.search_sessions("weather", user_id)[1] == 1, "Title should be indexed"
+        history_manager.update_session_title(second, "Forecast")
+        assert history_manager.search_sessions("weather", user_id)[1] == 0, "Old title should be unindexed"
+
+        history_manager.clear_session_history(first)
+        assert history_manager.search_sessions("科幻", user_id)[1] == 0, "Deleted session should be unindexed"
+        print("Search index tests passed\n")
+    finally:
+        for session_id in (first, second):
+            history_manager.clear_session_history(session_id)
+        history_manager.clear_user_sessions(user_id)
+
+
+def test_history_pages():
+    """Test index cursors, field projection and history versions"""
+    print("=== Testing history pages ===")
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping history page tests (Redis service may not be running)\n")
+        return
+
+    history_manager = HistoryManager(redis_client)
+    session_id = f"test_pages_{uuid.uuid4()}"
+    try:
+        for i in range(5):
+            history_manager.save_interaction(session_id, f"q{i}", FRAMES)
+
+        latest = history_manager.get_session_history_page(
+            session_id, limit=2, fields=["user_input"])
+        assert [h["index"] for h in latest["history"]] == [3, 4], "Latest page should hold the last indexes"
+        assert set(latest["history"][0]) == {"index", "user_input"}, "Fields should be projected"
+        assert latest["before"] == 3 and latest["after"] is None, "Unexpected cursors of the latest page"
+
+        older = history_manager.get_session_history_page(session_id, limit=2, before=latest["before"])
+        assert [h["user_input"] for h in older["history"]] == ["q1", "q2"], "Unexpected older page"
+        newer = history_manager.get_session_history_page(session_id, limit=2, after=older["after"])
+        assert [h["index"] for h in newer["history"]] == [3, 4], "Unexpected newer page"
+        for edge in ({"before": 0}, {"limit": 0}):
+            page = history_manager.get_session_history_page(session_id, **{"limit": 2, **edge})
+            assert page["history"] == [] and page["total"] == 5, f"{edge} should return an empty page"
+        try:
+            history_manager.get_session_history_page(session_id, limit=2, after=-3)
+            assert False, "Negative cursors should be rejected"
+        except ValueError:
+            pass
+
+        version = latest["version"]
+        assert history_manager.get_history_version(session_id) == version, "Version should be stable without writes"
+        history_manager.save_interaction(session_id, "q5", FRAMES)
+        assert history_manager.get_history_version(session_id) != version, "Version should change on write"
+        version = history_manager.get_history_version(session_id)
+        history_manager.clear_session_history(session_id)
+        assert not list(redis_client.scan_iter(f"history_version:{session_id}*")), \
+            "Clearing should not leave a history_version key behind"
+        assert history_manager.get_history_version(session_id) != version, \
+            "Version should change on clear"
+        print("History page tests passed\n")
+    finally:
+        history_manager.clear_session_history(session_id)
+        redis_client.delete(f"history_version:{session_id}")
+
+
+class FakeTitleLLM(BaseChatModel):
+    """Fake title model answering after a delay, or failing"""
+    answer: str = "Rainy night story"
+    delay: float = 0.0
+    fail: bool = False
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-title"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("title model unavailable")
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+
+def _wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_title_generation():
+    """Test the title draft, the fallback title and its atomic replacement"""
+    print("=== Testing title generation ===")
+
+    draft = TitleDraft(max_chars=10)
+    draft.feed("0123456")
+    assert not draft.done, "A short draft should wait for more text"
+    draft.feed("789abc")
+    assert draft.done and draft.wait(0) == "0123456789", "A full draft should be ready and truncated"
+    closed = TitleDraft()
+    threading.Timer(0.05, closed.close).start()
+    assert closed.wait(5) == "" and closed.done, "Closing should release a waiting title"
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping title generation tests (Redis service may not be running)\n")
+        return
+
+    history_manager = HistoryManager(redis_client)
+    user_id = f"test_title_user_{uuid.uuid4()}"
+    generated, failed, overridden = (f"test_title_{uuid.uuid4()}" for _ in range(3))
+    quick_llm = utils.history.quick_llm
+    try:
+        fake = utils.history.quick_llm = FakeTitleLLM()
+        assert history_manager.start_title_generation(generated, "Write a story about a rainy night", user_id,
+                                                      response_text="It was raining.")
+        assert _wait_for(lambda: history_manager.get_session_meta(generated, use_cache=False).get(
+            "title_source") == TitleSource.GENERATED), "The generated title should replace the fallback"
+        assert history_manager.get_session_title(generated) == "Rainy night story", "Unexpected generated title"
+        assert not history_manager._set_title_if(generated, "fallback", TitleSource.FALLBACK, user_id), \
+            "A fallback title should never replace an existing title"
+        assert not history_manager.start_title_generation(generated, "Another message", user_id), \
+            "Titled sessions should not be titled again"
+
+        fake.fail = True
+        assert history_manager.start_title_generation(failed, "A very long request that gets cut short", user_id,
+                                                      response_text="...")
+        assert _wait_for(lambda: fake.calls == 2), "The title model should be called"
+        time.sleep(0.1)
+        meta = history_manager.get_session_meta(failed, use_cache=False)
+        assert meta["title_source"] == TitleSource.FALLBACK and meta["title"] == "A very long reque...", \
+            f"A failed generation should keep the fallback title: {meta}"
+
+        fake.fail, fake.delay = False, 0.3
+        assert history_manager.start_title_generation(overridden, "Write a poem", user_id, response_text="...")
+        history_manager.update_session_title(overridden, "My poem")
+        assert _wait_for(lambda: fake.calls == 3), "The title model should be called"
+        time.sleep(0.4)
+        assert history_manager.get_session_title(overridden) == "My poem", "A user title should never be replaced"
+        print("Title generation tests passed\n")
+    finally:
+        utils.history.quick_llm = quick_llm
+        for session_id in (generated, failed, overridden):
+            history_manager.delete_session_meta(session_id)
+            history_manager.search_index.remove_session(session_id)
+            redis_client.delete(f"session_keys:{session_id}")
+        redis_client.delete(f"user_sessions_version:{user_id}")
+
+
+if __name__ == "__main__":
+    test_compact_history()
+    test_search_index()
+    test_history_pages()
+    test_title_generation()
@@ -0,0 +1,92 @@
+import threading
+import time
+import uuid
+from redis import Redis
+from env import get_redis_env
+from utils.idempotency import IdempotencyStore, RunStatus
+
+
+def test_idempotency_store():
+    """Test user-scoped idempotency keys, replays and runs whose owner died"""
+    print("=== Testing IdempotencyStore ===")
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping IdempotencyStore tests (Redis service may not be running)\n")
+        return
+
+    store = IdempotencyStore(redis_client, ttl=60, lease_ttl=0.3)
+    client_key = f"test_idempotency_{uuid.uuid4()}"
+    alice, bob = store.scoped_key(client_key, "alice"), store.scoped_key(client_key, "bob")
+    keys = [key for scoped in (alice, bob)
+            for key in (store.state_key(scoped), store.events_key(scoped), store.lease_key(scoped))]
+    try:
+        run = store.begin(alice, "session_a")
+        assert run is not None, "The first request should own the key"
+        assert store.begin(alice, "session_a") is None, "A duplicate should not own the key"
+        assert store.begin(bob, "session_b") is not None, "Keys of different users should not collide"
+        assert store.get_state(alice)["session_id"] == "session_a", "The run should record its session"
+
+        run.start_heartbeat()
+        run.append("data: first\n\n")
+        time.sleep(0.5)
+        assert store.begin(alice, "session_a") is None, "The heartbeat should keep the run alive"
+        run.complete()
+        assert list(store.replay(alice)) == ["data: first\n\n"], "Duplicates should replay the run"
+        assert store.get_state(alice)["status"] == RunStatus.COMPLETED, "The run should be completed"
+
+        # bob's run never renews its lease, as if its worker died: followers fail and the key is freed
+        time.sleep(0.4)
+        replayed = list(store.replay(bob, poll_interval=0.05))
+        assert replayed and "run_lost" in replayed[-1], "Followers of a dead run should get an error"
+        assert store.begin(bob, "session_b") is not None, "A retry should claim a key whose owner died"
+        print("IdempotencyStore tests passed!\n")
+    finally:
+        redis_client.delete(*keys)
+
+
+def test_idempotent_stream_waiting_on_lock():
+    """Test a /stream run keeps its idempotency key while it waits longer than the lease for the session lock"""
+    print("=== Testing idempotent stream waiting on the session lock ===")
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping idempotent stream tests (Redis service may not be running)\n")
+        return
+
+    from fastapi.testclient import TestClient
+    import server
+    store = server.idempotency_store
+    session_id = f"test_idempotency_lock_{uuid.uuid4()}"
+    key = store.scoped_key(f"test_idempotency_{uuid.uuid4()}", "alice")
+    holder = server.session_lock_manager.get_lock(session_id)
+    lease_ttl_ms, lock_wait = store.lease_ttl_ms, server.SESSION_LOCK_WAIT
+    store.lease_ttl_ms, server.SESSION_LOCK_WAIT = 300, 1.5
+    responses = []
+    try:
+        assert holder.try_acquire(), "The test should hold the session lock"
+        request = threading.Thread(target=lambda: responses.append(TestClient(server.app).post(
+            server.base_url + "stream/", headers={"UserId": "alice", "Idempotency-Key": key.split(":", 1)[1]},
+            json={"message": "hello", "sessionId": session_id})))
+        request.start()
+        time.sleep(0.8)
+        assert store.begin(key, session_id) is None, "A retry during the lock wait should not claim the key"
+        request.join()
+        assert responses[0].status_code == 429, f"The lock wait should time out: {responses[0].status_code}"
+        assert store.get_state(key) == {}, "A run that never started should free its key"
+        print("Idempotent stream tests passed!\n")
+    finally:
+        store.lease_ttl_ms, server.SESSION_LOCK_WAIT = lease_ttl_ms, lock_wait
+        holder.release()
+        redis_client.delete(store.state_key(key), store.events_key(key), store.lease_key(key))
+
+
+if __name__ == "__main__":
+    test_idempotency_store()
+    test_idempotent_stream_waiting_on_lock()
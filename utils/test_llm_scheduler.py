@@ -0,0 +1,71 @@
+import threading
+import time
+from redis import Redis
+from env import get_redis_env
+from utils.llm_scheduler import LLMScheduler, LLMAdmissionError, Priority
+
+
+def test_llm_scheduler():
+    """Test concurrency slots, the order of waiters and unlimited user rates"""
+    print("=== Testing LLMScheduler ===")
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping LLMScheduler tests (Redis service may not be running)\n")
+        return
+
+    # No token rate limits, only two concurrent calls; user_rate=0 is unlimited
+    scheduler = LLMScheduler(redis_client, rate=0, user_rate=0, max_concurrency=2, slot_ttl=5,
+                             queue_timeout=5, poll_interval=0.01)
+    prefix = f"test_llm_scheduler:{time.time_ns()}:"
+    scheduler.global_key = f"{prefix}global"
+    scheduler.user_key_prefix = f"{prefix}user:"
+    scheduler.slots_key = f"{prefix}slots"
+    scheduler.waiters_key = f"{prefix}waiters"
+    scheduler.waiters_seen_key = f"{prefix}waiters:seen"
+    try:
+        first = scheduler.acquire("alice")
+        second = scheduler.acquire("alice")
+        assert redis_client.zcard(scheduler.slots_key) == 2, "Each admitted call should hold a slot"
+        try:
+            scheduler.acquire("bob", timeout=0.2)
+            assert False, "Calls beyond the concurrency limit should wait and time out"
+        except LLMAdmissionError:
+            pass
+        assert redis_client.zcard(scheduler.waiters_key) == 0, "Shed callers should leave the line"
+
+        # Waiters are served by priority class first, then arrival
+        admitted = []
+
+        def wait_for_slot(name: str, priority: Priority):
+            with scheduler.acquire(name, priority):
+                admitted.append(name)
+                time.sleep(0.05)
+
+        threads = []
+        for name, priority in (("title", Priority.TITLE), ("critic", Priority.SUB_AGENT),
+                               ("user", Priority.INTERACTIVE)):
+            thread = threading.Thread(target=wait_for_slot, args=(name, priority))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.05)
+        assert redis_client.zcard(scheduler.waiters_key) == 3, "Callers should queue while the slots are busy"
+        first.release()
+        time.sleep(0.2)
+        second.release()
+        for thread in threads:
+            thread.join()
+        assert admitted == ["user", "critic", "title"], f"Unexpected admission order: {admitted}"
+        assert redis_client.zcard(scheduler.slots_key) == 0, "Released calls should return their slots"
+        print("LLMScheduler tests passed!\n")
+    finally:
+        redis_client.delete(scheduler.global_key, scheduler.slots_key, scheduler.waiters_key,
+                            scheduler.waiters_seen_key, f"{scheduler.user_key_prefix}alice",
+                            f"{scheduler.user_key_prefix}bob")
+
+
+if __name__ == "__main__":
+    test_llm_scheduler()
@@ -0,0 +1,108 @@
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import uuid
+from redis import Redis
+from env import get_redis_env
+from utils.history import HistoryManager
+from utils.read_router import ReadRouter
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(predicate, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if predicate():
+                return True
+        except Exception:
+            pass
+        time.sleep(0.05)
+    return False
+
+
+def test_read_router():
+    """Test replica routing and read-your-writes against a second local Redis process"""
+    print("=== Testing ReadRouter ===")
+
+    try:
+        primary = Redis(**get_redis_env())
+        primary.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping ReadRouter tests (Redis service may not be running)\n")
+        return
+    if not shutil.which("redis-server"):
+        print("Skipping ReadRouter tests (redis-server is not installed)\n")
+        return
+
+    port = _free_port()
+    # The replica keeps the snapshot it syncs from the primary in its working directory
+    workdir = tempfile.TemporaryDirectory()
+    process = subprocess.Popen(["redis-server", "--port", str(port), "--save", "", "--appendonly", "no",
+                                "--dir", workdir.name],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    replica = Redis(host="127.0.0.1", port=port)
+    session_id, user_id = f"test_replica_{uuid.uuid4()}", f"test_replica_user_{uuid.uuid4()}"
+    manager = HistoryManager(primary, replicas=[replica])
+    try:
+        assert _wait_for(replica.ping), "Second Redis process should start"
+
+        # Not replicating yet, so the replica never catches up and reads must fall back to the primary
+        manager.save_interaction(session_id, "hello", ['data: {"content": "hi"}\n\n'])
+        manager.add_user_session(user_id, session_id)
+        page = manager.get_session_history_page(session_id)
+        assert [item["user_input"] for item in page["history"]] == ["hello"], "Own writes must be visible"
+        assert manager.get_user_sessions(user_id) == [session_id], "Own session list writes must be visible"
+        assert manager.router.stats["stale"] >= 2, "A lagging replica should be detected by its version"
+
+        # Scopes this process did not write are served by the replica, stale or not
+        assert HistoryManager(primary, replicas=[replica]).get_session_history(session_id) == [], \
+            "Reads without recent writes should go to the replica"
+
+        # Unversioned scopes read the primary within the window
+        router = ReadRouter(primary, [replica], window=60)
+        primary.set(f"{session_id}:plain", "1")
+        router.note_write(f"{session_id}:plain")
+        assert router.read(lambda client: client.get(f"{session_id}:plain"), f"{session_id}:plain") == b"1", \
+            "Recently written unversioned scopes should be read on the primary"
+
+        replica.replicaof(get_redis_env()["host"], get_redis_env()["port"])
+        assert _wait_for(lambda: replica.info("replication").get("master_link_status") == "up", 30), \
+            "Replica should sync with the primary"
+
+        # The write blocks until the replica has it, the next replica read sees it, whatever connection wrote it
+        router = ReadRouter(Redis(**get_redis_env()), [replica], mode="wait", wait_ms=5000)
+        primary.rpush(f"{session_id}:list", "a")
+        router.note_write(f"{session_id}:list")
+        assert router.read(lambda client: client.lrange(f"{session_id}:list", 0, -1)) == [b"a"], \
+            "Writes acknowledged by WAIT should be readable on the replica"
+
+        manager.save_interaction(session_id, "again", ['data: {"content": "ok"}\n\n'])
+        assert _wait_for(lambda: len(HistoryManager(primary, replicas=[replica]).get_session_history(session_id)) == 2), \
+            "Replica should receive new interactions"
+        served = manager.router.stats["replica"]
+        assert len(manager.get_session_history(session_id)) == 2, "Caught-up replica should serve the read"
+        assert manager.router.stats["replica"] == served + 1, "Caught-up replica should be used"
+        print(f"Router stats: {manager.router.stats}")
+        print("ReadRouter tests passed\n")
+    finally:
+        manager.search_index.remove_session(session_id)
+        primary.delete(session_id, f"session_history:{session_id}", f"history_version:{session_id}",
+                       f"user_sessions:{user_id}", f"user_sessions_version:{user_id}",
+                       f"session_keys:{session_id}", f"search:s:{session_id}",
+                       f"{session_id}:plain", f"{session_id}:list")
+        process.terminate()
+        process.wait()
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    test_read_router()
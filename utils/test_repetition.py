@@ -0,0 +1,108 @@
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from session import MemorySession
+from utils.llm import LLMRetry, llm_invoke, llm_stream, llm_tools_invoke, llm_tools_stream, stream_text
+from utils.repetition import RepetitionDetector
+
+
+class LoopingLLM(BaseChatModel):
+    """Fake streaming model looping on a paragraph unless a frequency penalty is set"""
+    calls: list = []
+    sent: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-looping"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="unused"))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("frequency_penalty"):
+            parts = [f"Sentence {i} moves the story forward. " for i in range(50)]
+        else:
+            parts = ["The rain fell on the roof and nobody spoke. "] * 500
+        for part in parts:
+            self.sent += 1
+            yield ChatGenerationChunk(message=AIMessageChunk(content=part))
+
+
+class SilentLLM(BaseChatModel):
+    """Fake streaming model whose stream ends without a chunk"""
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-silent"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=""))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        return iter(())
+
+
+def test_repetition_guard():
+    """Test rolling-hash loop detection and retries of repetitive streams"""
+    print("=== Testing repetition guard ===")
+
+    detector = RepetitionDetector(ngram=16, window=128, threshold=0.8)
+    prose = "".join(f"Line {i}: the traveller counted {i * 7} stones by the river. " for i in range(40))
+    assert not detector.feed(prose), f"Varied text should not trip the guard ({detector.ratio:.2f})"
+    tripped_at = None
+    for i in range(40):
+        if detector.feed("Again and again the same words come back. "):
+            tripped_at = i
+            break
+    assert tripped_at is not None and tripped_at < 10, "A loop should be detected within a few repeats"
+
+    detector = RepetitionDetector(ngram=16, window=128, threshold=0.8)
+    assert detector.feed("哈" * 200), "Single character loops count too"
+
+    llm = LoopingLLM(calls=[])
+    session = MemorySession("test_repetition")
+    session.add_message(HumanMessage(content="write"))
+    ai_msg = llm_tools_invoke(llm, session)
+    assert ai_msg.content.startswith("Sentence 0"), "The retry should return the regenerated output"
+    assert [bool(c.get("frequency_penalty")) for c in llm.calls] == [False, True], \
+        "The retry should adjust sampling"
+    assert llm.sent < 500, f"The looping stream should be cut off early, {llm.sent} chunks sent"
+
+    llm = LoopingLLM(calls=[])
+    session = MemorySession("test_repetition_stream")
+    session.add_message(HumanMessage(content="write"))
+    parts = list(llm_tools_stream(llm, session))
+    retries = [part for part in parts if isinstance(part, LLMRetry)]
+    assert len(retries) == 1 and retries[0].discarded.startswith("The rain fell"), \
+        "The retry should be announced out of band with the aborted text"
+    assert stream_text(parts).startswith("Sentence 0"), "The aborted attempt's text should be dropped"
+    assert session.get_last_message().content.startswith("Sentence 0"), "Only the retry should be kept"
+
+    # Streams without a chunk give an empty message, like invoke
+    history = [HumanMessage(content="write")]
+    assert llm_invoke(SilentLLM(), history).content == "", "An empty stream should give an empty message"
+    stream = llm_stream(SilentLLM(), history)
+    try:
+        while True:
+            next(stream)
+    except StopIteration as e:
+        assert e.value.content == "", "An empty stream should give an empty message"
+
+    # Sub-agents collecting text keep only the regenerated output
+    import agents.agent
+    from agents.drafter.drafter_agent import drafter_agent
+    from agents.drafter.drafter_tools import agent_text
+    job_intent_llm = agents.agent.job_intent_llm
+    try:
+        agents.agent.job_intent_llm = LoopingLLM(calls=[])
+        text = agent_text(drafter_agent, "test_repetition_agent_text", "write")
+        assert text.startswith("Sentence 0") and "rain" not in text and "regenerating" not in text, \
+            f"agent_text should drop the aborted attempt: {text[:80]}"
+    finally:
+        agents.agent.job_intent_llm = job_intent_llm
+    print("Repetition guard tests passed\n")
+
+
+if __name__ == "__main__":
+    test_repetition_guard()
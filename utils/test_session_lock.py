@@ -0,0 +1,89 @@
+import asyncio
+import uuid
+from redis import Redis
+from env import get_redis_env
+from langchain_core.messages import HumanMessage
+from session import RedisSession
+from utils.session_lock import SessionLockManager, SessionLockError, SessionLockLostError
+
+
+def test_session_lock():
+    """Test per-session lease acquisition, fencing and policies"""
+    print("=== Testing SessionLock ===")
+
+    try:
+        redis_client = Redis(**get_redis_env())
+        redis_client.ping()
+    except Exception as e:
+        print(f"Redis connection failed: {e}")
+        print("Skipping SessionLock tests (Redis service may not be running)\n")
+        return
+
+    lock_manager = SessionLockManager(redis_client)
+    session_id = f"test_lock_{uuid.uuid4()}"
+
+    first = lock_manager.get_lock(session_id, ttl=5)
+    second = lock_manager.get_lock(session_id, ttl=5)
+    try:
+        assert first.try_acquire(), "First request should acquire the lease"
+        assert not second.try_acquire(), "Second request should not acquire a held lease"
+        assert int(second.token) > int(
+            first.token), "Fencing tokens should increase monotonically"
+
+        # Reject policy fails fast with 409
+        try:
+            asyncio.run(second.acquire_async(wait=0))
+            assert False, "Busy session should be rejected"
+        except SessionLockError as e:
+            assert e.status_code == 409, f"Expected 409, actual: {e.status_code}"
+
+        # Queue policy times out with 429
+        try:
+            asyncio.run(second.acquire_async(wait=0.3))
+            assert False, "Queued request should time out"
+        except SessionLockError as e:
+            assert e.status_code == 429, f"Expected 429, actual: {e.status_code}"
+
+        # Fenced writes succeed while the lease is held
+        session = RedisSession(session_id, redis_client)
+        session.set_fence(first.lock_key, first.token)
+        session.add_message(HumanMessage(content="fenced message"))
+        assert session.get_message_count() == 1, "Fenced write should succeed"
+
+        # Takeover by another holder fences off the stale writer
+        first.release()
+        assert second.try_acquire(), "Lease should be free after release"
+        try:
+            session.add_message(HumanMessage(content="stale message"))
+            assert False, "Stale holder write should be rejected"
+        except SessionLockLostError:
+            pass
+        assert session.get_message_count() == 1, "Stale write should not be stored"
+        for stale_write in (lambda: session.set_ctx("title", "stale"), session.clear_all_messages,
+                            lambda: session.delete_reverse_message(1)):
+            try:
+                stale_write()
+                assert False, "Every write of a stale holder should be rejected"
+            except SessionLockLostError:
+                pass
+        assert session.get_message_count() == 1 and session.get_ctx("title") is None, \
+            "Stale context and list writes should not be applied"
+        assert not first.extend() and first.lost, "Stale holder should detect lease loss"
+
+        # A deleted and re-created session keeps issuing newer tokens
+        second.release()
+        redis_client.delete(session_id, f"session_ctx:{session_id}")
+        recreated = lock_manager.get_lock(session_id, ttl=5)
+        assert recreated.try_acquire() and int(recreated.token) > int(second.token), \
+            "Tokens should not restart after the session is deleted"
+        recreated.release()
+    finally:
+        first.release()
+        second.release()
+        redis_client.delete(session_id, f"session_ctx:{session_id}", first.lock_key)
+
+    print("SessionLock tests passed!\n")
+
+
+if __name__ == "__main__":
+    test_session_lock()